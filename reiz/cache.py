@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from typing import Any, Optional
+
+from reiz.utilities import get_config_settings, logger
+
+# Bumped by the inserter after each ingestion; all cached results are
+# keyed by the generation of the corpus they were computed against.
+GENERATION_KEY = "reiz:generation"
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_LOCAL_SIZE = 512
+DEFAULT_LOCAL_TTL = 60
+DEFAULT_GENERATION_REFRESH = 5.0
+
+TIERS = ("local", "redis")
+
+
+def encode_results(results: Any) -> bytes:
+    return zlib.compress(json.dumps(results).encode())
+
+
+def decode_results(payload: bytes) -> Any:
+    return json.loads(zlib.decompress(payload))
+
+
+def bump_generation(client=None) -> Optional[int]:
+    if client is None:
+        if not (redis_url := get_config_settings().get("redis")):
+            return None
+
+        import redis
+
+        client = redis.from_url(redis_url)
+
+    generation = client.incr(GENERATION_KEY)
+    logger.info("corpus generation is bumped to %d", generation)
+    return generation
+
+
+class LocalCache:
+    # In-process LRU tier in front of redis. Entries expire after a short
+    # TTL, since other workers can't invalidate them.
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_LOCAL_SIZE,
+        ttl: float = DEFAULT_LOCAL_TTL,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            if (entry := self._entries.get(key)) is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class ResultCache:
+    # Two-tier (local LRU + redis) cache of the query results. Results are
+    # stored compressed in redis with a TTL, under a key that contains the
+    # current corpus generation so that a new ingestion invalidates them.
+
+    def __init__(
+        self,
+        client,
+        ttl: int = DEFAULT_TTL,
+        local: Optional[LocalCache] = None,
+        generation_refresh: float = DEFAULT_GENERATION_REFRESH,
+    ) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.local = local or LocalCache()
+        self.generation_refresh = generation_refresh
+        self.metrics = Counter()
+        self._generation = None
+        self._generation_expires = 0.0
+
+    @classmethod
+    def from_config(cls, client) -> ResultCache:
+        options = get_config_settings().get("cache", {})
+        return cls(
+            client,
+            ttl=options.get("ttl", DEFAULT_TTL),
+            local=LocalCache(
+                options.get("local_size", DEFAULT_LOCAL_SIZE),
+                options.get("local_ttl", DEFAULT_LOCAL_TTL),
+            ),
+            generation_refresh=options.get(
+                "generation_refresh", DEFAULT_GENERATION_REFRESH
+            ),
+        )
+
+    def _needs_generation(self) -> bool:
+        return (
+            self._generation is None
+            or self._generation_expires < time.monotonic()
+        )
+
+    def _update_generation(self, generation) -> int:
+        # The generation is only re-read every few seconds, instead of
+        # adding another round trip to every lookup.
+        self._generation = int(generation or 0)
+        self._generation_expires = time.monotonic() + self.generation_refresh
+        return self._generation
+
+    def get_generation(self) -> int:
+        if self._needs_generation():
+            return self._update_generation(self.client.get(GENERATION_KEY))
+        return self._generation
+
+    def make_key(self, key: str, generation: int) -> str:
+        return f"reiz:results:{generation}:{key}"
+
+    def _record(self, tier: str, hit: bool) -> None:
+        self.metrics[tier, "hits" if hit else "misses"] += 1
+
+    def _get_local(self, full_key: str) -> Any:
+        value = self.local.get(full_key)
+        self._record("local", value is not None)
+        return value
+
+    def _decode_remote(self, full_key: str, payload: Optional[bytes]) -> Any:
+        self._record("redis", payload is not None)
+        if payload is None:
+            return None
+
+        value = decode_results(payload)
+        self.local.set(full_key, value)
+        return value
+
+    def get(self, key: str) -> Any:
+        full_key = self.make_key(key, self.get_generation())
+        if (value := self._get_local(full_key)) is not None:
+            return value
+        return self._decode_remote(full_key, self.client.get(full_key))
+
+    def set(self, key: str, value: Any) -> None:
+        full_key = self.make_key(key, self.get_generation())
+        self.client.set(full_key, encode_results(value), ex=self.ttl)
+        self.local.set(full_key, value)
+
+    def get_metrics(self):
+        return {
+            tier: {
+                "hits": self.metrics[tier, "hits"],
+                "misses": self.metrics[tier, "misses"],
+            }
+            for tier in TIERS
+        }
+
+
+class AsyncResultCache(ResultCache):
+    # Same as the ResultCache, but for the redis.asyncio clients.
+
+    async def get_generation(self) -> int:
+        if self._needs_generation():
+            return self._update_generation(
+                await self.client.get(GENERATION_KEY)
+            )
+        return self._generation
+
+    async def get(self, key: str) -> Any:
+        full_key = self.make_key(key, await self.get_generation())
+        if (value := self._get_local(full_key)) is not None:
+            return value
+        return self._decode_remote(full_key, await self.client.get(full_key))
+
+    async def set(self, key: str, value: Any) -> None:
+        full_key = self.make_key(key, await self.get_generation())
+        await self.client.set(full_key, encode_results(value), ex=self.ttl)
+        self.local.set(full_key, value)
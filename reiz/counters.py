@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import ast
+import asyncio
+import json
+import sqlite3
+from argparse import ArgumentParser
+from collections import Counter
+from contextlib import closing
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from edgedb.errors import InvalidReferenceError
+
+from reiz.db.connection import connect, get_shard_index, resolve_shards
+from reiz.db.pool import get_shards, run_read
+from reiz.db.schema import RESERVED_NAMES, protected_name
+from reiz.edgeql import EdgeQLCall, EdgeQLSelect, as_edgeql
+from reiz.utilities import get_config_settings, get_db_settings, logger
+
+# Project name of the corpus-wide counters
+TOTAL = ""
+
+# The counters are stored in the database (ast::NodeCounter), next to the
+# nodes of each project on its own shard. The corpus-wide counts are the
+# sums of every project's counts, which the queries below take when they
+# get TOTAL (the empty string) as the project.
+ADD_COUNTS_QUERY = """
+FOR item IN {json_array_unpack(<json>$counts)}
+UNION (
+    INSERT ast::NodeCounter {
+        project := <str>$project,
+        name := <str>item['name'],
+        count := <int64>item['count']
+    }
+    UNLESS CONFLICT ON (.project, .name)
+    ELSE (
+        UPDATE ast::NodeCounter
+        SET { count := .count + <int64>item['count'] }
+    )
+)
+"""
+
+COUNTS_QUERY = """
+FOR node IN {array_unpack(<array<str>>$names)}
+UNION (
+    node := node,
+    count := sum((
+        SELECT ast::NodeCounter
+        FILTER .name = node
+        AND (<str>$project = '' OR .project = <str>$project)
+    ).count)
+)
+"""
+
+ALL_COUNTS_QUERY = """
+WITH counters := (
+    SELECT ast::NodeCounter
+    FILTER <str>$project = '' OR .project = <str>$project
+)
+FOR node IN {DISTINCT counters.name}
+UNION (
+    node := node,
+    count := sum((SELECT counters FILTER .name = node).count)
+)
+"""
+
+EXISTS_QUERY = "SELECT EXISTS ast::NodeCounter"
+
+# SQLite's default limit for the host parameters is 999 on older versions
+BATCH_SIZE = 500
+
+
+def count_node(counts: Counter, node: ast.AST) -> None:
+    # Nodes are accounted under their own type and all of their bases
+    # (e.g. Name, expr and AST), so that both the concrete and the
+    # abstract counts are a single lookup.
+    for base in type(node).__mro__:
+        if issubclass(base, ast.AST):
+            counts[base.__name__] += 1
+
+
+def add_counts(connection, counts: Dict[str, int], project=None) -> None:
+    # Called by the inserter in the same transaction as the nodes, so the
+    # counters never drift from the corpus. Each project's rows are only
+    # updated by the worker that inserts that project.
+    if not counts:
+        return None
+
+    items = [{"name": name, "count": count} for name, count in counts.items()]
+    connection.query(
+        ADD_COUNTS_QUERY, counts=json.dumps(items), project=project or TOTAL
+    )
+
+
+def get_counter_shards(shards, project=TOTAL):
+    # A project's counters are only stored on its own shard
+    if project != TOTAL:
+        return [shards[get_shard_index(project, len(shards))]]
+    else:
+        return shards
+
+
+def sum_counts(row_sets) -> Counter:
+    counts = Counter()
+    for rows in row_sets:
+        counts.update({row.node: row.count for row in rows or ()})
+    return counts
+
+
+class DatabaseCounters:
+    # Per node type (and per project) counts of the inserted nodes, read
+    # from the database (see add_counts()) through the API's pools so that
+    # the API doesn't need to scan the corpus for them.
+
+    def _run(self, func, shard):
+        # The databases that were created before the counters don't know
+        # the type, they are treated as having no counters at all.
+        try:
+            return run_read(func, shard)
+        except InvalidReferenceError:
+            logger.warning("shard %d doesn't have the node counters", shard)
+            return None
+
+    def _collect(self, query, project, **kwargs) -> Counter:
+        return sum_counts(
+            self._run(
+                lambda connection: connection.query(
+                    query, project=project, **kwargs
+                ),
+                shard,
+            )
+            for shard in get_counter_shards(get_shards(), project)
+        )
+
+    def get(
+        self, names: Iterable[str], project: str = TOTAL
+    ) -> Dict[str, int]:
+        names = list(names)
+        counts = self._collect(COUNTS_QUERY, project, names=names)
+        return {name: counts[name] for name in names}
+
+    def get_all(self, project: str = TOTAL) -> Dict[str, int]:
+        return dict(self._collect(ALL_COUNTS_QUERY, project))
+
+    def is_empty(self) -> bool:
+        return not any(
+            self._run(
+                lambda connection: connection.query_one(EXISTS_QUERY), shard
+            )
+            for shard in get_shards()
+        )
+
+
+class AsyncDatabaseCounters:
+    # The asyncio counterpart of DatabaseCounters, over the ASGI app's
+    # pools (see reiz.db.pool.AsyncShardPool).
+
+    def __init__(self, pools) -> None:
+        self.pools = pools
+
+    async def _run(self, shard, method, query, **kwargs):
+        try:
+            return await getattr(self.pools[shard], method)(query, **kwargs)
+        except InvalidReferenceError:
+            logger.warning("shard %d doesn't have the node counters", shard)
+            return None
+
+    async def _collect(self, query, project, **kwargs) -> Counter:
+        shards = get_counter_shards(range(len(self.pools)), project)
+        row_sets = await asyncio.gather(
+            *(
+                self._run(shard, "query", query, project=project, **kwargs)
+                for shard in shards
+            )
+        )
+        return sum_counts(row_sets)
+
+    async def get(
+        self, names: Iterable[str], project: str = TOTAL
+    ) -> Dict[str, int]:
+        names = list(names)
+        counts = await self._collect(COUNTS_QUERY, project, names=names)
+        return {name: counts[name] for name in names}
+
+    async def get_all(self, project: str = TOTAL) -> Dict[str, int]:
+        return dict(await self._collect(ALL_COUNTS_QUERY, project))
+
+    async def is_empty(self) -> bool:
+        exists = await asyncio.gather(
+            *(
+                self._run(shard, "query_one", EXISTS_QUERY)
+                for shard in range(len(self.pools))
+            )
+        )
+        return not any(exists)
+
+
+class NodeCounters:
+    # A local SQLite copy of the counters, for the deployments that don't
+    # want /stats to touch the database. It is opt-in (the "counters"
+    # setting, or insert's --counters), and is only as complete as the
+    # ingestions that were run with it.
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "project TEXT NOT NULL, "
+                "name TEXT NOT NULL, "
+                "count INTEGER NOT NULL, "
+                "PRIMARY KEY (project, name))"
+            )
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def add(self, counts: Dict[str, int], project: Optional[str] = None):
+        rows = [(TOTAL, name, count) for name, count in counts.items()]
+        if project:
+            rows.extend(
+                (project, name, count) for name, count in counts.items()
+            )
+
+        with self._connect() as connection, connection:
+            connection.executemany(
+                "INSERT INTO counters VALUES (?, ?, ?) "
+                "ON CONFLICT (project, name) "
+                "DO UPDATE SET count = count + excluded.count",
+                rows,
+            )
+
+    def get(
+        self, names: Iterable[str], project: str = TOTAL
+    ) -> Dict[str, int]:
+        names = list(names)
+        counts = dict.fromkeys(names, 0)
+        with self._connect() as connection:
+            for start in range(0, len(names), BATCH_SIZE):
+                batch = names[start : start + BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                cursor = connection.execute(
+                    "SELECT name, count FROM counters "
+                    f"WHERE project = ? AND name IN ({placeholders})",
+                    (project, *batch),
+                )
+                counts.update(cursor)
+        return counts
+
+    def get_all(self, project: str = TOTAL) -> Dict[str, int]:
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "SELECT name, count FROM counters WHERE project = ?",
+                (project,),
+            )
+            return dict(cursor)
+
+    def projects(self) -> List[str]:
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "SELECT DISTINCT project FROM counters WHERE project != ?",
+                (TOTAL,),
+            )
+            return [project for project, in cursor]
+
+    def is_empty(self) -> bool:
+        with self._connect() as connection:
+            cursor = connection.execute("SELECT 1 FROM counters LIMIT 1")
+            return cursor.fetchone() is None
+
+    def clear(self) -> None:
+        with self._connect() as connection, connection:
+            connection.execute("DELETE FROM counters")
+
+
+def get_counters_path() -> Optional[Path]:
+    if path := get_config_settings().get("counters"):
+        return Path(path).expanduser()
+    else:
+        return None
+
+
+@lru_cache(1)
+def get_node_counters():
+    if (path := get_counters_path()) is not None:
+        return NodeCounters(path)
+    else:
+        return DatabaseCounters()
+
+
+def unprotected_name(name: str) -> str:
+    name = name.replace("ast::", "", 1)
+    for reserved_name in RESERVED_NAMES:
+        if protected_name(reserved_name, prefix=False) == name:
+            return reserved_name
+    return name
+
+
+def count_types(connection) -> Dict[str, int]:
+    type_query = (
+        "SELECT schema::ObjectType.name "
+        "FILTER schema::ObjectType.name LIKE 'ast::%' "
+        "AND schema::ObjectType.name != 'ast::NodeCounter'"
+    )
+    counts = {}
+    for type_name in connection.query(type_query):
+        query = as_edgeql(EdgeQLSelect(EdgeQLCall("count", [type_name])))
+        count = connection.query_one(query)
+        counts[unprotected_name(type_name)] = count
+        logger.info("%s: %d", type_name, count)
+    return counts
+
+
+def rebuild(
+    dsn: str,
+    database: str,
+    shards=None,
+    counters: Optional[NodeCounters] = None,
+) -> Dict[str, int]:
+    # Counts every object type in the database from scratch. This is only
+    # needed for the corpora that were inserted before the counters were
+    # introduced, and the per-project breakdowns can't be recovered (the
+    # counts are stored under the TOTAL project).
+    if counters is not None:
+        counters.clear()
+
+    total = Counter()
+    for settings in resolve_shards(dsn, database, shards):
+        with connect(**settings) as connection:
+            counts = count_types(connection)
+            with connection.transaction():
+                connection.query("DELETE ast::NodeCounter")
+                add_counts(connection, counts)
+        if counters is not None:
+            counters.add(counts)
+        total.update(counts)
+    return total
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dsn", default=get_db_settings()["dsn"])
+    parser.add_argument("--database", default=get_db_settings()["database"])
+    parser.add_argument(
+        "--shards", nargs="+", default=get_config_settings().get("shards")
+    )
+    parser.add_argument(
+        "--path",
+        type=Path,
+        default=get_counters_path(),
+        help="also rebuild the local copy of the counters in the given "
+        "SQLite database",
+    )
+    options = parser.parse_args()
+    rebuild(
+        options.dsn,
+        options.database,
+        options.shards,
+        counters=NodeCounters(options.path) if options.path else None,
+    )
+
+
+if __name__ == "__main__":
+    main()
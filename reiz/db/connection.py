@@ -1,3 +1,4 @@
+import hashlib
 from contextlib import closing
 from functools import partial
 
@@ -7,8 +8,61 @@ DEFAULT_DSN = "edgedb://edgedb@localhost/"
 DEFAULT_DATABASE = "asttests"
 
 
+def create_connection(dsn, database, *args, **kwargs):
+    return edgedb.connect(dsn=dsn, database=database, *args, **kwargs)
+
+
 def connect(dsn, database, *args, **kwargs):
-    return closing(edgedb.connect(dsn=dsn, database=database, *args, **kwargs))
+    return closing(create_connection(dsn, database, *args, **kwargs))
 
 
 simple_connection = partial(connect, DEFAULT_DSN, DEFAULT_DATABASE)
+
+
+def create_async_pool(dsn, database, *args, **kwargs):
+    return edgedb.create_async_pool(
+        dsn=dsn, database=database, *args, **kwargs
+    )
+
+
+def resolve_shards(dsn, database, shards=None):
+    # Connection settings of each shard. The shards are either database
+    # names (on the same server) or {"dsn": ..., "database": ...} objects;
+    # without any, the whole corpus is a single shard.
+    if not shards:
+        return [{"dsn": dsn, "database": database}]
+
+    return [
+        {"dsn": dsn, "database": shard}
+        if isinstance(shard, str)
+        else {key: value for key, value in shard.items() if key != "readers"}
+        for shard in shards
+    ]
+
+
+def resolve_readers(database, shards=None, readers=None):
+    # Connection settings of the read replicas of each shard (in the same
+    # order as resolve_shards()), which serve the same databases as their
+    # writers. The shards on the main server share its readers, the rest
+    # can list their own ({"dsn": ..., "database": ..., "readers": [...]}).
+    if not shards:
+        shards = [database]
+
+    return [
+        [{"dsn": reader, "database": shard} for reader in readers or ()]
+        if isinstance(shard, str)
+        else [
+            {"dsn": reader, "database": shard["database"]}
+            for reader in shard.get("readers", ())
+        ]
+        for shard in shards
+    ]
+
+
+def get_shard_index(project, shard_count):
+    # Projects are assigned to the shards by a stable hash of their names
+    # (unlike hash(), it is the same on every process). Changing the
+    # number of shards moves the projects around, so the corpus needs to
+    # be re-inserted afterwards.
+    digest = hashlib.sha256(project.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
@@ -0,0 +1,358 @@
+from __future__ import annotations
+
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from functools import lru_cache, partial
+
+import edgedb
+
+from reiz.db.connection import create_connection
+from reiz.db.timeouts import QueryTimeout
+from reiz.utilities import (
+    get_config_settings,
+    get_reader_settings,
+    get_shard_settings,
+    logger,
+    timed,
+)
+
+DEFAULT_MAX_SIZE = 8
+DEFAULT_ACQUIRE_TIMEOUT = 30.0
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0
+DEFAULT_READER_RETRY_INTERVAL = 30.0
+
+# Errors that mean the server itself is unreachable (rather than that
+# something is wrong with the query).
+CONNECTION_ERRORS = (edgedb.errors.ClientConnectionError, OSError)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Errors after which a read is retried on another server of the shard
+RETRIED_ERRORS = CONNECTION_ERRORS + (PoolTimeout,)
+
+
+class PooledConnection:
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Errors from the server (e.g. an invalid query) leave the
+        # connection usable, anything else might have left it in a
+        # broken state. Timed out connections are either still usable
+        # or closed by the watchdog, which the release() checks anyway.
+        broken = exc_value is not None and not isinstance(
+            exc_value, (edgedb.errors.QueryError, QueryTimeout)
+        )
+        self.pool.release(self.connection, discard=broken)
+        if broken:
+            self.pool.report(exc_value)
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        factory,
+        max_size=DEFAULT_MAX_SIZE,
+        acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT,
+        health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+        on_error=None,
+    ):
+        self.factory = factory
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.on_error = on_error
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._size = 0
+        self._idle = deque()
+        self._condition = threading.Condition()
+
+    def _check_fork(self):
+        # Connections inherited from the parent process share their
+        # sockets with it, so the child should neither use nor close
+        # them; it just starts over with an empty pool.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _is_healthy(self, connection, last_used):
+        if connection.is_closed():
+            return False
+        elif time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            connection.query_one("SELECT 1")
+        except Exception:
+            logger.warning("discarding a broken pooled connection")
+            return False
+        else:
+            return True
+
+    def acquire(self, timeout=None):
+        self._check_fork()
+        if timeout is None:
+            timeout = self.acquire_timeout
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                elif self._size < self.max_size:
+                    self._size += 1
+                    connection = None
+                    break
+                elif not self._condition.wait(deadline - time.monotonic()):
+                    raise PoolTimeout(
+                        f"couldn't acquire a connection in {timeout}s"
+                    )
+
+        if connection is not None:
+            if self._is_healthy(connection, last_used):
+                return PooledConnection(self, connection)
+            else:
+                self._discard(connection)
+                return self.acquire(deadline - time.monotonic())
+
+        try:
+            connection = self.factory()
+        except BaseException as exc:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            self.report(exc)
+            raise
+        return PooledConnection(self, connection)
+
+    def report(self, exc):
+        if self.on_error is not None and isinstance(exc, CONNECTION_ERRORS):
+            self.on_error(exc)
+
+    def release(self, connection, discard=False):
+        if self._pid != os.getpid():
+            return None
+
+        if discard or connection.is_closed():
+            self._discard(connection)
+        else:
+            with self._condition:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def get_metrics(self):
+        with self._condition:
+            return {
+                "max_size": self.max_size,
+                "open": self._size,
+                "idle": len(self._idle),
+            }
+
+    def close(self):
+        self._check_fork()
+        with self._condition:
+            connections = [connection for connection, _ in self._idle]
+            self._size -= len(connections)
+            self._idle.clear()
+
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+class ReaderHealth:
+    # Readers that couldn't be reached are skipped until their retry
+    # interval passes; the first query afterwards either finds them back
+    # or marks them again.
+
+    def __init__(self, retry_interval=DEFAULT_READER_RETRY_INTERVAL):
+        self.retry_interval = retry_interval
+        self._retry_at = {}
+        self._turns = itertools.count()
+
+    def select(self, readers):
+        # The healthy ones, rotated so that the reads are spread evenly
+        now = time.monotonic()
+        healthy = [
+            reader
+            for reader in readers
+            if self._retry_at.get(reader, 0.0) <= now
+        ]
+        if not healthy:
+            return []
+
+        start = next(self._turns) % len(healthy)
+        return healthy[start:] + healthy[:start]
+
+    def mark_failed(self, reader, exc=None):
+        logger.warning(
+            "reader %r is unavailable (%s), skipping it for %gs",
+            reader,
+            exc,
+            self.retry_interval,
+        )
+        self._retry_at[reader] = time.monotonic() + self.retry_interval
+
+
+@lru_cache(1)
+def get_reader_health():
+    options = get_config_settings().get("pool", {})
+    return ReaderHealth(
+        options.get("reader_retry_interval", DEFAULT_READER_RETRY_INTERVAL)
+    )
+
+
+def get_readers(shard=0):
+    return [
+        (shard, reader) for reader in range(len(get_reader_settings()[shard]))
+    ]
+
+
+@lru_cache(None)
+def get_pool(shard=0, reader=None):
+    # Each shard has its own pools (of the configured size), one for the
+    # writer and one for each of its readers.
+    options = get_config_settings().get("pool", {})
+    if reader is None:
+        settings, on_error = get_shard_settings()[shard], None
+    else:
+        settings = get_reader_settings()[shard][reader]
+        on_error = partial(get_reader_health().mark_failed, (shard, reader))
+    return ConnectionPool(
+        partial(create_connection, **settings),
+        max_size=options.get("max_size", DEFAULT_MAX_SIZE),
+        acquire_timeout=options.get(
+            "acquire_timeout", DEFAULT_ACQUIRE_TIMEOUT
+        ),
+        health_check_interval=options.get(
+            "health_check_interval", DEFAULT_HEALTH_CHECK_INTERVAL
+        ),
+        on_error=on_error,
+    )
+
+
+def get_shards():
+    return range(len(get_shard_settings()))
+
+
+def run_read(func, shard=0, timeout=None, timings=None):
+    # The pooled connections only serve the reads (the ingestion connects
+    # to the writers directly), so func(connection) goes to the healthy
+    # readers of the shard in turns. When a reader can't serve it (it is
+    # unreachable, the connection breaks during the statement or its pool
+    # is exhausted), the reader is marked and the whole statement is
+    # retried on the next one, and eventually on the writer. The checkouts
+    # are timed as the "connect" phase.
+    health = get_reader_health()
+    for key in health.select(get_readers(shard)):
+        try:
+            with timed(timings, "connect"):
+                pooled = get_pool(*key).acquire(timeout)
+            with pooled as connection:
+                return func(connection)
+        except RETRIED_ERRORS as exc:
+            # Connection errors are already reported by the pool
+            if isinstance(exc, PoolTimeout):
+                health.mark_failed(key, exc)
+            logger.warning("retrying a read of shard %d elsewhere", shard)
+
+    with timed(timings, "connect"):
+        pooled = get_pool(shard).acquire(timeout)
+    with pooled as connection:
+        return func(connection)
+
+
+def get_all_pools():
+    for shard in get_shards():
+        yield get_pool(shard)
+        for key in get_readers(shard):
+            yield get_pool(*key)
+
+
+def get_pool_metrics():
+    metrics = {}
+    for pool in get_all_pools():
+        for state, value in pool.get_metrics().items():
+            metrics[state] = metrics.get(state, 0) + value
+    return metrics
+
+
+def close_pools():
+    for pool in get_all_pools():
+        pool.close()
+
+
+class AsyncShardPool:
+    # The asyncio counterpart of run_read(); the pools of a shard's writer
+    # and readers behind the (used subset of the) interface of a single
+    # edgedb async pool.
+
+    def __init__(self, writer, readers, shard=0, health=None):
+        self.writer = writer
+        self.readers = readers
+        self.shard = shard
+        self.health = health or get_reader_health()
+
+    async def run(self, func):
+        # Awaits func(connection), see run_read()
+        keys = [(self.shard, reader) for reader in range(len(self.readers))]
+        for key in self.health.select(keys):
+            try:
+                async with self.readers[key[1]].acquire() as connection:
+                    return await func(connection)
+            except CONNECTION_ERRORS as exc:
+                self.health.mark_failed(key, exc)
+                logger.warning(
+                    "retrying a read of shard %d elsewhere", self.shard
+                )
+
+        async with self.writer.acquire() as connection:
+            return await func(connection)
+
+    async def query(self, query, **kwargs):
+        return await self.run(
+            lambda connection: connection.query(query, **kwargs)
+        )
+
+    async def query_one(self, query, **kwargs):
+        return await self.run(
+            lambda connection: connection.query_one(query, **kwargs)
+        )
+
+    def get_max_size(self):
+        return sum(pool.get_max_size() for pool in self._pools())
+
+    def get_free_size(self):
+        return sum(pool.get_free_size() for pool in self._pools())
+
+    async def aclose(self):
+        for pool in self._pools():
+            await pool.aclose()
+
+    def _pools(self):
+        return [self.writer, *self.readers]
@@ -6,7 +6,10 @@ from pathlib import Path
 import edgedb
 from edgedb.errors import InvalidReferenceError
 
-from reiz.utilities import get_db_settings
+from reiz.counters import NodeCounters, get_counters_path
+from reiz.db.connection import resolve_shards
+from reiz.materialized import MaterializedQueries, get_materialized_path
+from reiz.utilities import get_config_settings, get_db_settings
 
 
 def drop_all_connection():
@@ -20,8 +23,7 @@ def drop_all_connection():
     )
 
 
-def drop_and_load_db(schema, dsn, database):
-    drop_all_connection()
+def load_db(schema, dsn, database):
     with closing(edgedb.connect(dsn, database="edgedb")) as connection:
         with suppress(InvalidReferenceError):
             connection.execute(f"DROP DATABASE {database}")
@@ -36,11 +38,27 @@ def drop_and_load_db(schema, dsn, database):
         connection.execute("COMMIT MIGRATION")
 
 
+def drop_and_load_db(schema, dsn, database, shards=None):
+    drop_all_connection()
+    for settings in resolve_shards(dsn, database, shards):
+        print(f"Resetting {settings['database']}...")
+        load_db(schema, **settings)
+    if (path := get_counters_path()) is not None:
+        print("Resetting the local node counters...")
+        NodeCounters(path).clear()
+    if (path := get_materialized_path()) is not None:
+        print("Resetting the materialized queries...")
+        MaterializedQueries(path).clear()
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("schema", type=Path)
     parser.add_argument("--dsn", default=get_db_settings()["dsn"])
     parser.add_argument("--database", default=get_db_settings()["database"])
+    parser.add_argument(
+        "--shards", nargs="+", default=get_config_settings().get("shards")
+    )
     options = parser.parse_args()
     drop_and_load_db(**vars(options))
 
@@ -18,6 +18,8 @@ EDGEQL_BASICS = {
 }
 
 UNIQUE_FIELDS = ["filename"]
+# Links that the scoped queries filter on (see reiz.fetch.Scope)
+INDEXED_FIELDS = ["_module", "_project"]
 ENUM_TYPES = set()
 
 
@@ -92,6 +94,13 @@ class QLModel:
     fields: List[QLField] = field(default_factory=list)
     extending: Optional[str] = None
     constraint: Optional[ModelConstraint] = None
+    indexes: List[str] = field(default_factory=list)
+    constraints: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        for model_field in self.fields:
+            if model_field.name in INDEXED_FIELDS:
+                self.indexes.append(model_field.name)
 
     def __str__(self):
         lines = []
@@ -105,6 +114,13 @@ class QLModel:
 
         lines[-1] += " " + "{"
         lines.extend(DEFAULT_INDENT + str(field) for field in self.fields)
+        lines.extend(
+            DEFAULT_INDENT + constraint + ";"
+            for constraint in self.constraints
+        )
+        lines.extend(
+            DEFAULT_INDENT + f"index on (.{index});" for index in self.indexes
+        )
         if len(lines) == 1:
             lines[-1] += "}"
         else:
@@ -126,7 +142,31 @@ def as_enum(names):
 
 class GraphQLGenerator(pyasdl.ASDLVisitor):
     def visit_Module(self, node):
-        definitions = [QLModel("AST", constraint=ModelConstraint.ABSTRACT)]
+        definitions = [
+            QLModel("AST", constraint=ModelConstraint.ABSTRACT),
+            QLModel(
+                "Project",
+                [
+                    QLField(
+                        "name",
+                        "string",
+                        FieldConstraint.REQUIRED,
+                        properties=["constraint exclusive;"],
+                    )
+                ],
+            ),
+            # Node counts of each project, see reiz.counters
+            QLModel(
+                "NodeCounter",
+                [
+                    QLField("project", "string", FieldConstraint.REQUIRED),
+                    QLField("name", "string", FieldConstraint.REQUIRED),
+                    QLField("count", "int", FieldConstraint.REQUIRED),
+                ],
+                indexes=["name"],
+                constraints=["constraint exclusive on ((.project, .name))"],
+            ),
+        ]
         for definition in node.body:
             definitions.extend(self.visit(definition))
         yield from self.fix_references(definitions)
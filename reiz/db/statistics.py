@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+
+from reiz.utilities import get_config_settings
+
+DEFAULT_STATISTICS_PATH = Path("~/.local/reiz-stats.json").expanduser()
+
+# The path, the modification time and the statistics that were loaded from
+# it, see get_statistics().
+_STATISTICS = []
+_STATISTICS_LOCK = threading.Lock()
+
+
+@dataclass
+class FieldStatistics:
+    total: int = 0
+    distinct: int = 0
+    most_common: Dict[str, int] = field(default_factory=dict)
+
+    def frequency(self, value: str) -> float:
+        # Values that are not tracked are assumed to be uniformly
+        # distributed over the remaining (non-common) part.
+        if value in self.most_common:
+            return self.most_common[value]
+
+        remaining = self.total - sum(self.most_common.values())
+        rare_values = self.distinct - len(self.most_common)
+        return max(remaining, 0) / max(rare_values, 1)
+
+
+@dataclass
+class Statistics:
+    counts: Dict[str, int] = field(default_factory=dict)
+    fields: Dict[str, Dict[str, FieldStatistics]] = field(default_factory=dict)
+
+    def __bool__(self):
+        return bool(self.counts)
+
+    def count(self, name: str) -> Optional[int]:
+        return self.counts.get(name)
+
+    def field_statistics(
+        self, name: str, pointer: str
+    ) -> Optional[FieldStatistics]:
+        return self.fields.get(name, {}).get(pointer)
+
+    @classmethod
+    def load(cls, path: Path) -> Statistics:
+        if not path.exists():
+            return cls()
+
+        with open(path) as stats_f:
+            data = json.load(stats_f)
+
+        return cls(
+            counts=data["counts"],
+            fields={
+                name: {
+                    pointer: FieldStatistics(**field_stats)
+                    for pointer, field_stats in pointers.items()
+                }
+                for name, pointers in data["fields"].items()
+            },
+        )
+
+    def dump(self, path: Path) -> None:
+        # The API processes reload the file while it is being replaced, so
+        # it is written aside and then renamed over the old one.
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(temp_path, "w") as stats_f:
+            json.dump(asdict(self), stats_f)
+        os.replace(temp_path, path)
+
+
+def get_statistics_path() -> Path:
+    if path := get_config_settings().get("statistics"):
+        return Path(path).expanduser()
+    else:
+        return DEFAULT_STATISTICS_PATH
+
+
+def get_statistics() -> Statistics:
+    # The statistics are reloaded whenever reiz.pipes.analyze (or insert's
+    # --analyze) rewrites the file. Until then the same object is returned,
+    # which the prepared queries of reiz.fetch rely on.
+    path = get_statistics_path()
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+
+    with _STATISTICS_LOCK:
+        if _STATISTICS[:2] != [path, mtime]:
+            _STATISTICS[:] = [path, mtime, Statistics.load(path)]
+        return _STATISTICS[2]
@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import weakref
+from contextlib import contextmanager
+
+import edgedb
+
+from reiz.utilities import get_config_settings, logger
+
+# Budgets (in seconds) of each kind of query; they can be overridden
+# through the "timeouts" section of the config, and a null disables them.
+# These should stay below the gunicorn's worker timeout.
+DEFAULT_TIMEOUTS = {
+    "query": 30.0,
+    "stats": 60.0,
+    "approximate": 30.0,
+    "stream": 30.0,
+    "job": 15 * 60.0,
+}
+
+# The server is expected to abort the statement by itself; the client
+# only gives up on it (and drops the connection) after this much extra
+# time, e.g. when the server is unresponsive.
+CANCEL_GRACE = 5.0
+
+# Last timeout that each connection's session was configured with, so
+# that it is only sent when it changes.
+_SESSION_TIMEOUTS = weakref.WeakKeyDictionary()
+_SERVER_TIMEOUTS = True
+
+# Raised by the servers that don't know about query_execution_timeout
+# (an unrecognized configuration object), or can't configure it. Other
+# errors (e.g. a broken connection) are not a reason to give up on the
+# server side timeouts.
+UNSUPPORTED_ERRORS = (
+    edgedb.errors.ConfigurationError,
+    edgedb.errors.UnsupportedFeatureError,
+)
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+def get_query_timeout(kind):
+    timeouts = get_config_settings().get("timeouts", {})
+    return timeouts.get(kind, DEFAULT_TIMEOUTS[kind])
+
+
+def get_session_query(timeout):
+    return (
+        "CONFIGURE SESSION SET query_execution_timeout := "
+        f"<std::duration>'{timeout:g} seconds'"
+    )
+
+
+def needs_configuration(connection, timeout):
+    return _SERVER_TIMEOUTS and _SESSION_TIMEOUTS.get(connection) != timeout
+
+
+def disable_server_timeouts(exc):
+    global _SERVER_TIMEOUTS
+    logger.warning(
+        "the server doesn't support statement timeouts (%s), "
+        "only the client side deadlines are going to be enforced",
+        exc,
+    )
+    _SERVER_TIMEOUTS = False
+
+
+def configure_session(connection, timeout):
+    if not needs_configuration(connection, timeout):
+        return None
+
+    try:
+        connection.execute(get_session_query(timeout))
+    except UNSUPPORTED_ERRORS as exc:
+        disable_server_timeouts(exc)
+    else:
+        _SESSION_TIMEOUTS[connection] = timeout
+
+
+async def configure_session_async(connection, timeout):
+    if not needs_configuration(connection, timeout):
+        return None
+
+    try:
+        await connection.execute(get_session_query(timeout))
+    except UNSUPPORTED_ERRORS as exc:
+        disable_server_timeouts(exc)
+    else:
+        _SESSION_TIMEOUTS[connection] = timeout
+
+
+def timeout_error(timeout):
+    return QueryTimeout(f"Query has exceeded its time budget ({timeout:g}s)")
+
+
+@contextmanager
+def deadline(connection, timeout):
+    # Enforces the timeout on the statements that are executed on the
+    # given (blocking) connection within the block, both by the session's
+    # query_execution_timeout and by terminating the connection from a
+    # watchdog thread.
+    if timeout is None:
+        yield
+        return None
+
+    configure_session(connection, timeout)
+    expired = threading.Event()
+
+    def cancel():
+        expired.set()
+        logger.warning("cancelling a query that has exceeded %gs", timeout)
+        connection.terminate()
+
+    watchdog = threading.Timer(timeout + CANCEL_GRACE, cancel)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        yield
+    except edgedb.errors.QueryTimeoutError as exc:
+        raise timeout_error(timeout) from exc
+    except Exception as exc:
+        if expired.is_set():
+            raise timeout_error(timeout) from exc
+        raise
+    finally:
+        watchdog.cancel()
+
+
+class Cancellation:
+    # Cancels the statements that are still running on the tracked
+    # (blocking) connections, e.g. once their results are not needed
+    # anymore, by terminating the connections like deadline() does.
+
+    def __init__(self):
+        self.cancelled = False
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, connection):
+        with self._lock:
+            if self.cancelled:
+                raise QueryCancelled("The query was cancelled")
+            self._connections.add(connection)
+
+        try:
+            yield
+        except Exception as exc:
+            if self.cancelled:
+                raise QueryCancelled("The query was cancelled") from exc
+            raise
+        finally:
+            with self._lock:
+                self._connections.discard(connection)
+
+    def cancel(self):
+        # The connections are terminated under the lock, so that none of
+        # them can be released to its pool (and reused) in the meantime.
+        with self._lock:
+            self.cancelled = True
+            for connection in self._connections:
+                connection.terminate()
+
+
+async def query_with_deadline(pool, method, query, timeout, **kwargs):
+    # Same as deadline(), but for the asyncio shard pools (see
+    # reiz.db.pool.AsyncShardPool) where the cancellation is done by the
+    # event loop.
+    if timeout is None:
+        return await getattr(pool, method)(query, **kwargs)
+
+    async def run(connection):
+        await configure_session_async(connection, timeout)
+        try:
+            return await asyncio.wait_for(
+                getattr(connection, method)(query, **kwargs),
+                timeout + CANCEL_GRACE,
+            )
+        except (asyncio.TimeoutError, edgedb.errors.QueryTimeoutError) as exc:
+            raise timeout_error(timeout) from exc
+
+    return await pool.run(run)
@@ -1,9 +1,9 @@
 from reiz.edgeql.base import *
 from reiz.edgeql.expr import *
-from reiz.edgeql.optimizer import optimize_edgeql
+from reiz.edgeql.optimizer import OptimizerState, optimize_edgeql
 from reiz.edgeql.stmt import *
 
 
-def as_edgeql(tree):
-    tree = optimize_edgeql(tree)
+def as_edgeql(tree, statistics=None):
+    tree = optimize_edgeql(tree, OptimizerState(statistics=statistics))
     return construct(tree, top_level=True)
@@ -1,40 +1,209 @@
-from abc import ABC, abstractmethod
-from dataclasses import dataclass
+import dataclasses
+import weakref
+from abc import ABCMeta, abstractmethod
+from operator import attrgetter
 
 from reiz.db.schema import protected_name
 
+# All hashable nodes are interned (hash-consed), so that structurally
+# equal trees share their instances (and their cached constructions).
+_INTERNED = weakref.WeakValueDictionary()
+
+
+class FrozenDict(dict):
+    __slots__ = ()
+
+    def __hash__(self):
+        return hash(tuple(self.items()))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} is immutable")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+def intern_key(value):
+    # 1, 1.0 and True are equal (and hash the same) but they are rendered
+    # differently, so the values are keyed together with their types.
+    if isinstance(value, tuple):
+        return (tuple, *map(intern_key, value))
+    elif isinstance(value, FrozenDict):
+        return (
+            FrozenDict,
+            *(
+                (intern_key(key), intern_key(item))
+                for key, item in value.items()
+            ),
+        )
+    else:
+        return (type(value), value)
+
+
+class EdgeQLMeta(ABCMeta):
+    def __call__(cls, *args, **kwargs):
+        node = super().__call__(*args, **kwargs)
+        key = (cls, *map(intern_key, node._values()))
+        try:
+            node_hash = hash(key)
+        except TypeError:
+            node_hash = None
+
+        object.__setattr__(node, "_hash", node_hash)
+        if node_hash is None:
+            return node
+        else:
+            return _INTERNED.setdefault(key, node)
+
+
+class EdgeQLObject(metaclass=EdgeQLMeta):
+    __slots__ = ("_hash", "_construction", "__weakref__")
+
+    _field_names = ()
+
+    def __post_init__(self):
+        for field_name in self._field_names:
+            value = getattr(self, field_name)
+            if isinstance(value, list):
+                object.__setattr__(self, field_name, tuple(value))
+            elif isinstance(value, dict) and type(value) is not FrozenDict:
+                object.__setattr__(self, field_name, FrozenDict(value))
+
+    def _values(self):
+        return ()
+
+    def __hash__(self):
+        if self._hash is None:
+            raise TypeError(f"unhashable node: {type(self).__name__!r}")
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        elif type(self) is not type(other):
+            return NotImplemented
+        elif self._hash is not None and other._hash is not None:
+            # Both of them are interned, and they are not the same
+            # instance so they can't be structurally equal.
+            return False
+        else:
+            return self._values() == other._values()
 
-class EdgeQLObject(ABC):
     @abstractmethod
-    def construct(self):
+    def render(self, builder):
         ...
 
+    def construct(self):
+        try:
+            return self._construction
+        except AttributeError:
+            builder = EdgeQLBuilder()
+            self.render(builder)
+            construction = builder.build()
+            object.__setattr__(self, "_construction", construction)
+            return construction
+
 
 class EdgeQLStatement(EdgeQLObject):
-    ...
+    __slots__ = ()
 
 
 class EdgeQLExpression(EdgeQLObject):
-    ...
+    __slots__ = ()
 
 
-@dataclass(unsafe_hash=True)
+def make_getter(field_names):
+    if len(field_names) == 0:
+        return lambda node: ()
+    elif len(field_names) == 1:
+        [field_name] = field_names
+        return lambda node: (getattr(node, field_name),)
+    else:
+        getter = attrgetter(*field_names)
+        return lambda node: getter(node)
+
+
+def edgeql_node(cls):
+    # Frozen dataclass with __slots__ (dataclass(slots=True)
+    # is only available on 3.10+)
+    cls = dataclasses.dataclass(frozen=True, eq=False)(cls)
+
+    inherited_slots = {
+        slot
+        for base in cls.__mro__[1:]
+        for slot in base.__dict__.get("__slots__", ())
+    }
+    field_names = tuple(field.name for field in dataclasses.fields(cls))
+
+    namespace = dict(cls.__dict__)
+    for field_name in field_names:
+        namespace.pop(field_name, None)
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    namespace["_field_names"] = field_names
+    namespace["_values"] = make_getter(field_names)
+    namespace["__slots__"] = tuple(
+        field_name
+        for field_name in field_names
+        if field_name not in inherited_slots
+    )
+
+    slotted_cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+    slotted_cls.__qualname__ = cls.__qualname__
+    return slotted_cls
+
+
+class EdgeQLBuilder:
+    def __init__(self):
+        self.parts = []
+
+    def write(self, *parts):
+        self.parts.extend(parts)
+
+    def node(self, value, top_level=False):
+        if isinstance(value, EdgeQLObject):
+            with_parens = isinstance(value, EdgeQLStatement) and not top_level
+            if with_parens:
+                self.write("(")
+
+            if construction := getattr(value, "_construction", None):
+                self.write(construction)
+            else:
+                value.render(self)
+
+            if with_parens:
+                self.write(")")
+        else:
+            self.write(str(value))
+
+    def protected(self, value):
+        if isinstance(value, str):
+            self.write(protected_name(value))
+        else:
+            self.node(value)
+
+    def sequence(self, values, separator=", "):
+        for index, value in enumerate(values):
+            if index > 0:
+                self.write(separator)
+            self.node(value)
+
+    def build(self):
+        return "".join(self.parts)
+
+
+@edgeql_node
 class EdgeQLPreparedQuery(EdgeQLObject):
     value: str
 
-    def construct(self):
-        return self.value
+    def render(self, builder):
+        builder.write(self.value)
 
 
 def construct(value, top_level=False):
-    if isinstance(value, EdgeQLObject):
-        result = value.construct()
-        if isinstance(value, EdgeQLStatement) and not top_level:
-            return with_parens(result)
-        else:
-            return result
-    else:
-        return str(value)
+    builder = EdgeQLBuilder()
+    builder.node(value, top_level=top_level)
+    return builder.build()
 
 
 def protected_construct(value):
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import dataclasses
+from dataclasses import dataclass
+from typing import Optional
+
+from reiz.db.statistics import Statistics
+from reiz.edgeql.base import EdgeQLObject
+from reiz.edgeql.optimizer import (
+    MIN_FILTERING,
+    estimate_cost,
+    estimate_selectivity,
+)
+from reiz.edgeql.stmt import EdgeQLFor, EdgeQLSelect, EdgeQLWithBlock
+
+# Assumed number of objects for the types that are missing from the
+# statistics; better to overestimate them than to let them through.
+UNKNOWN_ROWS = 1_000_000
+
+# Correlated subqueries are re-evaluated for every candidate of their
+# parent, so each level of nesting multiplies the work.
+NESTING_FACTOR = 2
+BINDING_COST = 2
+
+
+@dataclass
+class QueryCost:
+    # Expected number of root objects that are going to be scanned
+    rows: float
+    # Relative cost of evaluating the filters on a single row (see the
+    # reiz.edgeql.optimizer.estimate_cost)
+    per_row: float
+    depth: int
+    bindings: int
+    full_scan: bool
+
+    @property
+    def total(self) -> float:
+        return self.rows * self.per_row * NESTING_FACTOR**self.depth
+
+
+def iter_children(node):
+    # Operators are plain enums, which don't have any children.
+    if isinstance(node, EdgeQLObject) and dataclasses.is_dataclass(node):
+        values = node._values()
+    elif isinstance(node, (tuple, list)):
+        values = node
+    elif isinstance(node, dict):
+        values = node.values()
+    else:
+        return
+
+    for value in values:
+        if isinstance(value, (EdgeQLObject, tuple, list, dict)):
+            yield value
+
+
+def measure_nesting(node, depth=0):
+    # Returns the deepest level of subqueries and the total number of
+    # WITH bindings under the given node.
+    max_depth, bindings = depth, 0
+    if isinstance(node, EdgeQLWithBlock):
+        bindings += len(node.assignments)
+
+    for child in iter_children(node):
+        child_depth = depth
+        if isinstance(child, (EdgeQLSelect, EdgeQLFor)):
+            child_depth += 1
+        child_max_depth, child_bindings = measure_nesting(child, child_depth)
+        max_depth = max(max_depth, child_max_depth)
+        bindings += child_bindings
+    return max_depth, bindings
+
+
+def estimate_query_cost(
+    tree: EdgeQLSelect, statistics: Statistics, limit: Optional[int] = None
+) -> QueryCost:
+    # Estimates the work of the compiled selection (before the limit /
+    # count is applied). A limited query stops scanning as soon as it
+    # has found enough matches, so the cheaper the filters are to
+    # satisfy, the less rows it needs to look at; a count always has to
+    # scan the whole type.
+    total_rows = UNKNOWN_ROWS
+    if isinstance(tree.name, str):
+        total_rows = statistics.count(tree.name) or UNKNOWN_ROWS
+
+    rows = total_rows
+    if limit is not None:
+        selectivity = estimate_selectivity(tree.filters, tree.name, statistics)
+        rows = min(total_rows, limit / max(selectivity, MIN_FILTERING))
+
+    depth, bindings = measure_nesting(tree)
+    per_row = 1 + estimate_cost(tree.filters) + bindings * BINDING_COST
+    if tree.with_block is not None:
+        per_row += estimate_cost(tree.with_block)
+
+    return QueryCost(
+        rows=rows,
+        per_row=per_row,
+        depth=depth,
+        bindings=bindings,
+        full_scan=tree.filters is None and limit is None,
+    )
@@ -1,14 +1,8 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
 from enum import auto
 
-from reiz.edgeql.base import (
-    EdgeQLExpression,
-    construct,
-    construct_sequence,
-    with_parens,
-)
+from reiz.edgeql.base import EdgeQLExpression, edgeql_node
 from reiz.utilities import ReizEnum
 
 
@@ -19,6 +13,9 @@ class EdgeQLVerifyOperator(ReizEnum):
     def construct(self):
         return self.name
 
+    def render(self, builder):
+        builder.write(self.name)
+
 
 @EdgeQLExpression.register
 class EdgeQLLogicOperator(ReizEnum):
@@ -28,6 +25,9 @@ class EdgeQLLogicOperator(ReizEnum):
     def construct(self):
         return self.name
 
+    def render(self, builder):
+        builder.write(self.name)
+
 
 @EdgeQLExpression.register
 class EdgeQLComparisonOperator(ReizEnum):
@@ -37,10 +37,15 @@ class EdgeQLComparisonOperator(ReizEnum):
     NOT_EQUALS = "!="
     NOT_CONTAINS = "NOT IN"
     NOT_IDENTICAL = "IS NOT"
+    GREATER = ">"
+    LIKE = "LIKE"
 
     def construct(self):
         return self.value
 
+    def render(self, builder):
+        builder.write(self.value)
+
     def negate(self):
         if self.name.startswith("NOT_"):
             return getattr(self, self.name[4:])
@@ -48,98 +53,126 @@ class EdgeQLComparisonOperator(ReizEnum):
             return getattr(self, f"NOT_{self.name}")
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLContainer(EdgeQLExpression):
+    items: Tuple[EdgeQLObject, ...]
 
-    items: List[EdgeQLObject]
-
-    def construct(self):
-        body = ", ".join(construct_sequence(self.items))
-        return with_parens(body, combo=self.PARENS)
+    def render(self, builder):
+        left, right = self.PARENS
+        builder.write(left)
+        builder.sequence(self.items)
+        builder.write(right)
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLTuple(EdgeQLContainer):
     PARENS = "()"
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLArray(EdgeQLContainer):
     PARENS = "[]"
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLSet(EdgeQLContainer):
     PARENS = "{}"
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
+class EdgeQLTypeUnion(EdgeQLExpression):
+    types: Tuple[str, ...]
+
+    def render(self, builder):
+        builder.write("(")
+        builder.sequence(self.types, separator=" | ")
+        builder.write(")")
+
+
+@edgeql_node
 class EdgeQLName(EdgeQLExpression):
     name: str
 
-    def construct(self):
-        return self.name
+    def render(self, builder):
+        builder.write(self.name)
 
 
 class EdgeQLSpecialName(EdgeQLName):
-    def construct(self):
-        return self.PREFIX + self.name
+    __slots__ = ()
 
+    def render(self, builder):
+        builder.write(self.PREFIX, self.name)
 
-@dataclass(unsafe_hash=True)
+
+@edgeql_node
 class EdgeQLVariable(EdgeQLSpecialName):
     PREFIX = "$"
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLFilterKey(EdgeQLSpecialName):
     PREFIX = "."
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLProperty(EdgeQLSpecialName):
     PREFIX = "@"
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLAttribute(EdgeQLExpression):
     base: EdgeQLObject
     attr: str
 
-    def construct(self):
-        return construct(self.base) + "." + self.attr
+    def render(self, builder):
+        builder.node(self.base)
+        builder.write(".", self.attr)
+
+
+@edgeql_node
+class EdgeQLBacklink(EdgeQLExpression):
+    base: EdgeQLObject
+    attr: str
+    source: str
 
+    def render(self, builder):
+        builder.node(self.base)
+        builder.write(".<", self.attr, "[IS ", self.source, "]")
 
-@dataclass(unsafe_hash=True)
+
+@edgeql_node
 class EdgeQLCall(EdgeQLExpression):
     func: str
-    args: List[EdgeQLObject]
+    args: Tuple[EdgeQLObject, ...]
 
-    def construct(self):
-        body = ", ".join(construct_sequence(self.args))
-        return self.func + with_parens(body)
+    def render(self, builder):
+        builder.write(self.func, "(")
+        builder.sequence(self.args)
+        builder.write(")")
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLCast(EdgeQLExpression):
     type: str
     value: EdgeQLObject
 
-    def construct(self):
-        return f"<{self.type}>{construct(self.value)}"
+    def render(self, builder):
+        builder.write("<", self.type, ">")
+        builder.node(self.value)
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLReference(EdgeQLExpression):
     value: Any
 
-    def construct(self):
-        return construct(EdgeQLCast("uuid", repr(str(self.value.id))))
+    def render(self, builder):
+        builder.node(EdgeQLCast("uuid", repr(str(self.value.id))))
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLNot(EdgeQLExpression):
     value: EdgeQLObject
 
-    def construct(self):
-        return "not " + construct(self.value)
+    def render(self, builder):
+        builder.write("not ")
+        builder.node(self.value)
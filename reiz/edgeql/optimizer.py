@@ -1,46 +1,64 @@
+import ast
 import dataclasses
 import functools
-from dataclasses import dataclass
-from typing import List
+import math
+from dataclasses import dataclass, field
+from typing import List, Optional
 
+from reiz.db.statistics import Statistics, get_statistics
 from reiz.edgeql.base import *
 from reiz.edgeql.expr import *
 from reiz.edgeql.stmt import *
 
+DEFAULT_SELECTIVITY = 0.25
+EQUALITY_SELECTIVITY = 0.05
+MIN_FILTERING = 1e-6
+
+CALL_COST = 5
+SUBQUERY_COST = 10
+
+# Drive the root scan from a subquery only if it is expected to
+# produce an order of magnitude less rows than the root itself.
+ROOT_SCAN_THRESHOLD = 0.1
+
 
 @dataclass(unsafe_hash=True)
 class OptimizerState:
     context: List[EdgeQLObject] = field(default_factory=list)
+    statistics: Optional[Statistics] = None
 
 
 def visit(node, state):
     if isinstance(node, EdgeQLObject):
-        node = generic_visit(node, state)
         return optimize_edgeql(node, state)
     else:
         return node
 
 
 def generic_visit(node, state):
+    # Operators are plain enums, which don't have any children.
+    if not dataclasses.is_dataclass(node):
+        return node
+
     if state:
         state.context.append(node)
     else:
         state = OptimizerState([node])
 
     replacements = {}
-    for field, value in vars(node).items():
+    for field_name in node._field_names:
+        value = getattr(node, field_name)
         if isinstance(value, EdgeQLObject):
             if value is (replacement := visit(value, state)):
                 continue
-        elif isinstance(value, list):
-            if value == (
-                replacement := [visit(item, state) for item in value]
-            ):
+        elif isinstance(value, tuple):
+            replacement = tuple(visit(item, state) for item in value)
+            if all(old is new for old, new in zip(value, replacement)):
                 continue
         else:
             continue
 
-        replacements[field] = replacement
+        replacements[field_name] = replacement
     state.context.pop()
 
     if replacements:
@@ -55,7 +73,8 @@ def optimize_edgeql(node, state=None):
 
 
 @optimize_edgeql.register(EdgeQLFilter)
-def optimize_filter(node, state):
+def optimize_filter(node, state=None):
+    node = generic_visit(node, state)
     op = node.operator
 
     if isinstance(node.value, EdgeQLNot):
@@ -80,7 +99,7 @@ def optimize_filter(node, state):
             return EdgeQLFilterChain(
                 dataclasses.replace(node, value=EdgeQLSet(positives)),
                 dataclasses.replace(
-                    node, value=EdgeQLSet(negatives), op=op.negate()
+                    node, value=EdgeQLSet(negatives), operator=op.negate()
                 ),
             )
         elif negatives:
@@ -91,6 +110,334 @@ def optimize_filter(node, state):
     return node
 
 
+ATOMIC_VALUES = (EdgeQLPreparedQuery, EdgeQLCast)
+POINTER_KEYS = (EdgeQLFilterKey, EdgeQLAttribute)
+
+
+def as_alternative(node):
+    # Returns a (operator, pointer, values) triple if the given
+    # filter can be folded into a set membership / type check
+    # with its siblings, or None if it should stay as is.
+    if not (
+        isinstance(node, EdgeQLFilter) and isinstance(node.key, POINTER_KEYS)
+    ):
+        return None
+
+    operator, value = node.operator, node.value
+    if operator is EdgeQLComparisonOperator.EQUALS:
+        if isinstance(value, ATOMIC_VALUES):
+            return EdgeQLComparisonOperator.CONTAINS, node.key, [value]
+        elif isinstance(value, EdgeQLSelect) and value.is_bare():
+            model = protected_name(value.name, prefix=True)
+            return EdgeQLComparisonOperator.IDENTICAL, node.key, [model]
+    elif operator is EdgeQLComparisonOperator.CONTAINS:
+        if isinstance(value, EdgeQLSet) and all(
+            isinstance(item, ATOMIC_VALUES) for item in value.items
+        ):
+            return operator, node.key, value.items
+    elif operator is EdgeQLComparisonOperator.IDENTICAL:
+        if isinstance(value, str):
+            return operator, node.key, [value]
+        elif isinstance(value, EdgeQLTypeUnion):
+            return operator, node.key, value.types
+
+    return None
+
+
+def fold_alternatives(operator, key, values):
+    if len(values) == 1:
+        if operator is EdgeQLComparisonOperator.CONTAINS:
+            operator = EdgeQLComparisonOperator.EQUALS
+        return EdgeQLFilter(key, values[0], operator)
+    elif operator is EdgeQLComparisonOperator.CONTAINS:
+        return EdgeQLFilter(key, EdgeQLSet(values), operator)
+    else:
+        return EdgeQLFilter(key, EdgeQLTypeUnion(values), operator)
+
+
+def fold_chain(alternatives):
+    # Fold homogeneous alternatives on the same pointer;
+    #   .x = 'a' OR .x = 'b'                 => .x IN {'a', 'b'}
+    #   .x = (SELECT A) OR .x = (SELECT B)   => .x IS (A | B)
+    groups, leftovers = {}, []
+    for alternative in alternatives:
+        if (spec := as_alternative(alternative)) is None:
+            leftovers.append(alternative)
+            continue
+
+        operator, key, values = spec
+        groups.setdefault((operator, key), {}).update(dict.fromkeys(values))
+
+    if len(groups) + len(leftovers) == len(alternatives):
+        return alternatives
+
+    return (
+        *(
+            fold_alternatives(operator, key, list(values))
+            for (operator, key), values in groups.items()
+        ),
+        *leftovers,
+    )
+
+
+@optimize_edgeql.register(EdgeQLFilterChain)
+def optimize_filter_chain(node, state=None):
+    # Chains are flattened rather than visited recursively, since
+    # generated queries might contain hundreds of alternatives.
+    if state is None:
+        state = OptimizerState()
+
+    operands = tuple(unpack_chain(node, node.operator))
+    state.context.append(node)
+    replacements = tuple(visit(operand, state) for operand in operands)
+    state.context.pop()
+
+    if node.operator is EdgeQLLogicOperator.OR:
+        replacements = fold_chain(replacements)
+
+    if len(operands) == len(replacements) and all(
+        operand is replacement
+        for operand, replacement in zip(operands, replacements)
+    ):
+        return node
+
+    filters = None
+    for replacement in replacements:
+        filters = merge_filters(filters, replacement, node.operator)
+    return filters
+
+
+def infer_base_name(name):
+    if (node_type := getattr(ast, name, None)) is None:
+        return None
+    elif node_type.__base__ is ast.AST:
+        return name
+    else:
+        return node_type.__base__.__name__
+
+
+def estimate_rows(node, statistics):
+    if not isinstance(node.name, str):
+        return None
+    elif (count := statistics.count(node.name)) is None:
+        return None
+    else:
+        return count * estimate_selectivity(
+            node.filters, node.name, statistics
+        )
+
+
+def estimate_value_selectivity(model, pointer, values, statistics):
+    count = statistics.count(model)
+    field_stats = statistics.field_statistics(model, pointer)
+    if not count or field_stats is None:
+        return min(EQUALITY_SELECTIVITY * len(values), 1.0)
+
+    frequency = sum(
+        field_stats.frequency(construct(value)) for value in values
+    )
+    return min(frequency / count, 1.0)
+
+
+def estimate_subquery_selectivity(node, statistics):
+    rows = estimate_rows(node, statistics)
+    total = statistics.count(infer_base_name(node.name) or node.name)
+    if rows is None or not total:
+        return DEFAULT_SELECTIVITY
+    else:
+        return min(rows / total, 1.0)
+
+
+def estimate_filter_selectivity(node, model, statistics):
+    operator, value = node.operator, node.value
+    if operator.name.startswith("NOT_"):
+        return 1.0 - estimate_filter_selectivity(
+            dataclasses.replace(node, operator=operator.negate()),
+            model,
+            statistics,
+        )
+
+    if not isinstance(node.key, EdgeQLFilterKey):
+        return DEFAULT_SELECTIVITY
+
+    if operator is EdgeQLComparisonOperator.EQUALS:
+        if isinstance(value, ATOMIC_VALUES):
+            return estimate_value_selectivity(
+                model, node.key.name, [value], statistics
+            )
+        elif isinstance(value, EdgeQLSelect):
+            return estimate_subquery_selectivity(value, statistics)
+    elif operator is EdgeQLComparisonOperator.CONTAINS:
+        if isinstance(value, EdgeQLSet):
+            return estimate_value_selectivity(
+                model, node.key.name, value.items, statistics
+            )
+
+    return DEFAULT_SELECTIVITY
+
+
+def estimate_selectivity(node, model, statistics):
+    if node is None:
+        return 1.0
+    elif isinstance(node, EdgeQLFilterChain):
+        left = estimate_selectivity(node.left, model, statistics)
+        right = estimate_selectivity(node.right, model, statistics)
+        if node.operator is EdgeQLLogicOperator.AND:
+            return left * right
+        else:
+            return left + right - left * right
+    elif isinstance(node, EdgeQLFilter):
+        return estimate_filter_selectivity(node, model, statistics)
+    else:
+        return DEFAULT_SELECTIVITY
+
+
+def estimate_cost(node):
+    # A relative per-row evaluation cost, where a simple
+    # property comparison costs 1.
+    if isinstance(node, EdgeQLSelect):
+        cost = SUBQUERY_COST + estimate_cost(node.filters)
+        if not isinstance(node.name, str):
+            cost += estimate_cost(node.name)
+        if node.with_block is not None:
+            cost += estimate_cost(node.with_block)
+        return cost
+    elif isinstance(node, EdgeQLFor):
+        return SUBQUERY_COST + estimate_cost(node.generator)
+    elif isinstance(node, (EdgeQLFilterChain, EdgeQLFilter)):
+        return 1 + sum(map(estimate_cost, node._values()))
+    elif isinstance(node, EdgeQLCall):
+        return CALL_COST + sum(map(estimate_cost, node.args))
+    elif isinstance(node, EdgeQLVerify):
+        return estimate_cost(node.query)
+    elif isinstance(node, (EdgeQLAttribute, EdgeQLBacklink)):
+        return estimate_cost(node.base)
+    elif isinstance(node, EdgeQLSet):
+        return sum(map(estimate_cost, node.items))
+    elif isinstance(node, EdgeQLWithBlock):
+        return sum(map(estimate_cost, node.assignments.values()))
+    else:
+        return 0
+
+
+def rank_conjunct(node, model, statistics):
+    # Cheap and selective filters first; see the classic
+    # predicate ordering rank of (selectivity - 1) / cost.
+    selectivity = estimate_selectivity(node, model, statistics)
+    return estimate_cost(node) / max(1.0 - selectivity, MIN_FILTERING)
+
+
+def as_driving_subquery(node):
+    if not (
+        isinstance(node, EdgeQLFilter)
+        and isinstance(node.key, EdgeQLFilterKey)
+        and node.operator is EdgeQLComparisonOperator.EQUALS
+    ):
+        return None
+
+    value = node.value
+    if isinstance(value, EdgeQLSet) and len(value.items) == 1:
+        [value] = value.items
+
+    if (
+        isinstance(value, EdgeQLSelect)
+        and isinstance(value.name, str)
+        and value.filters is not None
+        and value.with_block is None
+        and value.limit is None
+        and value.offset is None
+        and not value.selections
+    ):
+        return value
+    else:
+        return None
+
+
+def choose_root_scan(node, conjuncts, statistics):
+    # If one of the conjuncts is a subquery that is much more selective
+    # than the rest of the filters, start from that subquery and reach
+    # the root objects through a backlink;
+    #   SELECT A FILTER .x = (SELECT B FILTER ...) AND ...
+    #   => SELECT A FILTER .id IN (SELECT B FILTER ...).<x[IS A].id AND ...
+    if (count := statistics.count(node.name)) is None:
+        return None, conjuncts
+
+    candidates = []
+    for index, conjunct in enumerate(conjuncts):
+        if (subquery := as_driving_subquery(conjunct)) is None:
+            continue
+        if (rows := estimate_rows(subquery, statistics)) is None:
+            continue
+
+        root_rows = count * math.prod(
+            estimate_selectivity(other, node.name, statistics)
+            for other in conjuncts
+            if other is not conjunct
+        )
+        if rows < root_rows * ROOT_SCAN_THRESHOLD:
+            candidates.append((rows, index, subquery))
+
+    if not candidates:
+        return None, conjuncts
+
+    _, index, subquery = min(candidates, key=lambda candidate: candidate[0])
+    backlink = EdgeQLBacklink(
+        subquery,
+        conjuncts[index].key.name,
+        protected_name(node.name, prefix=True),
+    )
+    driver = EdgeQLFilter(
+        EdgeQLFilterKey("id"),
+        EdgeQLAttribute(backlink, "id"),
+        EdgeQLComparisonOperator.CONTAINS,
+    )
+    return driver, conjuncts[:index] + conjuncts[index + 1 :]
+
+
+def is_scan_root(state):
+    return not any(
+        isinstance(
+            parent,
+            (EdgeQLFilter, EdgeQLFilterChain, EdgeQLVerify, EdgeQLWithBlock),
+        )
+        for parent in state.context
+    )
+
+
+@optimize_edgeql.register(EdgeQLSelect)
+def optimize_select_filters(node, state=None):
+    if state is None:
+        state = OptimizerState()
+    node = generic_visit(node, state)
+
+    if node.filters is None or not isinstance(node.name, str):
+        return node
+
+    if (statistics := state.statistics) is None:
+        statistics = get_statistics()
+
+    driver, conjuncts = None, list(
+        unpack_chain(node.filters, EdgeQLLogicOperator.AND)
+    )
+    if statistics and is_scan_root(state):
+        driver, conjuncts = choose_root_scan(node, conjuncts, statistics)
+
+    conjuncts.sort(
+        key=functools.partial(
+            rank_conjunct, model=node.name, statistics=statistics
+        )
+    )
+
+    filters = driver
+    for conjunct in conjuncts:
+        filters = merge_filters(filters, conjunct)
+
+    if filters == node.filters:
+        return node
+    else:
+        return dataclasses.replace(node, filters=filters)
+
+
 # @optimize_edgeql.register(EdgeQLSelect)
 def optimize_select(node, state=None):
     node = generic_visit(node, state)
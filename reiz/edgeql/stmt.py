@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, field
+from dataclasses import field
 from typing import Union
 
 from reiz.db.schema import protected_name
@@ -8,10 +8,8 @@ from reiz.edgeql.base import (
     EdgeQLExpression,
     EdgeQLObject,
     EdgeQLStatement,
-    construct,
-    construct_sequence,
-    protected_construct,
-    with_parens,
+    FrozenDict,
+    edgeql_node,
 )
 from reiz.edgeql.expr import (
     EdgeQLComparisonOperator,
@@ -22,35 +20,44 @@ from reiz.edgeql.expr import (
 
 
 class EdgeQLComponent(EdgeQLObject):
-    ...
+    __slots__ = ()
 
 
 EdgeQLFilterT = Union["EdgeQLFilter", "EdgeQLFilterChain"]
 
 
-@dataclass(unsafe_hash=True)
+def render_assignments(builder, assignments, protected=False):
+    for index, (key, value) in enumerate(assignments.items()):
+        if index > 0:
+            builder.write(", ")
+        if protected:
+            key = protected_name(key, prefix=False)
+        builder.write(key, " := ")
+        builder.node(value)
+
+
+@edgeql_node
 class EdgeQLSelector(EdgeQLComponent):
     selector: str
-    inner_selections: List[EdgeQLSelector] = field(default_factory=list)
+    inner_selections: Tuple[EdgeQLSelector, ...] = ()
 
-    def construct(self):
-        selector = self.selector
+    def render(self, builder):
+        builder.write(self.selector)
         if self.inner_selections:
-            selector += ": "
-            selector += with_parens(
-                ", ".join(construct_sequence(self.inner_selections)),
-                combo="{}",
-            )
-        return selector
+            builder.write(": {")
+            builder.sequence(self.inner_selections)
+            builder.write("}")
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLUnion(EdgeQLComponent):
     left: EdgeQLObject
     right: EdgeQLObject
 
-    def construct(self):
-        return construct(self.left) + " UNION " + construct(self.right)
+    def render(self, builder):
+        builder.node(self.left)
+        builder.write(" UNION ")
+        builder.node(self.right)
 
     @classmethod
     def from_seq(cls, items):
@@ -63,30 +70,46 @@ class EdgeQLUnion(EdgeQLComponent):
         return union
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLFilter(EdgeQLComponent):
     key: EdgeQLExpression
     value: EdgeQLObject
     operator: EdgeQLComparisonOperator = EdgeQLComparisonOperator.EQUALS
 
-    def construct(self):
-        key = construct(self.key)
-        value = construct(self.value)
-        operator = construct(self.operator)
-        return key + " " + operator + " " + value
+    def render(self, builder):
+        builder.node(self.key)
+        builder.write(" ")
+        builder.node(self.operator)
+        builder.write(" ")
+        builder.node(self.value)
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLFilterChain(EdgeQLComponent):
     left: EdgeQLFilterT
     right: EdgeQLFilterT
     operator: EdgeQLLogicOperator = EdgeQLLogicOperator.AND
 
-    def construct(self):
-        left = construct(self.left)
-        right = construct(self.right)
-        operator = construct(self.operator)
-        return left + " " + operator + " " + right
+    def render(self, builder):
+        for index, operand in enumerate(unpack_chain(self, self.operator)):
+            if index > 0:
+                builder.write(" ")
+                builder.node(self.operator)
+                builder.write(" ")
+            self.render_operand(builder, operand)
+
+    def render_operand(self, builder, operand):
+        # AND binds tighter than OR, so mixed chains need
+        # explicit grouping to keep their original meaning.
+        if (
+            isinstance(operand, EdgeQLFilterChain)
+            and operand.operator is not self.operator
+        ):
+            builder.write("(")
+            builder.node(operand)
+            builder.write(")")
+        else:
+            builder.node(operand)
 
 
 EdgeQLFilterType = (EdgeQLFilter, EdgeQLFilterChain)
@@ -115,6 +138,19 @@ def unpack_filters(filters, operator=None):
         yield from unpack_filters(filters.right, filters.operator)
 
 
+def unpack_chain(filters, operator):
+    # Iterative, since generated queries might have very
+    # long chains of the same operator.
+    stack = [filters]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, EdgeQLFilterChain) and node.operator is operator:
+            stack.append(node.right)
+            stack.append(node.left)
+        else:
+            yield node
+
+
 def merge_filters(left_filter, right_filter, operator=None):
     if left_filter is None:
         return right_filter
@@ -123,60 +159,53 @@ def merge_filters(left_filter, right_filter, operator=None):
         return EdgeQLFilterChain(left_filter, right_filter, operator)
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLVerify(EdgeQLComponent):
     query: EdgeQLObject
     operator: EdgeQLVerifyOperator
     argument: EdgeQLObject
 
-    def construct(self):
-        query = construct(self.query)
-        check = construct(self.operator) + " " + construct(self.argument)
-        return query + with_parens(check, combo="[]")
+    def render(self, builder):
+        builder.node(self.query)
+        builder.write("[")
+        builder.node(self.operator)
+        builder.write(" ")
+        builder.node(self.argument)
+        builder.write("]")
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLWithBlock(EdgeQLStatement):
-    assignments: Dict[str, EdgeQLObject] = field(default_factory=dict)
+    assignments: Dict[str, EdgeQLObject] = field(default_factory=FrozenDict)
 
-    def construct(self):
-        query = "WITH"
+    def render(self, builder):
         if not self.assignments:
             raise ValueError("Empty WITH blocks are not allowed!")
-        query += " " + ", ".join(
-            f"{assignment} := {construct(value)}"
-            for assignment, value in self.assignments.items()
-        )
-        return query
+        builder.write("WITH ")
+        render_assignments(builder, self.assignments)
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLInsert(EdgeQLStatement):
     name: str
-    fields: Dict[str, EdgeQLObject] = field(default_factory=dict)
+    fields: Dict[str, EdgeQLObject] = field(default_factory=FrozenDict)
 
-    def construct(self):
-        query = "INSERT"
-        query += " " + protected_name(self.name)
+    def render(self, builder):
+        builder.write("INSERT ", protected_name(self.name))
         if self.fields:
-            query += " " + with_parens(
-                ", ".join(
-                    f"{protected_name(key, prefix=False)} := {construct(value)}"
-                    for key, value in self.fields.items()
-                ),
-                combo="{}",
-            )
-        return query
+            builder.write(" {")
+            render_assignments(builder, self.fields, protected=True)
+            builder.write("}")
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLSelect(EdgeQLStatement):
     name: EdgeQLObject = None
     limit: Optional[int] = None
     offset: Optional[int] = None
     ordered: Optional[EdgeQLObject] = None
     filters: Optional[EdgeQLFilterT] = None
-    selections: Sequence[EdgeQLSelector] = field(default_factory=list)
+    selections: Tuple[EdgeQLSelector, ...] = ()
     with_block: Optional[EdgeQLWithBlock] = None
 
     def is_bare(self):
@@ -184,76 +213,69 @@ class EdgeQLSelect(EdgeQLStatement):
             self.name, str
         )
 
-    def construct(self):
+    def render(self, builder):
         if self.with_block:
-            query = construct(self.with_block, top_level=True) + " SELECT"
-        else:
-            query = "SELECT"
+            builder.node(self.with_block, top_level=True)
+            builder.write(" ")
 
-        query += " " + protected_construct(self.name)
+        builder.write("SELECT ")
+        builder.protected(self.name)
         if self.selections:
-            query += with_parens(
-                ", ".join(construct_sequence(self.selections)), combo="{}"
-            )
+            builder.write("{")
+            builder.sequence(self.selections)
+            builder.write("}")
         if self.filters is not None:
-            query += f" FILTER {construct(self.filters)}"
+            builder.write(" FILTER ")
+            builder.node(self.filters)
         if self.ordered is not None:
-            query += f" ORDER BY {construct(self.ordered)}"
+            builder.write(" ORDER BY ")
+            builder.node(self.ordered)
         if self.offset is not None:
-            query += f" OFFSET {self.offset}"
+            builder.write(" OFFSET ", str(self.offset))
         if self.limit is not None:
-            query += f" LIMIT {self.limit}"
-        return query
+            builder.write(" LIMIT ", str(self.limit))
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLUpdate(EdgeQLStatement):
     name: str
     filters: Optional[EdgeQLFilterT] = None
-    assigns: Dict[str, EdgeQLObject] = field(default_factory=dict)
+    assigns: Dict[str, EdgeQLObject] = field(default_factory=FrozenDict)
 
-    def construct(self):
-        query = "UPDATE"
-        query += " " + protected_name(self.name)
+    def render(self, builder):
+        builder.write("UPDATE ", protected_name(self.name))
         if self.filters is not None:
-            query += f" FILTER {construct(self.filters)}"
-        query += " SET"
-        query += " " + with_parens(
-            ", ".join(
-                f"{protected_name(key, prefix=False)} := {construct(value)}"
-                for key, value in self.assigns.items()
-            ),
-            combo="{}",
-        )
-        return query
+            builder.write(" FILTER ")
+            builder.node(self.filters)
+        builder.write(" SET {")
+        render_assignments(builder, self.assigns, protected=True)
+        builder.write("}")
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLFor(EdgeQLStatement):
     target: EdgeQLObject
     iterator: EdgeQLObject
     generator: EdgeQLObject
 
-    def construct(self):
-        query = "FOR "
-        query += construct(self.target)
-        query += " in "
-        query += construct(self.iterator)
-        query += " UNION "
-        query += construct(self.generator)
-        return query
+    def render(self, builder):
+        builder.write("FOR ")
+        builder.node(self.target)
+        builder.write(" in ")
+        builder.node(self.iterator)
+        builder.write(" UNION ")
+        builder.node(self.generator)
 
 
-@dataclass(unsafe_hash=True)
+@edgeql_node
 class EdgeQLReizCustomList(EdgeQLStatement):
     items: EdgeQLSet
 
     # FIX-ME(low): Maybe refactor this to it's own components
-    def construct(self):
-        query = "WITH"
-        query += " __items := "
-        query += construct(self.items)
-        query += ", "
-        query += "FOR __item IN {enumerate(__items)} "
-        query += "UNION (SELECT __item.1 { @index := __item.0 })"
-        return query
+    def render(self, builder):
+        builder.write("WITH __items := ")
+        builder.node(self.items)
+        builder.write(
+            ", FOR __item IN {enumerate(__items)} "
+            "UNION (SELECT __item.1 { @index := __item.0 })"
+        )
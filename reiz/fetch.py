@@ -1,30 +1,127 @@
-import ast
-import tokenize
-from functools import lru_cache
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, replace
+from functools import lru_cache, partial
+from operator import attrgetter
+from statistics import fmean, variance
+from typing import Optional
+from uuid import UUID
 
-from reiz.db.connection import connect
+from reiz.counters import TOTAL, get_node_counters
+from reiz.db.connection import get_shard_index
+from reiz.db.pool import get_shards, run_read
 from reiz.db.schema import protected_name
+from reiz.db.statistics import Statistics, get_statistics
+from reiz.db.timeouts import (
+    Cancellation,
+    deadline,
+    get_query_timeout,
+    timeout_error,
+)
 from reiz.edgeql import (
+    EdgeQLAttribute,
     EdgeQLCall,
+    EdgeQLCast,
+    EdgeQLComparisonOperator,
+    EdgeQLFilter,
+    EdgeQLFilterKey,
+    EdgeQLFor,
+    EdgeQLName,
     EdgeQLSelect,
     EdgeQLSelector,
+    EdgeQLSet,
     EdgeQLUnion,
+    EdgeQLVariable,
+    OptimizerState,
     as_edgeql,
+    construct,
+    merge_filters,
+    optimize_edgeql,
 )
-from reiz.reizql import compile_edgeql, parse_query
-from reiz.utilities import get_db_settings, logger
+from reiz.edgeql.cost import estimate_query_cost
+from reiz.materialized import get_materialization_key, get_materialized_queries
+from reiz.reizql import ReizQLMatch, compile_edgeql, parse_query
+from reiz.sources import SOURCE_CACHE, fetch_segments, get_source_store
+from reiz.utilities import get_config_settings, logger, timed
 
 DEFAULT_LIMIT = 10
+STREAM_BATCH_SIZE = 100
 DEFAULT_NODES = ("Module", "AST", "stmt", "expr")
 
+# Approximate counts are computed over a random sample of the modules,
+# which is refreshed periodically to include the newly inserted ones.
+DEFAULT_SAMPLE_FRACTION = 0.01
+MIN_SAMPLE_SIZE = 100
+SAMPLE_TTL = 60 * 60
+# z-score of the 95% confidence interval
+CONFIDENCE_Z = 1.96
+
+# Samples of the sampled queries (Scope.sample) are kept per seed, the
+# oldest ones are evicted once there are too many of them.
+MAX_MODULE_SAMPLES = 256
+_MODULE_SAMPLES = {}
+
+# Progressive queries are evaluated on a few projects at a time, see
+# fetch_partitions().
+DEFAULT_PROGRESSIVE_WORKERS = 4
+PROJECTS_TTL = 60
+_PROJECTS = []
+
+# The counters only change with ingestions, so the cost estimates can
+# work with a slightly stale copy of them.
+COST_STATISTICS_TTL = 60
+_COST_STATISTICS = []
+
+# Compiled EdgeQL of the recently prepared queries; the oldest ones are
+# evicted once the cache is full. The filter order and the root scan
+# depend on the corpus statistics (see reiz.edgeql.optimizer), so the
+# cache starts over whenever they are reloaded.
+MAX_PREPARED_QUERIES = 1024
+_PREPARED_QUERIES = {}
+_PREPARED_STATISTICS = []
+_PREPARED_QUERIES_LOCK = threading.Lock()
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class PreparedQuery:
+    tree: ReizQLMatch
+    # The compiled selection before it is scoped, limited or optimized;
+    # the cost estimates are based on it (see reiz.edgeql.cost).
+    selection: EdgeQLSelect
+    query: str
+
+
+@dataclass
+class CountEstimate:
+    count: int
+    # Half-width of the 95% confidence interval
+    error: int
+    exact: bool = False
+
 
-class LocationNode(ast.AST):
-    _attributes = ("lineno", "col_offset", "end_lineno", "end_col_offset")
+@dataclass(frozen=True)
+class Scope:
+    # Restricts a query to the modules of a project and/or to the files
+    # whose names match a glob (e.g. "*/tests/*", or "prefix/*").
+    project: Optional[str] = None
+    filename: Optional[str] = None
+    # Only scans a random sample (this fraction) of the modules; the ones
+    # with the same seed are taken from the same modules.
+    sample: Optional[float] = None
+    seed: Optional[int] = None
 
 
-@lru_cache(8)
-def get_stats(nodes=DEFAULT_NODES):
-    query = as_edgeql(
+def get_stats_query(nodes):
+    return as_edgeql(
         EdgeQLSelect(
             EdgeQLUnion.from_seq(
                 EdgeQLCall("count", [protected_name(node, prefix=True)])
@@ -33,81 +130,822 @@ def get_stats(nodes=DEFAULT_NODES):
         ),
     )
 
-    with connect(**get_db_settings()) as conn:
-        stats = tuple(conn.query(query))
 
+def count_nodes(connection, nodes):
+    stats = tuple(connection.query(get_stats_query(nodes)))
     return dict(zip(nodes, stats))
 
 
+def scatter(func, shards):
+    # Calls func(shard) on each of the shards concurrently, and returns
+    # their results in the same order.
+    if len(shards) == 1:
+        return [func(shards[0])]
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        return list(executor.map(func, shards))
+
+
+@lru_cache(1)
+def scan_stats():
+    # Fallback for the databases that were inserted without counters. It
+    # scans the whole corpus, so the result is kept for the process.
+    def count_shard(shard):
+        return run_read(partial(count_nodes, nodes=DEFAULT_NODES), shard)
+
+    counts = scatter(count_shard, get_shards())
+    return {
+        node: sum(shard_counts[node] for shard_counts in counts)
+        for node in DEFAULT_NODES
+    }
+
+
+def uses_stats_fallback(counters, nodes, project):
+    return nodes == DEFAULT_NODES and project == TOTAL and counters.is_empty()
+
+
+def get_stats(nodes=DEFAULT_NODES, project=TOTAL):
+    # The counters are maintained by the inserter, see reiz.counters
+    counters = get_node_counters()
+    if uses_stats_fallback(counters, nodes, project):
+        return scan_stats()
+    else:
+        return counters.get(nodes, project)
+
+
+def get_cached_cost_statistics():
+    if _COST_STATISTICS and _COST_STATISTICS[0] > time.time():
+        return _COST_STATISTICS[1]
+    else:
+        return None
+
+
+def cache_cost_statistics(counts):
+    # The analyzed statistics (see reiz.db.statistics) also know about
+    # the value distributions, but they are only refreshed manually while
+    # the counters are always up to date with the ingestion.
+    statistics = get_statistics()
+    statistics = Statistics(
+        counts={**statistics.counts, **counts}, fields=statistics.fields
+    )
+    _COST_STATISTICS[:] = [time.time() + COST_STATISTICS_TTL, statistics]
+    return statistics
+
+
+def get_cost_statistics():
+    if (statistics := get_cached_cost_statistics()) is not None:
+        return statistics
+    else:
+        return cache_cost_statistics(get_node_counters().get_all())
+
+
+def estimate_query(
+    reiz_ql,
+    stats=False,
+    limit=DEFAULT_LIMIT,
+    cursor=None,
+    scope=None,
+    progressive=False,
+    statistics=None,
+):
+    # Prepared the same way as run_query() does, so that the query that
+    # gets admitted is compiled only once.
+    prepared = prepare_query(
+        reiz_ql,
+        stats,
+        limit,
+        cursor,
+        scope=scope,
+        partitioned=is_partitioned(stats, cursor, scope, progressive),
+    )
+    if statistics is None:
+        statistics = get_cost_statistics()
+    return estimate_query_cost(
+        prepared.selection, statistics, limit=None if stats else limit
+    )
+
+
 def fetch(filename, **loc_data):
-    with tokenize.open(filename) as file:
-        source = file.read()
-    if loc_data:
-        loc_node = LocationNode(**loc_data)
-        return ast.get_source_segment(source, loc_node)
+    return SOURCE_CACHE.get(filename).segment(**loc_data)
+
+
+def compile_query(
+    tree,
+    stats=False,
+    limit=DEFAULT_LIMIT,
+    statistics=None,
+    paginated=False,
+    timings=None,
+    scope=None,
+    partitioned=False,
+    optimize=True,
+    base=None,
+):
+    with timed(timings, "compile"):
+        selection = build_selection(
+            tree, stats, limit, paginated, scope, partitioned, base
+        )
+
+    # Same as as_edgeql(), but the phases are measured separately
+    if optimize:
+        with timed(timings, "optimize"):
+            selection = optimize_edgeql(
+                selection, OptimizerState(statistics=statistics)
+            )
+
+    with timed(timings, "construct"):
+        return construct(selection, top_level=True)
+
+
+def glob_to_like(pattern):
+    for special in ("\\", "%", "_"):
+        pattern = pattern.replace(special, "\\" + special)
+    return pattern.replace("*", "%").replace("?", "_")
+
+
+def get_module_key(tree):
+    # Modules of the results; the root matcher is either positional (and
+    # has a _module) or matches the modules themselves.
+    if tree.positional:
+        return EdgeQLAttribute(EdgeQLFilterKey("_module"), "id")
     else:
-        return source
+        return EdgeQLFilterKey("id")
 
 
-def run_query(reiz_ql, stats=False, limit=DEFAULT_LIMIT):
-    tree = parse_query(reiz_ql)
-    logger.info("ReizQL Tree: %r", tree)
+def get_modules_filter(tree, variable):
+    # <module of the result> IN array_unpack(<array<uuid>>$<variable>)
+    return EdgeQLFilter(
+        get_module_key(tree),
+        EdgeQLCall(
+            "array_unpack",
+            [EdgeQLCast("array<uuid>", EdgeQLVariable(variable))],
+        ),
+        operator=EdgeQLComparisonOperator.CONTAINS,
+    )
+
+
+def compile_scope(scope, partitioned=False):
+    # Filters on the scoped modules (ast::PyModule). The partitioned
+    # queries take the project as a query argument ($project).
+    filters = None
+    if partitioned:
+        filters = merge_filters(
+            filters,
+            EdgeQLFilter(
+                EdgeQLAttribute(EdgeQLFilterKey("_project"), "name"),
+                EdgeQLCast("str", EdgeQLVariable("project")),
+            ),
+        )
+    elif scope.project is not None:
+        filters = merge_filters(
+            filters,
+            EdgeQLFilter(
+                EdgeQLAttribute(EdgeQLFilterKey("_project"), "name"),
+                repr(scope.project),
+            ),
+        )
+    if scope.filename is not None:
+        filters = merge_filters(
+            filters,
+            EdgeQLFilter(
+                EdgeQLFilterKey("filename"),
+                repr(glob_to_like(scope.filename)),
+                EdgeQLComparisonOperator.LIKE,
+            ),
+        )
+    return filters
+
+
+def apply_scope(selection, tree, scope, partitioned=False):
+    # The scope is a part of the root filters, so that only the objects
+    # of the scoped modules are scanned (through the _module index). The
+    # sampled modules are passed as a query argument ($sample).
+    if scope is None:
+        scope = Scope()
+
+    filters = compile_scope(scope, partitioned)
+    if filters is not None and tree.positional:
+        filters = EdgeQLFilter(
+            EdgeQLFilterKey("_module"),
+            EdgeQLSelect("Module", filters=filters),
+            EdgeQLComparisonOperator.CONTAINS,
+        )
+    if scope.sample is not None:
+        filters = merge_filters(filters, get_modules_filter(tree, "sample"))
+
+    if filters is None:
+        return selection
+    return replace(
+        selection, filters=merge_filters(selection.filters, filters)
+    )
+
 
-    selection = compile_edgeql(tree)
+def build_selection(
+    tree, stats, limit, paginated, scope=None, partitioned=False, base=None
+):
+    # The base is the compiled tree, if it is already at hand
+    if base is None:
+        base = compile_edgeql(tree)
+    selection = apply_scope(base, tree, scope, partitioned)
     if stats:
         selection = EdgeQLSelect(EdgeQLCall("count", [selection]))
     else:
-        selection.limit = limit
         if tree.positional:
-            selection.selections.extend(
-                (
-                    EdgeQLSelector("lineno"),
-                    EdgeQLSelector("col_offset"),
-                    EdgeQLSelector("end_lineno"),
-                    EdgeQLSelector("end_col_offset"),
-                    EdgeQLSelector("_module", [EdgeQLSelector("filename")]),
-                )
+            selections = (
+                EdgeQLSelector("id"),
+                EdgeQLSelector("lineno"),
+                EdgeQLSelector("col_offset"),
+                EdgeQLSelector("end_lineno"),
+                EdgeQLSelector("end_col_offset"),
+                EdgeQLSelector("_module", [EdgeQLSelector("filename")]),
             )
         elif tree.name == "Module":
-            selection.selections.append(EdgeQLSelector("filename"))
+            selections = (EdgeQLSelector("id"), EdgeQLSelector("filename"))
         else:
             raise Exception(f"Unexpected root matcher: {tree.name}")
 
-    query = as_edgeql(selection)
+        # Results are ordered by their ids, so that the pages can be
+        # continued from the last seen id (keyset pagination) instead
+        # of rescanning everything with an OFFSET.
+        filters = selection.filters
+        if paginated:
+            filters = merge_filters(
+                filters,
+                EdgeQLFilter(
+                    EdgeQLFilterKey("id"),
+                    EdgeQLCast("uuid", EdgeQLVariable("cursor")),
+                    EdgeQLComparisonOperator.GREATER,
+                ),
+            )
+
+        selection = replace(
+            selection,
+            limit=limit,
+            filters=filters,
+            ordered=EdgeQLFilterKey("id"),
+            selections=(*selection.selections, *selections),
+        )
+    return selection
+
+
+def parse_cursor(cursor):
+    try:
+        return str(UUID(cursor))
+    except (TypeError, ValueError):
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from None
+
+
+def get_query_args(cursor=None, sample=None, project=None):
+    query_args = {}
+    if cursor is not None:
+        query_args["cursor"] = cursor
+    if sample is not None:
+        query_args["sample"] = sample
+    if project is not None:
+        query_args["project"] = project
+    return query_args
+
+
+def get_location(tree, result):
+    if tree.positional:
+        return {
+            "filename": result._module.filename,
+            "lineno": result.lineno,
+            "col_offset": result.col_offset,
+            "end_lineno": result.end_lineno,
+            "end_col_offset": result.end_col_offset,
+        }
+    elif tree.name == "Module":
+        return {"filename": result.filename}
+
+
+def render_locations(ids, locations):
+    sources = fetch_segments(locations, store=get_source_store())
+    return [
+        {
+            "id": result_id,
+            "source": source,
+            "filename": location["filename"],
+        }
+        for result_id, source, location in zip(ids, sources, locations)
+    ]
+
+
+def render_results(tree, query_set):
+    return render_locations(
+        [str(result.id) for result in query_set],
+        [get_location(tree, result) for result in query_set],
+    )
+
+
+def get_materializations(scope=None):
+    if scope is None:
+        return get_materialized_queries()
+    else:
+        return None
+
+
+def fetch_materialized(tree, stats, limit, cursor, scope=None):
+    # Registered queries (see reiz.pipes.materialize) are served without
+    # touching the database; returns None for the rest of them, and for
+    # the scoped queries since the materializations cover the whole
+    # corpus.
+    if (materialized := get_materializations(scope)) is None:
+        return None
+
+    key = get_materialization_key(tree)
+    if (count := materialized.count(key)) is None:
+        return None
+    elif stats:
+        return count
+
+    ids, locations = [], []
+    for row in materialized.get_page(key, limit, cursor):
+        ids.append(row.pop("id"))
+        locations.append(
+            {field: value for field, value in row.items() if value is not None}
+        )
+    return render_locations(ids, locations)
+
+
+def get_query_shards(scope=None):
+    # A project is stored on a single shard, the rest of the queries are
+    # scattered to all of them.
+    shards = get_shards()
+    if scope is not None and scope.project is not None:
+        return [shards[get_shard_index(scope.project, len(shards))]]
+    else:
+        return shards
+
+
+def query_shards(
+    query,
+    shards,
+    stats=False,
+    cursor=None,
+    timeout=None,
+    scope=None,
+    timings=None,
+):
+    def run_shard(conn, shard):
+        sample = get_sampled_modules(conn, scope, shard)
+        query_args = get_query_args(cursor, sample)
+        with deadline(conn, timeout):
+            if stats:
+                return conn.query_one(query, **query_args)
+            else:
+                return list(conn.query(query, **query_args))
+
+    def query_shard(shard):
+        shard_timings = {}
+        result = run_read(
+            partial(run_shard, shard=shard), shard, timings=shard_timings
+        )
+        return result, shard_timings.get("connect", 0.0)
+
+    started = time.perf_counter()
+    results = scatter(query_shard, shards)
+    if timings is not None:
+        # The shards are queried in parallel, so only the slowest checkout
+        # counts as connecting, and the rest of the wait as the database.
+        connect = max(connect for _, connect in results)
+        elapsed = time.perf_counter() - started
+        timings["connect"] = timings.get("connect", 0.0) + connect
+        timings["db"] = timings.get("db", 0.0) + elapsed - connect
+    return [result for result, _ in results]
+
+
+def gather_results(query_sets, limit=None):
+    # Each shard returns its results ordered by their ids (up to the
+    # limit), so merging them keeps the keyset pagination intact.
+    merged = heapq.merge(*query_sets, key=attrgetter("id"))
+    return list(itertools.islice(merged, limit))
+
+
+def fetch_page(
+    tree,
+    query,
+    shards,
+    limit=None,
+    cursor=None,
+    timings=None,
+    timeout=None,
+    scope=None,
+):
+    query_sets = query_shards(
+        query,
+        shards,
+        cursor=cursor,
+        timeout=timeout,
+        scope=scope,
+        timings=timings,
+    )
+
+    with timed(timings, "fetch"):
+        return render_results(tree, gather_results(query_sets, limit))
+
+
+def prepare_query(
+    reiz_ql,
+    stats=False,
+    limit=DEFAULT_LIMIT,
+    cursor=None,
+    timings=None,
+    scope=None,
+    partitioned=False,
+):
+    statistics = get_statistics()
+    if not _PREPARED_STATISTICS or _PREPARED_STATISTICS[0] is not statistics:
+        with _PREPARED_QUERIES_LOCK:
+            _PREPARED_QUERIES.clear()
+            _PREPARED_STATISTICS[:] = [statistics]
+
+    key = (reiz_ql, stats, limit, cursor is not None, scope, partitioned)
+    if prepared := _PREPARED_QUERIES.get(key):
+        return prepared
+
+    with timed(timings, "parse"):
+        tree = parse_query(reiz_ql)
+    logger.info("ReizQL Tree: %r", tree)
+
+    with timed(timings, "compile"):
+        selection = compile_edgeql(tree)
+    query = compile_query(
+        tree,
+        stats=stats,
+        limit=limit,
+        statistics=statistics,
+        paginated=cursor is not None,
+        timings=timings,
+        scope=scope,
+        partitioned=partitioned,
+        base=selection,
+    )
+    logger.info("EdgeQL query: %r", query)
+
+    prepared = PreparedQuery(tree, selection, query)
+    with _PREPARED_QUERIES_LOCK:
+        if len(_PREPARED_QUERIES) >= MAX_PREPARED_QUERIES:
+            del _PREPARED_QUERIES[next(iter(_PREPARED_QUERIES))]
+        _PREPARED_QUERIES[key] = prepared
+    return prepared
+
+
+def is_partitioned(stats, cursor, scope, progressive):
+    # Progressive queries are split by projects, unless they are already
+    # scoped to one. Counts need all the partitions anyway.
+    if not progressive:
+        return False
+    elif stats or cursor is not None:
+        raise ValueError("progressive queries can't be counted or paginated")
+    return scope is None or scope.project is None
+
+
+def run_query(
+    reiz_ql,
+    stats=False,
+    limit=DEFAULT_LIMIT,
+    timings=None,
+    cursor=None,
+    timeout=None,
+    scope=None,
+    progressive=False,
+):
+    if cursor is not None:
+        cursor = parse_cursor(cursor)
+    if timeout is None:
+        timeout = get_query_timeout("stats" if stats else "query")
+
+    partitioned = is_partitioned(stats, cursor, scope, progressive)
+    prepared = prepare_query(
+        reiz_ql, stats, limit, cursor, timings, scope, partitioned
+    )
+    tree, query = prepared.tree, prepared.query
+
+    with timed(timings, "materialized"):
+        results = fetch_materialized(tree, stats, limit, cursor, scope)
+    if results is not None:
+        return results
+    elif partitioned:
+        return fetch_partitions(tree, query, limit, timings, timeout, scope)
+
+    shards = get_query_shards(scope)
+    if stats:
+        counts = query_shards(
+            query,
+            shards,
+            stats=True,
+            timeout=timeout,
+            scope=scope,
+            timings=timings,
+        )
+        return sum(counts)
+    else:
+        return fetch_page(
+            tree, query, shards, limit, cursor, timings, timeout, scope
+        )
+
+
+def get_projects_query():
+    return as_edgeql(
+        EdgeQLSelect("Project", selections=[EdgeQLSelector("name")])
+    )
+
+
+def get_cached_projects():
+    if _PROJECTS and _PROJECTS[0] > time.time():
+        return _PROJECTS[1]
+    else:
+        return None
+
+
+def cache_projects(query_sets):
+    # Projects of all the shards (each one is stored on a single shard)
+    projects = [
+        project.name for query_set in query_sets for project in query_set
+    ]
+    _PROJECTS[:] = [time.time() + PROJECTS_TTL, projects]
+    return projects
+
+
+def get_projects():
+    if (projects := get_cached_projects()) is not None:
+        return projects
+
+    def query_shard(shard):
+        return run_read(
+            lambda conn: list(conn.query(get_projects_query())), shard
+        )
+
+    return cache_projects(scatter(query_shard, get_shards()))
+
+
+def get_progressive_workers():
+    options = get_config_settings().get("progressive", {})
+    return options.get("workers", DEFAULT_PROGRESSIVE_WORKERS)
+
+
+def fetch_partitions(
+    tree, query, limit, timings=None, timeout=None, scope=None
+):
+    # Evaluates a partitioned query on each project, a few of them at a
+    # time, and returns as soon as the limit is reached. The results are
+    # whatever was found first, so they are neither ordered nor paginated.
+    # The timeout applies to the whole evaluation, and each partition is
+    # limited on its own as well.
+    with timed(timings, "db"):
+        projects = get_projects()
+
+    shards = get_shards()
+    started = time.monotonic()
+    cancellation = Cancellation()
+
+    def fetch_partition(project):
+        remaining = timeout
+        if timeout is not None:
+            remaining = timeout - (time.monotonic() - started)
+            if remaining <= 0:
+                raise timeout_error(timeout)
+
+        def query_partition(conn):
+            sample = get_sampled_modules(conn, scope, shard)
+            query_args = get_query_args(sample=sample, project=project)
+            with deadline(conn, remaining), cancellation.track(conn):
+                return list(conn.query(query, **query_args))
+
+        shard = shards[get_shard_index(project, len(shards))]
+        return run_read(query_partition, shard)
+
+    query_set = []
+    executor = ThreadPoolExecutor(max_workers=get_progressive_workers())
+    futures = [
+        executor.submit(fetch_partition, project) for project in projects
+    ]
+    try:
+        with timed(timings, "db"):
+            for future in as_completed(futures):
+                query_set.extend(future.result())
+                if limit is not None and len(query_set) >= limit:
+                    break
+    finally:
+        # The partitions that haven't started are dropped, and the ones
+        # that are still running are cancelled (so that they don't hold
+        # on to their connections until their timeouts).
+        for future in futures:
+            future.cancel()
+        cancellation.cancel()
+        executor.shutdown(wait=True)
+
+    with timed(timings, "fetch"):
+        return render_results(tree, query_set[:limit])
+
+
+def get_module_ids_query():
+    return as_edgeql(EdgeQLSelect("Module", selections=[EdgeQLSelector("id")]))
+
+
+def get_cached_module_sample(
+    fraction=DEFAULT_SAMPLE_FRACTION, seed=None, shard=0
+):
+    sample = _MODULE_SAMPLES.get((shard, fraction, seed))
+    if sample and sample[0] > time.time():
+        _, module_ids, population = sample
+        return module_ids, population
+    else:
+        return None
+
+
+def sample_modules(
+    all_ids, fraction=DEFAULT_SAMPLE_FRACTION, seed=None, shard=0
+):
+    # A seeded sample only depends on the set of modules, so the pages of
+    # a sampled query are taken from the same modules on every worker (as
+    # long as nothing is inserted in between). Each shard is sampled
+    # separately.
+    size = min(
+        max(MIN_SAMPLE_SIZE, round(len(all_ids) * fraction)), len(all_ids)
+    )
+    if seed is None:
+        module_ids = random.sample(all_ids, size)
+    else:
+        module_ids = random.Random(seed).sample(sorted(all_ids), size)
+
+    if len(_MODULE_SAMPLES) >= MAX_MODULE_SAMPLES:
+        del _MODULE_SAMPLES[next(iter(_MODULE_SAMPLES))]
+    _MODULE_SAMPLES[shard, fraction, seed] = (
+        time.time() + SAMPLE_TTL,
+        module_ids,
+        len(all_ids),
+    )
+    return module_ids, len(all_ids)
+
+
+def get_module_sample(
+    connection, fraction=DEFAULT_SAMPLE_FRACTION, seed=None, shard=0
+):
+    if sample := get_cached_module_sample(fraction, seed, shard):
+        return sample
+
+    modules = connection.query(get_module_ids_query())
+    return sample_modules(
+        [str(module.id) for module in modules], fraction, seed, shard
+    )
+
+
+def get_sampled_modules(connection, scope, shard=0):
+    # Module ids of a sampled scope ($sample)
+    if scope is None or scope.sample is None:
+        return None
+
+    module_ids, _ = get_module_sample(
+        connection, scope.sample, scope.seed, shard
+    )
+    return module_ids
+
+
+def compile_sampled_count(tree, scope=None):
+    # FOR __module IN {array_unpack(<array<uuid>>$modules)}
+    # UNION (SELECT count((<selection> FILTER ._module.id = __module)))
+    # The sampled modules that are out of the scope simply count as 0.
+    selection = apply_scope(compile_edgeql(tree), tree, scope)
+    selection = replace(
+        selection,
+        filters=merge_filters(
+            selection.filters,
+            EdgeQLFilter(get_module_key(tree), EdgeQLName("__module")),
+        ),
+    )
+    return as_edgeql(
+        EdgeQLFor(
+            "__module",
+            EdgeQLSet(
+                [
+                    EdgeQLCall(
+                        "array_unpack",
+                        [EdgeQLCast("array<uuid>", EdgeQLVariable("modules"))],
+                    )
+                ]
+            ),
+            EdgeQLSelect(EdgeQLCall("count", [selection])),
+        )
+    )
+
+
+def estimate_count(counts, population):
+    # Each sampled module is a cluster, the total is extrapolated from the
+    # mean count per module, and the error from the variance between them
+    # (with the finite population correction).
+    sample_size = len(counts)
+    if sample_size == 0:
+        return CountEstimate(0, 0, exact=population == 0)
+    elif sample_size >= population:
+        return CountEstimate(sum(counts), 0, exact=True)
+
+    spread = variance(counts) if sample_size > 1 else 0
+    standard_error = population * math.sqrt(
+        (1 - sample_size / population) * spread / sample_size
+    )
+    return CountEstimate(
+        round(population * fmean(counts)),
+        math.ceil(CONFIDENCE_Z * standard_error),
+    )
+
+
+def combine_estimates(estimates):
+    # The shards are sampled independently (as strata), so their errors
+    # add up in quadrature.
+    return CountEstimate(
+        sum(estimate.count for estimate in estimates),
+        math.ceil(
+            math.sqrt(sum(estimate.error**2 for estimate in estimates))
+        ),
+        exact=all(estimate.exact for estimate in estimates),
+    )
+
+
+def approximate_count(
+    reiz_ql,
+    fraction=DEFAULT_SAMPLE_FRACTION,
+    timings=None,
+    timeout=None,
+    scope=None,
+):
+    if timeout is None:
+        timeout = get_query_timeout("approximate")
+
+    with timed(timings, "parse"):
+        tree = parse_query(reiz_ql)
+
+    with timed(timings, "compile"):
+        query = compile_sampled_count(tree, scope)
     logger.info("EdgeQL query: %r", query)
 
-    results = []
-    with connect(**get_db_settings()) as conn:
-        if stats:
-            return conn.query_one(query)
-
-        query_set = conn.query(query)
-
-        for result in query_set:
-            loc_data = {}
-            if tree.positional:
-                loc_data.update(
-                    {
-                        "filename": result._module.filename,
-                        "lineno": result.lineno,
-                        "col_offset": result.col_offset,
-                        "end_lineno": result.end_lineno,
-                        "end_col_offset": result.end_col_offset,
-                    }
-                )
-            elif tree.name == "Module":
-                loc_data.update({"filename": result.filename})
-
-            try:
-                source = fetch(**loc_data)
-            except Exception:
-                source = None
-
-            results.append(
-                {
-                    "source": source,
-                    "filename": loc_data["filename"],
-                }
+    def estimate_shard(conn, shard):
+        module_ids, population = get_module_sample(conn, fraction, shard=shard)
+        sample = get_sampled_modules(conn, scope, shard)
+        query_args = get_query_args(sample=sample)
+        with deadline(conn, timeout):
+            counts = conn.query(query, modules=module_ids, **query_args)
+        return estimate_count(list(counts), population)
+
+    with timed(timings, "db"):
+        estimates = scatter(
+            lambda shard: run_read(
+                partial(estimate_shard, shard=shard), shard
+            ),
+            get_query_shards(scope),
+        )
+    return combine_estimates(estimates)
+
+
+def get_next_cursor(results, limit):
+    # A page that is shorter than the limit is the last one.
+    if results and len(results) == limit:
+        return results[-1]["id"]
+    else:
+        return None
+
+
+def stream_query(
+    reiz_ql,
+    limit=None,
+    cursor=None,
+    batch_size=STREAM_BATCH_SIZE,
+    timeout=None,
+    scope=None,
+):
+    # The query is parsed and validated eagerly, so that the errors can
+    # be reported before anything is streamed. The timeout applies to
+    # each page separately.
+    if cursor is not None:
+        cursor = parse_cursor(cursor)
+    if timeout is None:
+        timeout = get_query_timeout("stream")
+
+    tree = parse_query(reiz_ql)
+
+    @lru_cache(4)
+    def compile_page(size, paginated):
+        return compile_query(
+            tree, limit=size, paginated=paginated, scope=scope
+        )
+
+    compile_page(batch_size, cursor is not None)
+
+    def stream():
+        nonlocal cursor, limit
+        shards = get_query_shards(scope)
+        while limit is None or limit > 0:
+            size = batch_size if limit is None else min(batch_size, limit)
+            query = compile_page(size, cursor is not None)
+            results = fetch_page(
+                tree, query, shards, size, cursor, timeout=timeout, scope=scope
             )
+            yield from results
+
+            if not (cursor := get_next_cursor(results, size)):
+                break
+            if limit is not None:
+                limit -= len(results)
 
-    return results
+    return stream()
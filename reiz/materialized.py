@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+from contextlib import closing, nullcontext
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from reiz.utilities import get_config_settings, logger
+
+LOCATION_FIELDS = (
+    "filename",
+    "lineno",
+    "col_offset",
+    "end_lineno",
+    "end_col_offset",
+)
+
+
+def get_materialization_key(tree) -> str:
+    # Parsed queries are compared rather than their sources, so that the
+    # formatting differences don't matter.
+    return repr(tree)
+
+
+class MaterializedQueries:
+    # Result ids (with their locations) and counts of the registered hot
+    # queries. The inserter records the ids of the modules it inserts,
+    # and the reiz.pipes.materialize evaluates the registered queries
+    # only over those modules, so that the materializations stay up to
+    # date with the corpus without rescanning it.
+
+    def __init__(self, path: Path, read_only: bool = False) -> None:
+        self.path = path
+        self.read_only = read_only
+        # The read-only stores (of the API) keep a connection per thread
+        # instead of opening one for each lookup.
+        self._local = threading.local()
+        if read_only:
+            return None
+
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "key TEXT PRIMARY KEY, "
+                "query TEXT NOT NULL, "
+                "count INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT NOT NULL, "
+                "id TEXT NOT NULL, "
+                "filename TEXT NOT NULL, "
+                "lineno INTEGER, "
+                "col_offset INTEGER, "
+                "end_lineno INTEGER, "
+                "end_col_offset INTEGER, "
+                "PRIMARY KEY (key, id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS pending_modules ("
+                "id TEXT PRIMARY KEY)"
+            )
+
+    def _connect(self):
+        if not self.read_only:
+            return closing(sqlite3.connect(self.path, timeout=30))
+
+        if (connection := getattr(self._local, "connection", None)) is None:
+            connection = self._local.connection = sqlite3.connect(
+                self.path.resolve().as_uri() + "?mode=ro", uri=True
+            )
+        return nullcontext(connection)
+
+    def _insert_results(self, connection, key, results):
+        connection.executemany(
+            "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (key, result["id"], *map(result.get, LOCATION_FIELDS))
+                for result in results
+            ],
+        )
+        connection.execute(
+            "UPDATE queries SET count = "
+            "(SELECT count(*) FROM results WHERE key = ?) WHERE key = ?",
+            (key, key),
+        )
+
+    def register(
+        self, key: str, query: str, results: Iterable[Dict[str, Any]]
+    ) -> None:
+        # Queries are only served after their initial results are stored,
+        # both are replaced at once.
+        with self._connect() as connection, connection:
+            connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            connection.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, 0)",
+                (key, query),
+            )
+            self._insert_results(connection, key, results)
+
+    def unregister(self, key: str) -> None:
+        with self._connect() as connection, connection:
+            connection.execute("DELETE FROM queries WHERE key = ?", (key,))
+            connection.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def queries(self) -> Dict[str, str]:
+        with self._connect() as connection:
+            return dict(connection.execute("SELECT key, query FROM queries"))
+
+    def add_results(self, key: str, results: Iterable[Dict[str, Any]]) -> None:
+        with self._connect() as connection, connection:
+            self._insert_results(connection, key, results)
+
+    def count(self, key: str) -> Optional[int]:
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "SELECT count FROM queries WHERE key = ?", (key,)
+            )
+            if row := cursor.fetchone():
+                return row[0]
+            else:
+                return None
+
+    def get_page(
+        self,
+        key: str,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        # Same order as the database (by id), so that the cursors of the
+        # materialized and the live results are interchangeable.
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT id, {', '.join(LOCATION_FIELDS)} FROM results "
+                "WHERE key = ? AND id > ? ORDER BY id LIMIT ?",
+                (key, cursor or "", -1 if limit is None else limit),
+            )
+            return [dict(zip(("id", *LOCATION_FIELDS), row)) for row in rows]
+
+    def add_pending(self, module_id: str) -> None:
+        with self._connect() as connection, connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO pending_modules VALUES (?)",
+                (module_id,),
+            )
+
+    def pending(self) -> List[str]:
+        with self._connect() as connection:
+            cursor = connection.execute("SELECT id FROM pending_modules")
+            return [module_id for module_id, in cursor]
+
+    def clear_pending(self, module_ids: Iterable[str]) -> None:
+        with self._connect() as connection, connection:
+            connection.executemany(
+                "DELETE FROM pending_modules WHERE id = ?",
+                [(module_id,) for module_id in module_ids],
+            )
+
+    def clear(self) -> None:
+        # Registrations are kept, the queries are re-populated from the
+        # modules that are inserted afterwards.
+        with self._connect() as connection, connection:
+            connection.execute("DELETE FROM results")
+            connection.execute("DELETE FROM pending_modules")
+            connection.execute("UPDATE queries SET count = 0")
+
+
+def get_materialized_path() -> Optional[Path]:
+    # The materializations are only maintained (and served) when they are
+    # configured.
+    if path := get_config_settings().get("materialized"):
+        return Path(path).expanduser()
+    else:
+        return None
+
+
+@lru_cache(1)
+def get_materialized_queries() -> Optional[MaterializedQueries]:
+    # The API only reads the store that the inserter maintains
+    path = get_materialized_path()
+    if path is None:
+        return None
+    elif not path.exists():
+        logger.warning("materialized queries are not found at %s", path)
+        return None
+    else:
+        return MaterializedQueries(path, read_only=True)
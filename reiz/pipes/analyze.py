@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, List, Set, Tuple
+
+import pyasdl
+
+from reiz.db.connection import connect
+from reiz.db.schema import protected_name
+from reiz.db.schema_gen import EDGEQL_BASICS, UNIQUE_FIELDS
+from reiz.db.statistics import FieldStatistics, Statistics, get_statistics_path
+from reiz.edgeql import EdgeQLAttribute, EdgeQLCall, EdgeQLSelect, as_edgeql
+from reiz.fetch import count_nodes
+from reiz.utilities import get_db_settings, logger
+
+DEFAULT_SAMPLE_SIZE = 100_000
+DEFAULT_MOST_COMMON = 100
+
+ProfiledField = Tuple[str, str, str]
+
+
+def load_model(
+    source: str,
+) -> Tuple[List[str], List[ProfiledField], Set[str]]:
+    tree = pyasdl.parse(source)
+
+    enums = {
+        definition.name
+        for definition in tree.body
+        if isinstance(definition.value, pyasdl.Sum)
+        and not any(
+            constructor.fields for constructor in definition.value.types
+        )
+    }
+
+    types, fields = ["AST"], []
+    for definition in tree.body:
+        if isinstance(definition.value, pyasdl.Sum):
+            if definition.name in enums:
+                continue
+            types.append(definition.name)
+            constructors = [
+                (constructor.name, constructor.fields or ())
+                for constructor in definition.value.types
+            ]
+        else:
+            constructors = [(definition.name, definition.value.fields)]
+
+        for name, constructor_fields in constructors:
+            types.append(name)
+            for field in constructor_fields:
+                if field.name in UNIQUE_FIELDS:
+                    continue
+                if field.kind in EDGEQL_BASICS or field.kind in enums:
+                    fields.append((name, field.name, field.kind))
+
+    return types, fields, enums
+
+
+def render_value(value, kind, enums):
+    # Render the value in the same form that compiler would
+    # emit it, so that the optimizer can look it up directly.
+    if kind in enums:
+        return f"<{protected_name(kind, prefix=True)}>{str(value)!r}"
+    elif isinstance(value, str):
+        return repr(value)
+    else:
+        return str(value)
+
+
+def profile_field(
+    connection, name, field, kind, enums, total, sample_size, most_common
+):
+    # The nodes are stored in their insertion order (project by project),
+    # so the sample is drawn randomly to represent the whole corpus, which
+    # is what the counts are scaled up to.
+    if total > sample_size:
+        nodes = EdgeQLSelect(
+            name, limit=sample_size, ordered=EdgeQLCall("random", [])
+        )
+    else:
+        nodes = EdgeQLSelect(name)
+
+    selection = EdgeQLSelect(
+        EdgeQLAttribute(nodes, protected_name(field, prefix=False))
+    )
+    values = Counter(
+        render_value(value, kind, enums)
+        for value in connection.query(as_edgeql(selection))
+    )
+
+    scale = total / max(min(total, sample_size), 1)
+    return FieldStatistics(
+        total=round(sum(values.values()) * scale),
+        distinct=len(values),
+        most_common={
+            value: round(count * scale)
+            for value, count in values.most_common(most_common)
+        },
+    )
+
+
+def iter_field_statistics(
+    connection, fields, enums, counts, sample_size, most_common
+) -> Iterator[Tuple[str, str, FieldStatistics]]:
+    for name, field, kind in fields:
+        if not counts.get(name):
+            continue
+
+        yield name, protected_name(field, prefix=False), profile_field(
+            connection,
+            name,
+            field,
+            kind,
+            enums,
+            counts[name],
+            sample_size,
+            most_common,
+        )
+
+
+def analyze(
+    connection,
+    asdl_file: Path,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    most_common: int = DEFAULT_MOST_COMMON,
+) -> Statistics:
+    types, fields, enums = load_model(asdl_file.read_text())
+
+    statistics = Statistics(counts=count_nodes(connection, types))
+    logger.info("collected counts of %d types", len(statistics.counts))
+
+    for name, pointer, field_stats in iter_field_statistics(
+        connection,
+        fields,
+        enums,
+        statistics.counts,
+        sample_size,
+        most_common,
+    ):
+        statistics.fields.setdefault(name, {})[pointer] = field_stats
+        logger.info(
+            "profiled %s.%s (%d distinct values)",
+            name,
+            pointer,
+            field_stats.distinct,
+        )
+
+    return statistics
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("asdl_file", type=Path)
+    parser.add_argument("--dsn", default=get_db_settings()["dsn"])
+    parser.add_argument("--database", default=get_db_settings()["database"])
+    parser.add_argument("--output", type=Path, default=get_statistics_path())
+    parser.add_argument("--sample-size", type=int, default=DEFAULT_SAMPLE_SIZE)
+    parser.add_argument("--most-common", type=int, default=DEFAULT_MOST_COMMON)
+    options = parser.parse_args()
+
+    with connect(options.dsn, options.database) as connection:
+        statistics = analyze(
+            connection,
+            options.asdl_file,
+            sample_size=options.sample_size,
+            most_common=options.most_common,
+        )
+
+    statistics.dump(options.output)
+    logger.info("statistics are written to %s", options.output)
+
+
+if __name__ == "__main__":
+    main()
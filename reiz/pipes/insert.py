@@ -3,27 +3,44 @@ from __future__ import annotations
 import random
 import warnings
 from argparse import ArgumentParser
+from contextlib import ExitStack
 from functools import partial
 from pathlib import Path
 from typing import NamedTuple
 
-from reiz.db.connection import connect
+from reiz.cache import bump_generation
+from reiz.counters import NodeCounters, get_counters_path
+from reiz.db.connection import connect, get_shard_index, resolve_shards
+from reiz.db.statistics import get_statistics_path
+from reiz.db.timeouts import get_query_timeout
 from reiz.edgeql import EdgeQLSelect, EdgeQLSelector
-from reiz.serialization.serializer import insert_file
-from reiz.utilities import get_db_settings, get_executor, logger, read_config
+from reiz.materialized import MaterializedQueries, get_materialized_path
+from reiz.pipes.analyze import analyze
+from reiz.pipes.materialize import refresh
+from reiz.serialization.serializer import ensure_project, insert_file
+from reiz.sources import SourceStore, get_source_store_path
+from reiz.utilities import (
+    get_config_settings,
+    get_db_settings,
+    get_executor,
+    logger,
+    read_config,
+)
+from reiz.web.warmup import warmup_from_config
 
 FILE_CACHE = frozenset()
 
 
-def sync_cache(connector):
+def sync_cache(connectors):
     global FILE_CACHE
-    with connector() as connection:
-        selection = EdgeQLSelect(
-            "Module", selections=[EdgeQLSelector("filename")]
-        )
-        result_set = connection.query(selection.construct())
+    filenames = set()
+    selection = EdgeQLSelect("Module", selections=[EdgeQLSelector("filename")])
+    for connector in connectors:
+        with connector() as connection:
+            result_set = connection.query(selection.construct())
+        filenames.update(module.filename for module in result_set)
 
-    FILE_CACHE = frozenset(module.filename for module in result_set)
+    FILE_CACHE = frozenset(filenames)
 
 
 class Stats(NamedTuple):
@@ -50,17 +67,33 @@ class Stats(NamedTuple):
             return NotImplemented
 
 
-def insert_project(connector, directory):
+def insert_project(
+    connectors, directory, source_store=None, counters=None, materialized=None
+):
+    # Each project is inserted into a single shard, see reiz.db.connection
+    connector = connectors[get_shard_index(directory.name, len(connectors))]
     inserted, cached, failed = 0, 0, 0
     with connector() as connection:
+        ensure_project(connection, directory.name)
         for file in directory.glob("**/*.py"):
             filename = str(file)
             if filename in FILE_CACHE:
                 cached += 1
+                # Backfill the files that were inserted before the
+                # source store was enabled.
+                if source_store is not None and filename not in source_store:
+                    source_store.put_file(filename)
                 continue
 
             try:
-                insert_file(connection, file)
+                insert_file(
+                    connection,
+                    file,
+                    source_store=source_store,
+                    counters=counters,
+                    materialized=materialized,
+                    project=directory.name,
+                )
             except ArithmeticError:
                 failed += 1
                 logger.info(
@@ -76,14 +109,54 @@ def insert_project(connector, directory):
     return directory, Stats(cached=cached, failed=failed, inserted=inserted)
 
 
-def insert(clean_dir, workers, **db_opts):
+def refresh_materialized(connectors, materialized):
+    # The pending modules are kept on failures, so that the next refresh
+    # can pick them up.
+    try:
+        with ExitStack() as stack:
+            connections = [
+                stack.enter_context(connector()) for connector in connectors
+            ]
+            refresh(
+                connections, materialized, timeout=get_query_timeout("job")
+            )
+    except Exception:
+        logger.exception("couldn't refresh the materialized queries")
+
+
+def insert(
+    clean_dir,
+    workers,
+    asdl_file=None,
+    source_store=None,
+    counters=None,
+    materialized=None,
+    warmup=False,
+    shards=None,
+    **db_opts,
+):
     cache = read_config(clean_dir / "info.json")
     random.shuffle(cache)
-    connector = partial(connect, **db_opts)
-    bound_inserter = partial(insert_project, connector)
+    connectors = [
+        partial(connect, **settings)
+        for settings in resolve_shards(**db_opts, shards=shards)
+    ]
+    if source_store is not None:
+        source_store = SourceStore(source_store)
+    if counters is not None:
+        counters = NodeCounters(counters)
+    if materialized is not None:
+        materialized = MaterializedQueries(materialized)
+    bound_inserter = partial(
+        insert_project,
+        connectors,
+        source_store=source_store,
+        counters=counters,
+        materialized=materialized,
+    )
 
     stats = []
-    sync_cache(connector)
+    sync_cache(connectors)
     try:
         with get_executor(workers) as executor:
             for project_path, project_stats in executor.map(
@@ -96,6 +169,24 @@ def insert(clean_dir, workers, **db_opts):
     finally:
         total_stats = sum(stats)
         logger.info("total stats: %r", total_stats)
+        # Invalidate the results that the API has cached for the
+        # previous state of the corpus.
+        if total_stats and total_stats.inserted:
+            if materialized is not None:
+                refresh_materialized(connectors, materialized)
+            bump_generation()
+
+    # The value distributions are profiled on the first shard, the counts
+    # of the whole corpus come from the node counters anyway.
+    if asdl_file is not None:
+        with connectors[0]() as connection:
+            statistics = analyze(connection, asdl_file)
+        statistics.dump(get_statistics_path())
+        logger.info("corpus statistics are updated")
+
+    # Re-populate the cache of the new generation with the popular queries
+    if warmup and total_stats and total_stats.inserted:
+        warmup_from_config()
 
 
 def main():
@@ -103,7 +194,47 @@ def main():
     parser.add_argument("clean_dir", type=Path)
     parser.add_argument("--dsn", default=get_db_settings()["dsn"])
     parser.add_argument("--database", default=get_db_settings()["database"])
+    parser.add_argument(
+        "--shards",
+        nargs="+",
+        default=get_config_settings().get("shards"),
+        help="database names of the shards (on the --dsn server), the "
+        "projects are distributed among them by their names",
+    )
     parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--analyze",
+        dest="asdl_file",
+        type=Path,
+        help="collect corpus statistics with the given ASDL after insertion",
+    )
+    parser.add_argument(
+        "--source-store",
+        type=Path,
+        default=get_source_store_path(),
+        help="also store the sources of the inserted files in the given "
+        "SQLite database, so that the API doesn't need the raw data",
+    )
+    parser.add_argument(
+        "--counters",
+        type=Path,
+        default=get_counters_path(),
+        help="also maintain a local copy of the node counts (served by "
+        "/stats, see reiz.counters) in the given SQLite database",
+    )
+    parser.add_argument(
+        "--materialized",
+        type=Path,
+        default=get_materialized_path(),
+        help="refresh the materialized queries (see reiz.pipes.materialize) "
+        "in the given SQLite database with the inserted modules",
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="warm up the API's result cache (see reiz.web.warmup) "
+        "after the insertion",
+    )
     options = parser.parse_args()
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from contextlib import ExitStack
+from dataclasses import replace
+from pathlib import Path
+
+from reiz.db.connection import connect, resolve_shards
+from reiz.db.timeouts import deadline, get_query_timeout
+from reiz.edgeql import as_edgeql, merge_filters
+from reiz.fetch import build_selection, get_location, get_modules_filter
+from reiz.materialized import (
+    MaterializedQueries,
+    get_materialization_key,
+    get_materialized_path,
+)
+from reiz.reizql import parse_query
+from reiz.utilities import get_config_settings, get_db_settings, logger
+
+# Number of newly inserted modules that are evaluated in a single query
+REFRESH_BATCH_SIZE = 500
+
+
+def compile_materialization(tree, incremental=False):
+    # All the results of the query, or only the ones in the given $modules
+    selection = build_selection(tree, stats=False, limit=None, paginated=False)
+    if incremental:
+        selection = replace(
+            selection,
+            filters=merge_filters(
+                selection.filters, get_modules_filter(tree, "modules")
+            ),
+        )
+    return as_edgeql(selection)
+
+
+def fetch_results(connection, tree, query, timeout=None, **query_args):
+    with deadline(connection, timeout):
+        query_set = connection.query(query, **query_args)
+    return [
+        {"id": str(result.id), **get_location(tree, result)}
+        for result in query_set
+    ]
+
+
+def materialize(connections, materialized, reiz_ql, timeout=None):
+    # Results are collected from every shard
+    tree = parse_query(reiz_ql)
+    query = compile_materialization(tree)
+    logger.info("EdgeQL query: %r", query)
+
+    results = []
+    for connection in connections:
+        results.extend(fetch_results(connection, tree, query, timeout))
+    materialized.register(get_materialization_key(tree), reiz_ql, results)
+    logger.info("%r is materialized with %d results", reiz_ql, len(results))
+    return len(results)
+
+
+def refresh(connections, materialized, timeout=None):
+    # Evaluates the registered queries over the modules that were inserted
+    # since the last refresh (on any of the shards). The modules stay
+    # pending until all of the queries are refreshed, and re-evaluating
+    # them is harmless.
+    module_ids = materialized.pending()
+    for key, reiz_ql in materialized.queries().items():
+        tree = parse_query(reiz_ql)
+        query = compile_materialization(tree, incremental=True)
+        for start in range(0, len(module_ids), REFRESH_BATCH_SIZE):
+            batch = module_ids[start : start + REFRESH_BATCH_SIZE]
+            for connection in connections:
+                results = fetch_results(
+                    connection, tree, query, timeout, modules=batch
+                )
+                materialized.add_results(key, results)
+        logger.info(
+            "%r is refreshed over %d modules", reiz_ql, len(module_ids)
+        )
+
+    materialized.clear_pending(module_ids)
+    return len(module_ids)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "action", choices=("register", "unregister", "refresh", "list")
+    )
+    parser.add_argument("queries", nargs="*")
+    parser.add_argument(
+        "--path",
+        type=Path,
+        default=get_materialized_path(),
+        required=get_materialized_path() is None,
+    )
+    parser.add_argument("--dsn", default=get_db_settings()["dsn"])
+    parser.add_argument("--database", default=get_db_settings()["database"])
+    parser.add_argument(
+        "--shards", nargs="+", default=get_config_settings().get("shards")
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=get_query_timeout("job")
+    )
+    options = parser.parse_args()
+
+    materialized = MaterializedQueries(options.path)
+    if options.action == "list":
+        for key, reiz_ql in materialized.queries().items():
+            print(f"{materialized.count(key):>10} {reiz_ql}")
+        return None
+    elif options.action == "unregister":
+        for reiz_ql in options.queries:
+            key = get_materialization_key(parse_query(reiz_ql))
+            materialized.unregister(key)
+        return None
+
+    with ExitStack() as stack:
+        connections = [
+            stack.enter_context(connect(**settings))
+            for settings in resolve_shards(
+                options.dsn, options.database, options.shards
+            )
+        ]
+        if options.action == "register":
+            for reiz_ql in options.queries:
+                materialize(
+                    connections, materialized, reiz_ql, timeout=options.timeout
+                )
+        else:
+            refresh(connections, materialized, timeout=options.timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import functools
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from typing import Dict, Optional
 
 from reiz.db.schema import protected_name
@@ -127,11 +127,10 @@ def generate_typechecked_query_item(query, base):
     key = EdgeQLAttribute(base, name)
 
     if rec_list:
-        query.key.args[0] = key
-        return query
+        call = query.key
+        return replace(query, key=replace(call, args=(key, *call.args[1:])))
     elif isinstance(query.value, EdgeQLPreparedQuery):
-        query.key = key
-        return query
+        return replace(query, key=key)
     elif isinstance(query.value, EdgeQLSelect):
         model = protected_name(query.value.name, prefix=True)
         verifier = EdgeQLVerify(key, EdgeQLVerifyOperator.IS, model)
@@ -150,12 +149,14 @@ def generate_typechecked_query_item(query, base):
 def generate_typechecked_selection(selection, base):
     def replace_select(node):
         assert isinstance(node.name, EdgeQLFilterKey)
-        node.name = EdgeQLAttribute(f"_tmp_singleton", node.name.name)
+        node = replace(
+            node, name=EdgeQLAttribute(f"_tmp_singleton", node.name.name)
+        )
         return EdgeQLFor("_tmp_singleton", EdgeQLSet([base]), node)
 
     def replace_node(node):
         if isinstance(node, EdgeQLVerify):
-            node.query = replace_select(node.query)
+            return replace(node, query=replace_select(node.query))
         elif isinstance(node, EdgeQLSelect):
             return replace_select(node)
         else:
@@ -163,9 +164,11 @@ def generate_typechecked_selection(selection, base):
         return node
 
     if selection.with_block:
-        namespace = selection.with_block.assignments
-        for key, node in namespace.copy().items():
-            namespace[key] = replace_node(node)
+        namespace = {
+            key: replace_node(node)
+            for key, node in selection.with_block.assignments.items()
+        }
+        selection = replace(selection, with_block=EdgeQLWithBlock(namespace))
 
     return selection
 
@@ -1,9 +1,11 @@
 import ast
 import functools
 import tokenize
+from collections import Counter
 from dataclasses import dataclass, field
 from typing import List, Optional
 
+from reiz.counters import add_counts, count_node
 from reiz.db.schema import (
     ATOMIC_TYPES,
     ENUM_TYPES,
@@ -39,6 +41,12 @@ from reiz.utilities import logger
 class QLState:
     from_parent: Optional[ast.AST] = None
     reference_pool: List[str] = field(default_factory=list)
+    counts: Counter = field(default_factory=Counter)
+
+
+@dataclass(frozen=True)
+class ProjectReference:
+    name: str
 
 
 @functools.singledispatch
@@ -91,6 +99,13 @@ def serialize_string(obj, ql_state, connection):
     return repr(obj)
 
 
+@serialize.register(ProjectReference)
+def serialize_project(obj, ql_state, connection):
+    return EdgeQLSelect(
+        "Project", filters=make_filter(name=repr(obj.name)), limit=1
+    )
+
+
 @serialize.register(type(None))
 def serialize_sentinel(obj, ql_state, connection):
     return serialize(Sentinel(), ql_state, connection)
@@ -106,16 +121,35 @@ def insert(connection, ql_state, node):
         insertions[field] = serialize(value, ql_state, connection)
     query = as_edgeql(EdgeQLInsert(node_type, insertions))
     logger.trace("Running query: %r", query)
+    count_node(ql_state.counts, node)
     return connection.query_one(query)
 
 
 # FIX-ME(low): remove <rawdata>/<provider> prefix
-def insert_file(connection, file):
+def ensure_project(connection, name):
+    selection = EdgeQLSelect(
+        "Project", filters=make_filter(name=repr(name)), limit=1
+    )
+    if not connection.query(as_edgeql(selection)):
+        insertion = EdgeQLInsert("Project", {"name": repr(name)})
+        connection.query(as_edgeql(insertion))
+
+
+def insert_file(
+    connection,
+    file,
+    source_store=None,
+    counters=None,
+    materialized=None,
+    project=None,
+):
     with tokenize.open(file) as file_p:
         source = file_p.read()
 
     tree = QLAst.visit(ast.parse(source))
     tree.filename = str(file)
+    if project is not None:
+        tree._project = ProjectReference(project)
 
     ql_state = QLState()
     with connection.transaction():
@@ -144,3 +178,12 @@ def insert_file(connection, file):
             )
             logger.trace("Running post-insert query: %r", update)
             connection.query(update, ids=ql_state.reference_pool)
+
+        add_counts(connection, ql_state.counts, project)
+
+    if source_store is not None:
+        source_store.put(tree.filename, source)
+    if counters is not None:
+        counters.add(ql_state.counts, project=project)
+    if materialized is not None:
+        materialized.add_pending(str(module.id))
@@ -32,6 +32,7 @@ class Sentinel(ast.expr):
 
 ast.Sentinel = Sentinel
 alter_ast(ast.Module, "_fields", "filename")
+alter_ast(ast.Module, "_attributes", "_project")
 alter_ast(ast.slice, "_attributes", "sentinel")
 for sum_type in MODULE_ANNOTATED_TYPES:
     alter_ast(sum_type, "_attributes", "_module")
@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+import mmap
+import os
+import sqlite3
+import threading
+import tokenize
+import zlib
+from array import array
+from collections import OrderedDict, defaultdict
+from contextlib import closing
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from reiz.utilities import get_config_settings
+
+# Files bigger than this are mapped into memory instead of being read.
+MMAP_THRESHOLD = 1024 * 1024
+
+DEFAULT_MAX_FILES = 256
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# SQLite's default limit for the host parameters is 999 on older versions
+STORE_BATCH_SIZE = 500
+
+
+def build_line_offsets(buffer, start=0):
+    offsets = [start]
+    position = start
+    while position := buffer.find(b"\n", position) + 1:
+        offsets.append(position)
+    return offsets
+
+
+@dataclass
+class SourceFile:
+    # UTF-8 encoded source with normalized newlines, either read into
+    # memory or mapped from the disk. Column offsets in the AST are UTF-8
+    # byte offsets, so segments can be sliced directly from the buffer.
+    buffer: Union[bytes, mmap.mmap]
+    line_offsets: List[int]
+    # None for the files that are loaded from the source store, since
+    # they don't need to be checked against the disk.
+    mtime: Optional[int]
+    size: int
+
+    @classmethod
+    def load(cls, filename: str) -> SourceFile:
+        with open(filename, "rb") as stream:
+            encoding, _ = tokenize.detect_encoding(stream.readline)
+            stat = os.fstat(stream.fileno())
+            if stat.st_size >= MMAP_THRESHOLD and encoding in (
+                "utf-8",
+                "utf-8-sig",
+            ):
+                buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+                # Mapped files can't be normalized, so the ones with
+                # the \r newlines are read into the memory.
+                if buffer.find(b"\r") == -1:
+                    start = 3 if encoding == "utf-8-sig" else 0
+                    return cls(
+                        buffer,
+                        build_line_offsets(buffer, start),
+                        stat.st_mtime_ns,
+                        size=0,
+                    )
+                buffer.close()
+
+            stream.seek(0)
+            buffer = stream.read()
+
+        if encoding == "utf-8-sig":
+            buffer = buffer[3:]
+        elif encoding != "utf-8":
+            buffer = buffer.decode(encoding).encode()
+
+        # Same newline translation as tokenize.open() does
+        if b"\r" in buffer:
+            buffer = buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        return cls.from_buffer(buffer, stat.st_mtime_ns)
+
+    @classmethod
+    def from_buffer(
+        cls,
+        buffer: bytes,
+        mtime: Optional[int] = None,
+        line_offsets: Optional[List[int]] = None,
+    ) -> SourceFile:
+        if line_offsets is None:
+            line_offsets = build_line_offsets(buffer)
+        return cls(buffer, line_offsets, mtime, len(buffer))
+
+    @property
+    def is_mapped(self) -> bool:
+        return isinstance(self.buffer, mmap.mmap)
+
+    def is_valid(self) -> bool:
+        # Slicing the pages of a mapped file that is truncated since then
+        # kills the process (SIGBUS), so the mapping is checked against
+        # the current size of the file (size() stats the mapped file
+        # itself) before each slice.
+        if not self.is_mapped:
+            return True
+        elif self.buffer.closed:
+            return False
+        else:
+            return self.buffer.size() >= len(self.buffer)
+
+    def close(self) -> None:
+        if self.is_mapped:
+            self.buffer.close()
+
+    def segment(
+        self,
+        lineno: Optional[int] = None,
+        col_offset: Optional[int] = None,
+        end_lineno: Optional[int] = None,
+        end_col_offset: Optional[int] = None,
+    ) -> str:
+        if not self.is_valid():
+            raise ValueError("the mapped source file has changed")
+
+        if lineno is None:
+            return self.buffer[self.line_offsets[0] :].decode()
+
+        start = self.line_offsets[lineno - 1] + col_offset
+        end = self.line_offsets[end_lineno - 1] + end_col_offset
+        return self.buffer[start:end].decode()
+
+
+class SourceCache:
+    # Bounded LRU cache of source files, invalidated when the file's
+    # modification time changes. The size limit only accounts the files
+    # that are read into memory, mapped files are paged by the OS.
+
+    def __init__(
+        self,
+        max_files: int = DEFAULT_MAX_FILES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ) -> None:
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._files: OrderedDict[str, SourceFile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, filename: str) -> Optional[SourceFile]:
+        with self._lock:
+            source_file = self._files.get(filename)
+        if source_file is None:
+            return None
+
+        if source_file.mtime is not None:
+            try:
+                mtime = os.stat(filename).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != source_file.mtime or not source_file.is_valid():
+                return None
+
+        with self._lock:
+            if filename in self._files:
+                self._files.move_to_end(filename)
+        return source_file
+
+    def add(self, filename: str, source_file: SourceFile) -> None:
+        with self._lock:
+            self._discard(filename)
+            self._files[filename] = source_file
+            self.total_bytes += source_file.size
+            self._evict()
+
+    def get(self, filename: str) -> SourceFile:
+        if source_file := self.lookup(filename):
+            return source_file
+
+        source_file = SourceFile.load(filename)
+        self.add(filename, source_file)
+        return source_file
+
+    def get_many(
+        self, filenames: Iterable[str], store: Optional[SourceStore] = None
+    ) -> Dict[str, SourceFile]:
+        # Cached files first, then a single batched lookup on the store
+        # and the disk for whatever remains.
+        source_files = {}
+        missing = []
+        for filename in filenames:
+            if source_file := self.lookup(filename):
+                source_files[filename] = source_file
+            else:
+                missing.append(filename)
+
+        if store is not None and missing:
+            for filename, source_file in store.get_many(missing).items():
+                self.add(filename, source_file)
+                source_files[filename] = source_file
+
+        for filename in missing:
+            if filename in source_files:
+                continue
+            try:
+                source_files[filename] = self.get(filename)
+            except Exception:
+                continue
+
+        return source_files
+
+    def clear(self) -> None:
+        with self._lock:
+            for source_file in self._files.values():
+                source_file.close()
+            self._files.clear()
+            self.total_bytes = 0
+
+    def _discard(self, filename):
+        if source_file := self._files.pop(filename, None):
+            self.total_bytes -= source_file.size
+            source_file.close()
+
+    def _evict(self):
+        while len(self._files) > 1 and (
+            len(self._files) > self.max_files
+            or self.total_bytes > self.max_bytes
+        ):
+            _, source_file = self._files.popitem(last=False)
+            self.total_bytes -= source_file.size
+            source_file.close()
+
+
+class SourceStore:
+    # Sidecar SQLite database that holds the compressed sources (and
+    # their line offset tables) of the inserted files, so that the API
+    # can render results without having access to the raw data.
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                "filename TEXT PRIMARY KEY, "
+                "source BLOB NOT NULL, "
+                "line_offsets BLOB NOT NULL)"
+            )
+
+    def _connect(self):
+        # Connections are short-lived, so the store can be freely shared
+        # between threads and forked insertion workers.
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def __contains__(self, filename: str) -> bool:
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "SELECT 1 FROM sources WHERE filename = ?", (filename,)
+            )
+            return cursor.fetchone() is not None
+
+    def put(self, filename: str, source: str) -> None:
+        # The source is expected to be read with tokenize.open(), which
+        # already strips the BOM and normalizes the newlines.
+        buffer = source.encode()
+        line_offsets = array("I", build_line_offsets(buffer))
+        with self._connect() as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                (
+                    filename,
+                    zlib.compress(buffer),
+                    zlib.compress(line_offsets.tobytes()),
+                ),
+            )
+
+    def put_file(self, filename: str) -> None:
+        with tokenize.open(filename) as file:
+            self.put(filename, file.read())
+
+    def get_many(self, filenames: Iterable[str]) -> Dict[str, SourceFile]:
+        filenames = list(filenames)
+        source_files = {}
+        with self._connect() as connection:
+            for start in range(0, len(filenames), STORE_BATCH_SIZE):
+                batch = filenames[start : start + STORE_BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                cursor = connection.execute(
+                    "SELECT filename, source, line_offsets FROM sources "
+                    f"WHERE filename IN ({placeholders})",
+                    batch,
+                )
+                for filename, source, raw_offsets in cursor:
+                    line_offsets = array("I")
+                    line_offsets.frombytes(zlib.decompress(raw_offsets))
+                    source_files[filename] = SourceFile.from_buffer(
+                        zlib.decompress(source), line_offsets=line_offsets
+                    )
+        return source_files
+
+
+def get_source_store_path() -> Optional[Path]:
+    if path := get_config_settings().get("source_store"):
+        return Path(path).expanduser()
+    else:
+        return None
+
+
+@lru_cache(1)
+def get_source_store() -> Optional[SourceStore]:
+    if path := get_source_store_path():
+        return SourceStore(path)
+    else:
+        return None
+
+
+SOURCE_CACHE = SourceCache()
+
+
+def fetch_segments(
+    locations: Iterable[Dict[str, Any]],
+    cache: SourceCache = SOURCE_CACHE,
+    store: Optional[SourceStore] = None,
+) -> List[Optional[str]]:
+    # Group the locations per file, so that each file is looked up once
+    # no matter how many results it has.
+    locations = list(locations)
+    segments: List[Optional[str]] = [None] * len(locations)
+
+    groups = defaultdict(list)
+    for index, location in enumerate(locations):
+        groups[location["filename"]].append(index)
+
+    source_files = cache.get_many(groups.keys(), store)
+    for filename, indices in groups.items():
+        if not (source_file := source_files.get(filename)):
+            continue
+
+        for index in indices:
+            location = locations[index].copy()
+            del location["filename"]
+            try:
+                segments[index] = source_file.segment(**location)
+            except Exception:
+                continue
+
+    return segments
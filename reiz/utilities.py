@@ -2,13 +2,19 @@ import builtins
 import contextlib
 import json
 import logging
+import time
 from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from functools import partialmethod
+from functools import lru_cache, partialmethod
 from pathlib import Path
-from typing import ContextManager, List
+from typing import ContextManager, Dict, List, Optional
 
-from reiz.db.connection import DEFAULT_DATABASE, DEFAULT_DSN
+from reiz.db.connection import (
+    DEFAULT_DATABASE,
+    DEFAULT_DSN,
+    resolve_readers,
+    resolve_shards,
+)
 
 DEFAULT_CONFIG_PATH = Path("~/.local/reiz.json").expanduser()
 
@@ -39,6 +45,18 @@ def get_executor(workers: int) -> ContextManager:
     return executor
 
 
+@contextlib.contextmanager
+def timed(timings: Optional[Dict[str, float]], phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = (
+                timings.get(phase, 0.0) + time.perf_counter() - start
+            )
+
+
 def read_config(config: Path) -> List[str]:
     if config.exists():
         with open(config) as config_f:
@@ -53,6 +71,7 @@ def write_config(config: Path, data: List[str]) -> None:
         json.dump(data, config)
 
 
+@lru_cache(1)
 def get_config_settings():
     if DEFAULT_CONFIG_PATH.exists():
         with open(DEFAULT_CONFIG_PATH) as file:
@@ -61,13 +80,40 @@ def get_config_settings():
         return {}
 
 
+@lru_cache(1)
 def get_db_settings():
     if config := get_config_settings():
-        return config["db"]
+        # Only the writer, see get_reader_settings()
+        return {
+            key: value
+            for key, value in config["db"].items()
+            if key != "readers"
+        }
     else:
         return {"dsn": DEFAULT_DSN, "database": DEFAULT_DATABASE}
 
 
+@lru_cache(1)
+def get_shard_settings():
+    # {"db": {...}, "shards": ["reiz_0", "reiz_1"]}
+    return resolve_shards(
+        **get_db_settings(), shards=get_config_settings().get("shards")
+    )
+
+
+@lru_cache(1)
+def get_reader_settings():
+    # {"db": {..., "readers": ["edgedb://replica_1/", ...]}}; only the
+    # queries of the API are served by the readers, everything else (e.g.
+    # the ingestion) connects to the writers.
+    config = get_config_settings()
+    return resolve_readers(
+        get_db_settings()["database"],
+        shards=config.get("shards"),
+        readers=config.get("db", {}).get("readers"),
+    )
+
+
 class ReizEnum(Enum):
     # normal __repr__: <$cls.$name: $value>
     # ReizEnum __repr__: $cls.$name
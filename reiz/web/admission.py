@@ -0,0 +1,69 @@
+import math
+from dataclasses import dataclass
+
+from reiz.fetch import DEFAULT_SAMPLE_FRACTION
+from reiz.utilities import get_config_settings
+
+# The costs are in the units of reiz.edgeql.cost.QueryCost.total (roughly,
+# the number of filter evaluations). Queries within the budget run right
+# away, the ones above it are either deferred, downgraded to a sampled
+# count or rejected.
+DEFAULT_BUDGET = 10**9
+DEFAULT_MAX_COST = 10**11
+
+# Clients are charged by the estimated cost of their queries rather than
+# by their number; a query that costs less than a single unit is charged
+# as one.
+DEFAULT_COST_UNIT = 10**7
+QUERY_COST_LIMIT = "240 per hour"
+
+RUN = "run"
+DEFER = "defer"
+APPROXIMATE = "approximate"
+REJECT = "reject"
+
+
+@dataclass
+class AdmissionPolicy:
+    budget: float = DEFAULT_BUDGET
+    max_cost: float = DEFAULT_MAX_COST
+    cost_unit: float = DEFAULT_COST_UNIT
+
+    @classmethod
+    def from_config(cls):
+        options = get_config_settings().get("admission", {})
+        return cls(
+            budget=options.get("budget", DEFAULT_BUDGET),
+            max_cost=options.get("max_cost", DEFAULT_MAX_COST),
+            cost_unit=options.get("cost_unit", DEFAULT_COST_UNIT),
+        )
+
+    def admit(self, cost, stats=False, defer=False, approximate=False):
+        sampled_cost = cost * DEFAULT_SAMPLE_FRACTION
+        if stats and approximate and sampled_cost <= self.budget:
+            return APPROXIMATE
+        elif cost <= self.budget:
+            return RUN
+        elif defer and cost <= self.max_cost:
+            return DEFER
+        elif stats and sampled_cost <= self.budget:
+            return APPROXIMATE
+        else:
+            return REJECT
+
+    def admit_job(self, cost):
+        return cost <= self.max_cost
+
+    def charge(self, cost, decision=RUN):
+        if decision == APPROXIMATE:
+            cost *= DEFAULT_SAMPLE_FRACTION
+        elif decision == REJECT:
+            cost = 0
+        return max(1, math.ceil(cost / self.cost_unit))
+
+
+def rejection_message(cost, budget):
+    return (
+        f"Query is too expensive (estimated cost: {cost:.0f}, "
+        f"allowed: {budget:.0f})"
+    )
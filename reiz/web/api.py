@@ -1,151 +1,336 @@
 import atexit
 import json
-import traceback
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
+from functools import partial
 
-import edgedb
 import redis
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits import parse
 
-from reiz.edgeql import as_edgeql
-from reiz.fetch import get_stats, run_query
-from reiz.reizql import ReizQLSyntaxError, compile_edgeql, parse_query
-from reiz.utilities import get_config_settings, normalize
+from reiz.cache import ResultCache
+from reiz.db.pool import close_pools, get_pool_metrics
+from reiz.fetch import (
+    approximate_count,
+    estimate_query,
+    get_stats,
+    run_query,
+    stream_query,
+)
+from reiz.reizql import ReizQLSyntaxError
+from reiz.utilities import get_config_settings, logger, timed
+from reiz.web.admission import QUERY_COST_LIMIT, AdmissionPolicy
+from reiz.web.coalescing import RedisSingleFlight, SingleFlight
+from reiz.web.common import (
+    JOB_RATE_LIMIT,
+    QUERY_RATE_LIMIT,
+    STATS_RATE_LIMIT,
+    STREAM_RATE_LIMIT,
+    analyze_query,
+    error_payload,
+    find_missing_key,
+    load_cost_statistics,
+    parse_stream_request,
+    syntax_error_payload,
+)
+from reiz.web.jobs import get_job_manager
+from reiz.web.metrics import (
+    StateCollector,
+    format_server_timing,
+    observe_request,
+    render_metrics,
+    uses_server_timing,
+)
+from reiz.web.querylog import QueryLog
+from reiz.web.service import (
+    QueryBackend,
+    describe_query_error,
+    handle_job,
+    handle_query,
+    handle_stats,
+    handle_submit,
+    run_blocking,
+    run_cached_query,
+    stream_error_payload,
+)
+from reiz.web.warmup import start_warmup
 
 CACHING = None
+FLIGHTS = None
+JOBS = None
+ADMISSION = AdmissionPolicy.from_config()
+
+# Exact counts that are computed after returning an approximate one
+REFINEMENTS = ThreadPoolExecutor(max_workers=2)
+PENDING_REFINEMENTS = set()
 
 
 def get_app():
-    global CACHING
+    global CACHING, FLIGHTS, JOBS
     app = Flask(__name__)
     CORS(app)
 
     extras = {}
     if redis_url := get_config_settings().get("redis"):
         extras["storage_uri"] = redis_url
-        CACHING = redis.from_url(redis_url)
-        atexit.register(CACHING.close)
+        client = redis.from_url(redis_url)
+        atexit.register(client.close)
+        CACHING = ResultCache.from_config(client)
+        FLIGHTS = RedisSingleFlight(client, describe=describe_query_error)
+        JOBS = get_job_manager(client)
+    else:
+        FLIGHTS = SingleFlight()
+        JOBS = get_job_manager()
 
+    atexit.register(close_pools)
     limiter = Limiter(app, key_func=get_remote_address, **extras)
+    start_warmup(CACHING)
     return app, limiter
 
 
 app, limiter = get_app()
+SERVER_TIMING = uses_server_timing()
+QUERY_LOG = QueryLog.from_config()
 
 
-def run_cached_query(reiz_ql):
-    if results := CACHING.get(reiz_ql):
-        return json.loads(results)
-    else:
-        results = run_query(reiz_ql)
-        CACHING.set(reiz_ql, json.dumps(results))
-        return results
+def get_cache_metrics():
+    if CACHING is not None:
+        return CACHING.get_metrics()
+
+
+METRICS = StateCollector(get_cache_metrics, get_pool_metrics)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    g.timings = {}
+
+
+@app.after_request
+def record_timings(response):
+    duration = time.perf_counter() - g.started
+    observe_request(request.endpoint, duration, g.timings)
+    if QUERY_LOG is not None and (entry := g.get("logged_query")):
+        QUERY_LOG.record(entry, response.status_code, duration, g.timings)
+    if SERVER_TIMING and g.timings:
+        response.headers["Server-Timing"] = format_server_timing(g.timings)
+    return response
+
+
+def run_query_request(request, timings=None):
+    return run_query(
+        request.reiz_ql,
+        stats=request.stats,
+        limit=request.limit,
+        cursor=request.cursor,
+        timings=timings,
+        scope=request.scope,
+        progressive=request.progressive,
+    )
+
+
+def refine_count(request):
+    try:
+        run_blocking(run_cached_query(BACKEND, request))
+    except Exception:
+        logger.exception(
+            "couldn't compute the exact count of %r", request.reiz_ql
+        )
+    finally:
+        PENDING_REFINEMENTS.discard(request.key)
+
+
+def charge_query(units):
+    if not limiter.enabled:
+        return True
+    return limiter.limiter.hit(
+        parse(QUERY_COST_LIMIT), "query-cost", get_remote_address(), cost=units
+    )
+
+
+class BlockingBackend(QueryBackend):
+    # See reiz.web.service; the module globals are looked up on each call
+    # since they are only set up by get_app().
+
+    @property
+    def admission(self):
+        return ADMISSION
+
+    @property
+    def caching(self):
+        return CACHING
+
+    async def cache_get(self, key):
+        return CACHING.get(key)
+
+    async def cache_set(self, key, value):
+        CACHING.set(key, value)
+
+    async def charge(self, units):
+        return charge_query(units)
+
+    async def estimate(self, request):
+        return estimate_query(
+            request.reiz_ql,
+            request.stats,
+            request.limit,
+            request.cursor,
+            request.scope,
+            request.progressive,
+        )
+
+    async def run(self, request, timings=None):
+        # Identical queries that arrive at the same time (e.g. a shared
+        # link) are only executed once, and all of them receive the same
+        # result.
+        key = request.key
+        if CACHING is None:
+            return FLIGHTS.do(
+                key, partial(run_query_request, request, timings)
+            )
+
+        def execute():
+            results = run_query_request(request, timings)
+            with timed(timings, "cache"):
+                CACHING.set(key, results)
+            return results
+
+        return FLIGHTS.do(key, execute, partial(CACHING.get, key))
+
+    async def approximate(self, request, timings=None):
+        return FLIGHTS.do(
+            "approximate:" + request.as_count().key,
+            lambda: asdict(
+                approximate_count(
+                    request.reiz_ql, timings=timings, scope=request.scope
+                )
+            ),
+        )
+
+    def refine(self, request):
+        request = request.as_count()
+        if request.key not in PENDING_REFINEMENTS:
+            PENDING_REFINEMENTS.add(request.key)
+            REFINEMENTS.submit(refine_count, request)
+
+    async def submit(self, reiz_ql, stats, limit, scope=None):
+        return JOBS.submit(reiz_ql, stats=stats, limit=limit, scope=scope)
+
+    async def get_job(self, job_id):
+        return JOBS.get(job_id)
+
+    async def get_job_page(self, job_id, offset, limit):
+        return JOBS.get_page(job_id, offset, limit)
+
+    async def get_stats(self, nodes, project):
+        return get_stats(nodes, project)
+
+
+BACKEND = BlockingBackend()
 
 
 def validate_keys(*keys):
-    for key in keys:
-        if key not in request.json.keys():
-            return key
+    return find_missing_key(request.json, *keys)
+
+
+def error_response(exception, code, **extras):
+    return jsonify(error_payload(exception, **extras)), code
+
+
+def make_response(reply, timings=None):
+    with timed(timings, "encode"):
+        response = jsonify(reply.payload)
+    response.status_code = reply.status
+    response.headers.update(reply.headers)
+    return response
 
 
 @app.route("/query", methods=["POST"])
-@limiter.limit("240 per hour")
 def query():
+    reply = run_blocking(
+        handle_query(BACKEND, request.get_json(silent=True), g.timings)
+    )
+    g.logged_query = reply.logged
+    return make_response(reply, g.timings)
+
+
+@app.route("/query/stream", methods=["POST"])
+@limiter.limit(STREAM_RATE_LIMIT)
+def query_stream():
     if key := validate_keys("query"):
-        return (
-            jsonify(
-                {
-                    "status": "error",
-                    "results": [],
-                    "exception": f"Missing key {key}",
-                }
-            ),
-            412,
-        )
+        return error_response(f"Missing key {key}", 412)
 
-    reiz_ql = request.json["query"]
     try:
-        if stats := request.json.get("stats", False) or not CACHING:
-            results = run_query(reiz_ql, stats=stats)
-        else:
-            results = run_cached_query(reiz_ql)
-    except ReizQLSyntaxError as syntax_err:
-        error = {
-            "status": "error",
-            "results": [],
-            "exception": syntax_err.message,
-        }
-        if syntax_err.position:
-            error.update(syntax_err.position)
-        return jsonify(error), 422
-    except edgedb.errors.InvalidReferenceError as exc:
-        return (
-            jsonify(
-                {
-                    "status": "error",
-                    "results": [],
-                    "exception": exc.args[0],
-                }
-            ),
-            412,
-        )
-    except Exception:
-        return (
-            jsonify(
-                {
-                    "status": "error",
-                    "results": [],
-                    "exception": traceback.format_exc(),
-                }
-            ),
-            412,
-        )
-    else:
-        return (
-            jsonify(
-                {"status": "success", "results": results, "exception": None}
-            ),
-            200,
+        stream_request = parse_stream_request(request.json)
+        results = stream_query(
+            stream_request.reiz_ql,
+            limit=stream_request.limit,
+            cursor=stream_request.cursor,
+            scope=stream_request.scope,
         )
+    except ReizQLSyntaxError as syntax_err:
+        return jsonify(syntax_error_payload(syntax_err)), 422
+    except ValueError as exc:
+        return error_response(exc.args[0], 412)
+
+    def generate():
+        try:
+            for result in results:
+                yield json.dumps(result) + "\n"
+        except Exception as exc:
+            yield json.dumps(stream_error_payload(exc)) + "\n"
+
+    return Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
+
+
+@app.route("/query/submit", methods=["POST"])
+@limiter.limit(JOB_RATE_LIMIT)
+def query_submit():
+    reply = run_blocking(handle_submit(BACKEND, request.get_json(silent=True)))
+    return make_response(reply)
+
+
+@app.route("/query/<job_id>", methods=["GET"])
+def query_job(job_id):
+    reply = run_blocking(handle_job(BACKEND, job_id, request.args))
+    return make_response(reply)
 
 
 @app.route("/stats", methods=["GET"])
-@limiter.limit("4 per hour")
+@limiter.limit(STATS_RATE_LIMIT)
 def stats():
-    return jsonify(get_stats()), 200
+    reply = run_blocking(handle_stats(BACKEND, request.args))
+    return make_response(reply)
+
+
+@app.route("/cache", methods=["GET"])
+def cache():
+    if CACHING is None:
+        return jsonify({}), 200
+    return jsonify(CACHING.get_metrics()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    body, content_type = render_metrics(METRICS)
+    return Response(body, content_type=content_type)
 
 
 @app.route("/analyze", methods=["POST"])
-@limiter.limit("240 per hour")
+@limiter.limit(QUERY_RATE_LIMIT)
 def analyze():
     if key := validate_keys("query"):
-        return (
-            jsonify(
-                {
-                    "status": "error",
-                    "results": [],
-                    "exception": f"Missing key {key}",
-                }
-            ),
-            412,
-        )
-
-    results = dict.fromkeys(("exception", "reiz_ql", "edge_ql"))
-    try:
-        reiz_ql = parse_query(request.json["query"])
-        results["reiz_ql"] = normalize(asdict(reiz_ql))
-        results["edge_ql"] = as_edgeql(compile_edgeql(reiz_ql))
-    except ReizQLSyntaxError as syntax_err:
-        results["status"] = "error"
-        results["exception"] = syntax_err.message
-        results.update(syntax_err.position)
-    else:
-        results["status"] = "success"
+        return error_response(f"Missing key {key}", 412)
 
-    return jsonify(results), 200
+    statistics = load_cost_statistics()
+    return jsonify(analyze_query(request.json["query"], statistics)), 200
 
 
 if __name__ == "__main__":
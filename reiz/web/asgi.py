@@ -0,0 +1,734 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from functools import partial, wraps
+
+import redis
+import redis.asyncio
+from limits import parse
+from limits.aio.strategies import FixedWindowRateLimiter
+from limits.storage import storage_from_string
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from reiz.cache import AsyncResultCache
+from reiz.counters import (
+    TOTAL,
+    AsyncDatabaseCounters,
+    get_counters_path,
+    get_node_counters,
+)
+from reiz.db.connection import create_async_pool, get_shard_index
+from reiz.db.pool import AsyncShardPool
+from reiz.db.timeouts import (
+    get_query_timeout,
+    query_with_deadline,
+    timeout_error,
+)
+from reiz.fetch import (
+    DEFAULT_LIMIT,
+    DEFAULT_NODES,
+    DEFAULT_SAMPLE_FRACTION,
+    STREAM_BATCH_SIZE,
+    cache_cost_statistics,
+    cache_projects,
+    combine_estimates,
+    compile_sampled_count,
+    estimate_count,
+    estimate_query,
+    fetch_materialized,
+    gather_results,
+    get_cached_cost_statistics,
+    get_cached_module_sample,
+    get_cached_projects,
+    get_materializations,
+    get_module_ids_query,
+    get_next_cursor,
+    get_progressive_workers,
+    get_projects_query,
+    get_query_args,
+    get_query_shards,
+    get_stats_query,
+    is_partitioned,
+    parse_cursor,
+    prepare_query,
+    render_results,
+    sample_modules,
+)
+from reiz.reizql import ReizQLSyntaxError, parse_query
+from reiz.utilities import (
+    get_config_settings,
+    get_reader_settings,
+    get_shard_settings,
+    logger,
+    timed,
+)
+from reiz.web.admission import QUERY_COST_LIMIT, AdmissionPolicy
+from reiz.web.coalescing import AsyncRedisSingleFlight, AsyncSingleFlight
+from reiz.web.common import (
+    COST_ERRORS,
+    JOB_RATE_LIMIT,
+    QUERY_RATE_LIMIT,
+    STATS_RATE_LIMIT,
+    STREAM_RATE_LIMIT,
+    analyze_query,
+    parse_stream_request,
+    syntax_error_payload,
+)
+from reiz.web.jobs import get_job_manager
+from reiz.web.metrics import (
+    StateCollector,
+    format_server_timing,
+    observe_request,
+    render_metrics,
+    uses_server_timing,
+)
+from reiz.web.querylog import QueryLog
+from reiz.web.service import (
+    QueryBackend,
+    Reply,
+    check_payload,
+    describe_query_error,
+    error_reply,
+    handle_job,
+    handle_query,
+    handle_stats,
+    handle_submit,
+    query_error_reply,
+    run_cached_query,
+    stream_error_payload,
+)
+from reiz.web.warmup import start_warmup
+
+# Unlike the WSGI app, the in-flight queries only hold a connection
+# while they are waiting for the database, so the pool can be a lot
+# bigger than the number of gunicorn workers.
+DEFAULT_POOL_SIZE = 64
+
+# Parsing, compiling and rendering the results are CPU bound, so they
+# run on a small executor to keep the event loop responsive.
+DEFAULT_EXECUTOR_WORKERS = 4
+
+
+@asynccontextmanager
+async def lifespan(app):
+    config = get_config_settings()
+    options = config.get("asgi", {})
+    state = app.state
+
+    # One pool for each shard, see reiz.utilities.get_shard_settings. The
+    # readers' pools start empty, so that an unreachable replica doesn't
+    # prevent the app from starting (it is skipped when queried instead).
+    pool_size = options.get("pool_size", DEFAULT_POOL_SIZE)
+    state.pools = [
+        AsyncShardPool(
+            await create_async_pool(**settings, max_size=pool_size),
+            [
+                await create_async_pool(
+                    **reader, min_size=0, max_size=pool_size
+                )
+                for reader in readers
+            ],
+            shard=shard,
+        )
+        for shard, (settings, readers) in enumerate(
+            zip(get_shard_settings(), get_reader_settings())
+        )
+    ]
+    # The node counters are read through the same pools, unless there is
+    # a local copy of them (see reiz.counters.NodeCounters).
+    if get_counters_path() is None:
+        state.counters = AsyncDatabaseCounters(state.pools)
+    else:
+        state.counters = None
+    state.executor = ThreadPoolExecutor(
+        max_workers=options.get("executor_workers", DEFAULT_EXECUTOR_WORKERS)
+    )
+    state.stats = None
+    state.refinements = {}
+    state.admission = AdmissionPolicy.from_config()
+    state.server_timing = uses_server_timing()
+    state.query_log = QueryLog.from_config()
+
+    if redis_url := config.get("redis"):
+        client = redis.asyncio.from_url(redis_url)
+        state.caching = AsyncResultCache.from_config(client)
+        state.flights = AsyncRedisSingleFlight(
+            client, describe=describe_query_error
+        )
+        # Jobs run on their own threads, so they use a blocking client
+        state.jobs = get_job_manager(redis.from_url(redis_url))
+        storage = storage_from_string("async+" + redis_url)
+    else:
+        state.caching = None
+        state.flights = AsyncSingleFlight()
+        state.jobs = get_job_manager()
+        storage = storage_from_string("async+memory://")
+    state.limiter = FixedWindowRateLimiter(storage)
+    state.metrics = StateCollector(
+        partial(get_cache_metrics, state), partial(get_pool_metrics, state)
+    )
+    # The warmup goes through the blocking pool and cache client on its
+    # own thread, it only shares the results (through redis) with the app.
+    start_warmup()
+
+    try:
+        yield
+    finally:
+        if state.caching is not None:
+            await state.caching.client.aclose()
+        state.executor.shutdown(wait=False)
+        state.jobs.executor.shutdown(wait=False)
+        for pool in state.pools:
+            await pool.aclose()
+
+
+def get_cache_metrics(state):
+    if state.caching is not None:
+        return state.caching.get_metrics()
+
+
+def get_pool_metrics(state):
+    return {
+        "max_size": sum(pool.get_max_size() for pool in state.pools),
+        "idle": sum(pool.get_free_size() for pool in state.pools),
+    }
+
+
+def instrumented(endpoint):
+    @wraps(endpoint)
+    async def instrumented_endpoint(request):
+        started = time.perf_counter()
+        timings = request.state.timings = {}
+        response = await endpoint(request)
+
+        state = request.app.state
+        duration = time.perf_counter() - started
+        observe_request(endpoint.__name__, duration, timings)
+        if state.query_log is not None and (
+            entry := getattr(request.state, "logged_query", None)
+        ):
+            state.query_log.record(
+                entry, response.status_code, duration, timings
+            )
+        if state.server_timing and timings:
+            response.headers["Server-Timing"] = format_server_timing(timings)
+        return response
+
+    return instrumented_endpoint
+
+
+async def run_sync(request, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        request.app.state.executor, partial(func, *args, **kwargs)
+    )
+
+
+def rate_limited(limit):
+    rate_limit = parse(limit)
+
+    def wrapper(endpoint):
+        @wraps(endpoint)
+        async def limited_endpoint(request):
+            limiter = request.app.state.limiter
+            if not await limiter.hit(
+                rate_limit, endpoint.__name__, request.client.host
+            ):
+                return make_response(
+                    error_reply(f"Rate limit exceeded: {limit}", 429)
+                )
+            return await endpoint(request)
+
+        return limited_endpoint
+
+    return wrapper
+
+
+async def get_payload(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def execute_query(
+    request,
+    reiz_ql,
+    stats=False,
+    limit=DEFAULT_LIMIT,
+    cursor=None,
+    timings=None,
+    scope=None,
+    progressive=False,
+    timeout=None,
+):
+    if cursor is not None:
+        cursor = parse_cursor(cursor)
+    if timeout is None:
+        timeout = get_query_timeout("stats" if stats else "query")
+
+    partitioned = is_partitioned(stats, cursor, scope, progressive)
+    prepared = await run_sync(
+        request,
+        prepare_query,
+        reiz_ql,
+        stats,
+        limit,
+        cursor,
+        timings,
+        scope,
+        partitioned,
+    )
+    tree, query = prepared.tree, prepared.query
+
+    # The materializations are stored in SQLite, so they are only read on
+    # the executor when they are configured.
+    results = None
+    if get_materializations(scope) is not None:
+        with timed(timings, "materialized"):
+            results = await run_sync(
+                request, fetch_materialized, tree, stats, limit, cursor, scope
+            )
+    if results is not None:
+        return results
+    elif partitioned:
+        return await execute_partitions(
+            request, tree, query, limit, timings, scope, timeout
+        )
+
+    # See reiz.fetch.query_shards
+    pools = request.app.state.pools
+    method = "query_one" if stats else "query"
+
+    async def query_shard(shard):
+        sample = await get_sampled_modules(pools[shard], scope, shard)
+        return await query_with_deadline(
+            pools[shard],
+            method,
+            query,
+            timeout,
+            **get_query_args(cursor, sample),
+        )
+
+    with timed(timings, "db"):
+        results = await asyncio.gather(
+            *map(query_shard, get_query_shards(scope))
+        )
+    if stats:
+        return sum(results)
+
+    with timed(timings, "fetch"):
+        return await run_sync(
+            request, render_results, tree, gather_results(results, limit)
+        )
+
+
+async def get_projects(pools):
+    if (projects := get_cached_projects()) is not None:
+        return projects
+
+    query_sets = await asyncio.gather(
+        *(pool.query(get_projects_query()) for pool in pools)
+    )
+    return cache_projects(query_sets)
+
+
+async def execute_partitions(
+    request, tree, query, limit, timings=None, scope=None, timeout=None
+):
+    # See reiz.fetch.fetch_partitions
+    pools = request.app.state.pools
+    with timed(timings, "db"):
+        projects = await get_projects(pools)
+    workers = asyncio.Semaphore(get_progressive_workers())
+
+    async def fetch_partition(project):
+        shard = get_shard_index(project, len(pools))
+        async with workers:
+            sample = await get_sampled_modules(pools[shard], scope, shard)
+            return await query_with_deadline(
+                pools[shard],
+                "query",
+                query,
+                timeout,
+                **get_query_args(sample=sample, project=project),
+            )
+
+    tasks = [asyncio.ensure_future(fetch_partition(p)) for p in projects]
+
+    async def collect():
+        query_set = []
+        for partition in asyncio.as_completed(tasks):
+            query_set.extend(await partition)
+            if limit is not None and len(query_set) >= limit:
+                break
+        return query_set
+
+    try:
+        with timed(timings, "db"):
+            query_set = await asyncio.wait_for(collect(), timeout)
+    except asyncio.TimeoutError as exc:
+        raise timeout_error(timeout) from exc
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    with timed(timings, "fetch"):
+        return await run_sync(request, render_results, tree, query_set[:limit])
+
+
+async def stream_pages(request, query, batch_size=STREAM_BATCH_SIZE):
+    # See reiz.fetch.stream_query; each page is only fetched once the
+    # client has consumed the previous one, and has its own timeout.
+    limit, cursor = query.limit, query.cursor
+    timeout = get_query_timeout("stream")
+    while limit is None or limit > 0:
+        size = batch_size if limit is None else min(batch_size, limit)
+        results = await execute_query(
+            request,
+            query.reiz_ql,
+            limit=size,
+            cursor=cursor,
+            scope=query.scope,
+            timeout=timeout,
+        )
+        yield results
+
+        if not (cursor := get_next_cursor(results, size)):
+            break
+        if limit is not None:
+            limit -= len(results)
+
+
+async def get_module_sample(
+    pool, fraction=DEFAULT_SAMPLE_FRACTION, seed=None, shard=0
+):
+    if sample := get_cached_module_sample(fraction, seed, shard):
+        return sample
+
+    modules = await pool.query(get_module_ids_query())
+    return sample_modules(
+        [str(module.id) for module in modules], fraction, seed, shard
+    )
+
+
+async def get_sampled_modules(pool, scope, shard=0):
+    # See reiz.fetch.get_sampled_modules
+    if scope is None or scope.sample is None:
+        return None
+
+    module_ids, _ = await get_module_sample(
+        pool, scope.sample, scope.seed, shard
+    )
+    return module_ids
+
+
+async def estimate_approximate_count(
+    request, reiz_ql, timings=None, scope=None
+):
+    # See reiz.fetch.approximate_count
+    state = request.app.state
+    with timed(timings, "parse"):
+        tree = await run_sync(request, parse_query, reiz_ql)
+    with timed(timings, "compile"):
+        query = await run_sync(request, compile_sampled_count, tree, scope)
+
+    async def estimate_shard(shard):
+        pool = state.pools[shard]
+        module_ids, population = await get_module_sample(pool, shard=shard)
+        sample = await get_sampled_modules(pool, scope, shard)
+        counts = await query_with_deadline(
+            pool,
+            "query",
+            query,
+            get_query_timeout("approximate"),
+            modules=module_ids,
+            **get_query_args(sample=sample),
+        )
+        return estimate_count(list(counts), population)
+
+    with timed(timings, "db"):
+        estimates = await asyncio.gather(
+            *map(estimate_shard, get_query_shards(scope))
+        )
+    return combine_estimates(estimates)
+
+
+async def read_counters(request, method, *args):
+    # The local copy of the counters is read on the executor
+    if (counters := request.app.state.counters) is not None:
+        return await getattr(counters, method)(*args)
+    else:
+        counters = get_node_counters()
+        return await run_sync(request, getattr(counters, method), *args)
+
+
+async def get_cost_statistics(request):
+    # See reiz.fetch.get_cost_statistics
+    if (statistics := get_cached_cost_statistics()) is not None:
+        return statistics
+
+    counts = await read_counters(request, "get_all")
+    return await run_sync(request, cache_cost_statistics, counts)
+
+
+async def load_cost_statistics(request):
+    # See reiz.web.common.load_cost_statistics
+    try:
+        return await get_cost_statistics(request)
+    except COST_ERRORS as exc:
+        logger.warning("couldn't load the cost statistics: %r", exc)
+        return None
+
+
+async def get_stats(request, nodes, project):
+    # See reiz.fetch.get_stats
+    state = request.app.state
+    if not (
+        nodes == DEFAULT_NODES
+        and project == TOTAL
+        and await read_counters(request, "is_empty")
+    ):
+        return await read_counters(request, "get", nodes, project)
+
+    if state.stats is None:
+        shard_counts = await asyncio.gather(
+            *(
+                pool.query(get_stats_query(DEFAULT_NODES))
+                for pool in state.pools
+            )
+        )
+        state.stats = dict(zip(DEFAULT_NODES, map(sum, zip(*shard_counts))))
+    return state.stats
+
+
+class AsyncBackend(QueryBackend):
+    # See reiz.web.service; one for each request, on top of the app state.
+
+    def __init__(self, request):
+        self.request = request
+        self.state = request.app.state
+        self.admission = self.state.admission
+        self.caching = self.state.caching
+
+    async def cache_get(self, key):
+        return await self.caching.get(key)
+
+    async def cache_set(self, key, value):
+        await self.caching.set(key, value)
+
+    async def charge(self, units):
+        return await self.state.limiter.hit(
+            parse(QUERY_COST_LIMIT),
+            "query-cost",
+            self.request.client.host,
+            cost=units,
+        )
+
+    async def estimate(self, request):
+        statistics = await get_cost_statistics(self.request)
+        return await run_sync(
+            self.request,
+            estimate_query,
+            request.reiz_ql,
+            request.stats,
+            request.limit,
+            request.cursor,
+            request.scope,
+            request.progressive,
+            statistics,
+        )
+
+    async def run(self, request, timings=None):
+        # Identical queries that arrive at the same time are only executed
+        # once, see reiz.web.api.BlockingBackend.run
+        key = request.key
+        flights = self.state.flights
+
+        async def execute():
+            results = await execute_query(
+                self.request,
+                request.reiz_ql,
+                stats=request.stats,
+                limit=request.limit,
+                cursor=request.cursor,
+                timings=timings,
+                scope=request.scope,
+                progressive=request.progressive,
+            )
+            if self.caching is not None:
+                with timed(timings, "cache"):
+                    await self.caching.set(key, results)
+            return results
+
+        if self.caching is None:
+            return await flights.do(key, execute)
+        else:
+            return await flights.do(
+                key, execute, partial(self.caching.get, key)
+            )
+
+    async def approximate(self, request, timings=None):
+        async def execute():
+            estimate = await estimate_approximate_count(
+                self.request, request.reiz_ql, timings, request.scope
+            )
+            return asdict(estimate)
+
+        return await self.state.flights.do(
+            "approximate:" + request.as_count().key, execute
+        )
+
+    def refine(self, request):
+        request = request.as_count()
+        refinements = self.state.refinements
+        if request.key in refinements:
+            return None
+
+        task = asyncio.create_task(run_cached_query(self, request))
+        refinements[request.key] = task
+        task.add_done_callback(lambda _: refinements.pop(request.key, None))
+
+    async def submit(self, reiz_ql, stats, limit, scope=None):
+        return await run_sync(
+            self.request, self.state.jobs.submit, reiz_ql, stats, limit, scope
+        )
+
+    async def get_job(self, job_id):
+        return await run_sync(self.request, self.state.jobs.get, job_id)
+
+    async def get_job_page(self, job_id, offset, limit):
+        return await run_sync(
+            self.request, self.state.jobs.get_page, job_id, offset, limit
+        )
+
+    async def get_stats(self, nodes, project):
+        return await get_stats(self.request, nodes, project)
+
+
+def make_response(reply, timings=None):
+    with timed(timings, "encode"):
+        response = JSONResponse(reply.payload, reply.status)
+    response.headers.update(reply.headers)
+    return response
+
+
+async def query(request):
+    payload = await get_payload(request)
+    timings = request.state.timings
+    reply = await handle_query(AsyncBackend(request), payload, timings)
+    request.state.logged_query = reply.logged
+    return make_response(reply, timings)
+
+
+@rate_limited(STREAM_RATE_LIMIT)
+async def query_stream(request):
+    payload = await get_payload(request)
+    if error := check_payload(payload, "query"):
+        return make_response(error)
+
+    try:
+        pages = stream_pages(request, parse_stream_request(payload))
+        # The first page is fetched before responding, so that its errors
+        # (e.g. syntax errors) still get their own status codes.
+        first_page = await pages.__anext__()
+    except ReizQLSyntaxError as syntax_err:
+        return make_response(Reply(syntax_error_payload(syntax_err), 422))
+    except ValueError as exc:
+        return make_response(error_reply(exc.args[0], 412))
+    except Exception as exc:
+        return make_response(query_error_reply(exc))
+
+    async def generate():
+        try:
+            for result in first_page:
+                yield json.dumps(result) + "\n"
+            async for page in pages:
+                for result in page:
+                    yield json.dumps(result) + "\n"
+        except Exception as exc:
+            yield json.dumps(stream_error_payload(exc)) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@rate_limited(JOB_RATE_LIMIT)
+async def query_submit(request):
+    payload = await get_payload(request)
+    reply = await handle_submit(AsyncBackend(request), payload)
+    return make_response(reply)
+
+
+async def query_job(request):
+    job_id = request.path_params["job_id"]
+    reply = await handle_job(
+        AsyncBackend(request), job_id, request.query_params
+    )
+    return make_response(reply)
+
+
+@rate_limited(STATS_RATE_LIMIT)
+async def stats(request):
+    reply = await handle_stats(AsyncBackend(request), request.query_params)
+    return make_response(reply)
+
+
+async def cache(request):
+    if (caching := request.app.state.caching) is None:
+        return JSONResponse({}, 200)
+    return JSONResponse(caching.get_metrics(), 200)
+
+
+async def metrics(request):
+    body, content_type = render_metrics(request.app.state.metrics)
+    return Response(body, headers={"Content-Type": content_type})
+
+
+@rate_limited(QUERY_RATE_LIMIT)
+async def analyze(request):
+    payload = await get_payload(request)
+    if error := check_payload(payload, "query"):
+        return make_response(error)
+
+    statistics = await load_cost_statistics(request)
+    results = await run_sync(
+        request, analyze_query, payload["query"], statistics
+    )
+    return JSONResponse(results, 200)
+
+
+app = Starlette(
+    routes=[
+        Route("/query", instrumented(query), methods=["POST"]),
+        Route("/query/stream", instrumented(query_stream), methods=["POST"]),
+        Route("/query/submit", instrumented(query_submit), methods=["POST"]),
+        Route("/query/{job_id}", instrumented(query_job), methods=["GET"]),
+        Route("/stats", instrumented(stats), methods=["GET"]),
+        Route("/cache", cache, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/analyze", instrumented(analyze), methods=["POST"]),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=["*"],
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app)
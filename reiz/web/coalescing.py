@@ -0,0 +1,248 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+from reiz.utilities import logger
+
+DEFAULT_LOCK_TIMEOUT = 120.0
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Only release the lock if it is still owned by us, it might have been
+# expired and taken over by someone else in the meantime.
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+else
+    return 0
+end
+"""
+
+
+class RemoteCallError(Exception):
+    # Raised in the waiters of a call that has failed in another process,
+    # with the (JSON) description of the error that the owner published.
+
+    def __init__(self, payload, status):
+        super().__init__(payload, status)
+        self.payload = payload
+        self.status = status
+
+
+def describe_error(exc):
+    return str(exc), 500
+
+
+def encode_result(result):
+    return json.dumps({"result": result})
+
+
+def encode_error(exc, describe):
+    payload, status = describe(exc)
+    return json.dumps({"error": payload, "status": status})
+
+
+def decode_message(data):
+    message = json.loads(data)
+    if "error" in message:
+        raise RemoteCallError(message["error"], message["status"])
+    return message["result"]
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Coalesces the concurrent calls with the same key within a process;
+    # the first caller runs the function and the rest wait for its
+    # result (or its exception).
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            if call := self._calls.get(key):
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class RedisSingleFlight:
+    # Coalesces the calls across processes. The process that acquires the
+    # lock runs the function and publishes its result, the others wait
+    # for the message (and poll the lock, in case the owner dies). Calls
+    # within the same process are coalesced before touching redis.
+
+    def __init__(
+        self,
+        client,
+        lock_timeout=DEFAULT_LOCK_TIMEOUT,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        prefix="reiz:flight:",
+        describe=describe_error,
+    ):
+        # describe(exc) returns the (payload, status) of a failed call,
+        # which is re-raised as a RemoteCallError in all of its waiters.
+        self.client = client
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self.describe = describe
+        self.local = SingleFlight()
+        self._release = client.register_script(RELEASE_SCRIPT)
+
+    def do(self, key, func, lookup=None):
+        # lookup() is an optional way to check whether the result has
+        # already been stored somewhere else (e.g. a cache) by a call
+        # that finished before we subscribed.
+        return self.local.do(key, lambda: self._do(key, func, lookup))
+
+    def _do(self, key, func, lookup):
+        lock_key = self.prefix + "lock:" + key
+        channel = self.prefix + "done:" + key
+        token = uuid.uuid4().hex
+
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        try:
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                if lookup is not None and (result := lookup()) is not None:
+                    return result
+                if self.client.set(
+                    lock_key, token, nx=True, px=int(self.lock_timeout * 1000)
+                ):
+                    break
+
+                message = pubsub.get_message(timeout=self.poll_interval)
+                if message is not None and message["data"]:
+                    return decode_message(message["data"])
+            else:
+                logger.warning(
+                    "gave up on waiting for the query %r, running it", key
+                )
+                return func()
+        finally:
+            pubsub.close()
+
+        message = ""
+        try:
+            result = func()
+            message = encode_result(result)
+            return result
+        except Exception as exc:
+            message = encode_error(exc, self.describe)
+            raise
+        finally:
+            # The result is published before releasing the lock, otherwise
+            # a waiter could take it over in between and run the call
+            # again. An empty message wakes up the waiters when the call
+            # was interrupted, so one of them can take over the lock.
+            self.client.publish(channel, message)
+            self._release(keys=[lock_key], args=[token])
+
+
+class AsyncSingleFlight:
+    # The same as SingleFlight, for coroutines on a single event loop. The
+    # call runs on its own task, so that it isn't cancelled when the
+    # caller that started it goes away (e.g. a disconnected client).
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        if (call := self._calls.get(key)) is None:
+            call = self._calls[key] = asyncio.ensure_future(func())
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(call)
+
+
+class AsyncRedisSingleFlight:
+    # The same as RedisSingleFlight, on top of an asyncio redis client.
+
+    def __init__(
+        self,
+        client,
+        lock_timeout=DEFAULT_LOCK_TIMEOUT,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        prefix="reiz:flight:",
+        describe=describe_error,
+    ):
+        self.client = client
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self.describe = describe
+        self.local = AsyncSingleFlight()
+        self._release = client.register_script(RELEASE_SCRIPT)
+
+    async def do(self, key, func, lookup=None):
+        return await self.local.do(key, lambda: self._do(key, func, lookup))
+
+    async def _do(self, key, func, lookup):
+        lock_key = self.prefix + "lock:" + key
+        channel = self.prefix + "done:" + key
+        token = uuid.uuid4().hex
+
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(channel)
+        try:
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                if (
+                    lookup is not None
+                    and (result := await lookup()) is not None
+                ):
+                    return result
+                if await self.client.set(
+                    lock_key, token, nx=True, px=int(self.lock_timeout * 1000)
+                ):
+                    break
+
+                message = await pubsub.get_message(timeout=self.poll_interval)
+                if message is not None and message["data"]:
+                    return decode_message(message["data"])
+            else:
+                logger.warning(
+                    "gave up on waiting for the query %r, running it", key
+                )
+                return await func()
+        finally:
+            await pubsub.aclose()
+
+        message = ""
+        try:
+            result = await func()
+            message = encode_result(result)
+            return result
+        except Exception as exc:
+            message = encode_error(exc, self.describe)
+            raise
+        finally:
+            await self.client.publish(channel, message)
+            await self._release(keys=[lock_key], args=[token])
@@ -0,0 +1,276 @@
+import ast
+import hashlib
+import json
+import random
+from dataclasses import asdict, dataclass, replace
+from typing import Optional
+
+import edgedb
+
+from reiz.counters import TOTAL
+from reiz.db.pool import RETRIED_ERRORS
+from reiz.edgeql import as_edgeql
+from reiz.edgeql.cost import estimate_query_cost
+from reiz.fetch import DEFAULT_LIMIT, DEFAULT_NODES, Scope, get_cost_statistics
+from reiz.reizql import ReizQLSyntaxError, compile_edgeql, parse_query
+from reiz.utilities import logger, normalize
+
+# Shared between the WSGI (reiz.web.api) and the ASGI (reiz.web.asgi)
+# applications, so that both of them keep the same contract.
+
+MAX_LIMIT = 100
+MAX_STREAM_LIMIT = 10_000
+MAX_STATS_NODES = 64
+
+QUERY_RATE_LIMIT = "240 per hour"
+STREAM_RATE_LIMIT = "60 per hour"
+JOB_RATE_LIMIT = "60 per hour"
+STATS_RATE_LIMIT = "120 per hour"
+
+# The cost estimates of /analyze need the node counters from the database,
+# but the parse and the EdgeQL output are still useful without them.
+COST_ERRORS = RETRIED_ERRORS + (edgedb.errors.EdgeDBError,)
+
+# Seeds that are assigned to the sampled queries without one
+MAX_SEED = 2**31
+
+
+def find_missing_key(payload, *keys):
+    for key in keys:
+        if key not in payload.keys():
+            return key
+
+
+def validate_limit(limit, maximum):
+    if limit is None:
+        return limit
+    elif not isinstance(limit, int) or not 0 < limit <= maximum:
+        raise ValueError(f"limit should be an integer between 1 and {maximum}")
+    return limit
+
+
+def parse_stats_args(args):
+    # /stats?nodes=Name,Call&project=requests
+    nodes = DEFAULT_NODES
+    if raw_nodes := args.get("nodes"):
+        nodes = tuple(filter(None, raw_nodes.split(",")))
+        if len(nodes) > MAX_STATS_NODES or not all(
+            node.isidentifier() for node in nodes
+        ):
+            raise ValueError(
+                f"nodes should be a comma separated list of at most "
+                f"{MAX_STATS_NODES} node types"
+            )
+    return nodes, args.get("project", TOTAL)
+
+
+def parse_sample(payload):
+    # {"sample": 0.05, "seed": 42}; when the seed is omitted, a random one
+    # is assigned (and returned with the results) so that the next pages
+    # can be taken from the same modules.
+    sample, seed = payload.get("sample"), payload.get("seed")
+    if sample is None:
+        if seed is not None:
+            raise ValueError("seed can only be used together with sample")
+        return None, None
+
+    if isinstance(sample, bool) or not isinstance(sample, (int, float)):
+        raise ValueError("sample should be a number between 0 and 1")
+    elif not 0 < sample < 1:
+        raise ValueError("sample should be a number between 0 and 1")
+
+    if seed is None:
+        seed = random.randrange(MAX_SEED)
+    elif isinstance(seed, bool) or not isinstance(seed, int):
+        raise ValueError("seed should be an integer")
+    return float(sample), seed
+
+
+def parse_scope(payload):
+    # {"query": ..., "project": "requests", "filename": "*/tests/*"}
+    project, filename = payload.get("project"), payload.get("filename")
+    sample, seed = parse_sample(payload)
+    if project is None and filename is None and sample is None:
+        return None
+
+    for value in (project, filename):
+        if value is not None and not (isinstance(value, str) and value):
+            raise ValueError(
+                "project and filename should be non-empty strings"
+            )
+    return Scope(project=project, filename=filename, sample=sample, seed=seed)
+
+
+def parse_progressive(payload, stats, cursor):
+    # {"query": ..., "progressive": true} returns the first matches that
+    # are found in any project, see reiz.fetch.fetch_partitions
+    progressive = payload.get("progressive", False)
+    if not isinstance(progressive, bool):
+        raise ValueError("progressive should be a boolean")
+    elif progressive and (stats or cursor is not None):
+        raise ValueError("progressive queries can't be counted or paginated")
+    return progressive
+
+
+def find_payload_error(payload, *keys):
+    if not isinstance(payload, dict):
+        return "Expected a JSON object"
+    elif key := find_missing_key(payload, *keys):
+        return f"Missing key {key}"
+    else:
+        return None
+
+
+def get_page_args(args):
+    # /query/<job_id>?offset=100&limit=100
+    try:
+        offset = int(args.get("offset", 0))
+        limit = int(args.get("limit", MAX_LIMIT))
+    except ValueError:
+        raise ValueError("offset and limit should be integers") from None
+
+    if offset < 0:
+        raise ValueError("offset should be a positive integer")
+    return offset, validate_limit(limit, MAX_LIMIT)
+
+
+def job_payload(job_id):
+    return {
+        "status": "queued",
+        "results": [],
+        "exception": None,
+        "job": job_id,
+    }
+
+
+def error_payload(exception, **extras):
+    return {
+        "status": "error",
+        "results": [],
+        "exception": exception,
+        **extras,
+    }
+
+
+def syntax_error_payload(syntax_err):
+    return error_payload(syntax_err.message, **(syntax_err.position or {}))
+
+
+def canonicalize_query(source):
+    # Formatting differences (whitespace, quotes, parentheses) don't
+    # change the meaning of a query, so the keys are derived from its AST.
+    try:
+        return ast.dump(ast.parse(source))
+    except (SyntaxError, ValueError):
+        return source
+
+
+def get_query_key(
+    reiz_ql, limit, cursor, stats=False, scope=None, progressive=False
+):
+    parts = [canonicalize_query(reiz_ql), limit, cursor, stats]
+    if scope is not None:
+        parts.append(asdict(scope))
+    if progressive:
+        parts.append("progressive")
+    canonical = json.dumps(parts)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class QueryRequest:
+    # A validated /query payload
+    reiz_ql: str
+    stats: bool = False
+    limit: Optional[int] = DEFAULT_LIMIT
+    cursor: Optional[str] = None
+    scope: Optional[Scope] = None
+    progressive: bool = False
+    defer: bool = False
+    approximate: bool = False
+
+    @classmethod
+    def from_payload(cls, payload):
+        stats = payload.get("stats", False)
+        cursor = payload.get("cursor")
+        limit = validate_limit(payload.get("limit", DEFAULT_LIMIT), MAX_LIMIT)
+        scope = parse_scope(payload)
+        progressive = parse_progressive(payload, stats, cursor)
+        if stats:
+            # Counts don't depend on the page, so all of them share the
+            # same cache entry.
+            limit = cursor = None
+
+        return cls(
+            payload["query"],
+            stats=stats,
+            limit=limit,
+            cursor=cursor,
+            scope=scope,
+            progressive=progressive,
+            defer=payload.get("defer", False),
+            approximate=payload.get("approximate", False),
+        )
+
+    @property
+    def key(self):
+        return get_query_key(
+            self.reiz_ql,
+            self.limit,
+            self.cursor,
+            self.stats,
+            self.scope,
+            self.progressive,
+        )
+
+    def as_count(self):
+        return replace(
+            self,
+            stats=True,
+            limit=None,
+            cursor=None,
+            progressive=False,
+            defer=False,
+            approximate=False,
+        )
+
+
+def parse_stream_request(payload):
+    # /query/stream takes the same payload as /query, with a higher limit
+    # (or none at all)
+    return QueryRequest(
+        payload["query"],
+        limit=validate_limit(
+            payload.get("limit", MAX_STREAM_LIMIT), MAX_STREAM_LIMIT
+        ),
+        cursor=payload.get("cursor"),
+        scope=parse_scope(payload),
+    )
+
+
+def load_cost_statistics():
+    try:
+        return get_cost_statistics()
+    except COST_ERRORS as exc:
+        logger.warning("couldn't load the cost statistics: %r", exc)
+        return None
+
+
+def analyze_query(source, statistics=None):
+    results = dict.fromkeys(("exception", "reiz_ql", "edge_ql", "cost"))
+    try:
+        reiz_ql = parse_query(source)
+        results["reiz_ql"] = normalize(asdict(reiz_ql))
+        selection = compile_edgeql(reiz_ql)
+        results["edge_ql"] = as_edgeql(selection)
+
+        if statistics is not None:
+            cost = estimate_query_cost(selection, statistics)
+            results["cost"] = {**asdict(cost), "total": cost.total}
+    except ReizQLSyntaxError as syntax_err:
+        results["status"] = "error"
+        results["exception"] = syntax_err.message
+        results.update(syntax_err.position or {})
+    else:
+        results["status"] = "success"
+    return results
@@ -0,0 +1,338 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+import traceback
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from reiz.cache import decode_results, encode_results
+from reiz.db.timeouts import QueryTimeout, get_query_timeout
+from reiz.fetch import Scope, run_query, stream_query
+from reiz.reizql import parse_query
+from reiz.utilities import get_config_settings, logger
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_TTL = 24 * 60 * 60
+DEFAULT_JOBS_PATH = Path("~/.local/reiz-jobs").expanduser()
+DEFAULT_HEARTBEAT_INTERVAL = 30.0
+
+# Jobs whose owner hasn't refreshed their heartbeat for this many
+# intervals are considered lost (e.g. the worker was killed).
+MISSED_HEARTBEATS = 4
+
+PENDING_STATUSES = ("queued", "running")
+
+MAX_JOB_LIMIT = 10_000
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+class JobStore(ABC):
+    # Jobs are stored as a small JSON record (status, timings etc.) and a
+    # separate compressed blob of results, both expiring after the ttl.
+
+    def __init__(self, ttl: int = DEFAULT_JOB_TTL) -> None:
+        self.ttl = ttl
+
+    def expire(self) -> None:
+        # Stores that don't expire their entries by themselves remove the
+        # stale ones here.
+        pass
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def put(self, job: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def get_results(self, job_id: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def put_results(self, job_id: str, results: Any) -> None:
+        ...
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    else:
+        return True
+
+
+def is_orphaned(job: Dict[str, Any], stale_after: float) -> bool:
+    # A pending job is lost when its owner has exited (which can only be
+    # checked on the same host), or has stopped refreshing its heartbeat.
+    if job["status"] not in PENDING_STATUSES:
+        return False
+    elif job.get("host") == socket.gethostname() and not is_alive(job["pid"]):
+        return True
+    else:
+        return (
+            job.get("heartbeat", job["submitted"]) + stale_after < time.time()
+        )
+
+
+class RedisJobStore(JobStore):
+    def __init__(self, client, ttl: int = DEFAULT_JOB_TTL) -> None:
+        super().__init__(ttl)
+        self.client = client
+
+    def _key(self, job_id, suffix=""):
+        return f"reiz:job:{job_id}{suffix}"
+
+    def get(self, job_id):
+        if record := self.client.get(self._key(job_id)):
+            return json.loads(record)
+        else:
+            return None
+
+    def put(self, job):
+        self.client.set(self._key(job["id"]), json.dumps(job), ex=self.ttl)
+
+    def get_results(self, job_id):
+        if payload := self.client.get(self._key(job_id, ":results")):
+            return decode_results(payload)
+        else:
+            return None
+
+    def put_results(self, job_id, results):
+        self.client.set(
+            self._key(job_id, ":results"),
+            encode_results(results),
+            ex=self.ttl,
+        )
+
+
+class DiskJobStore(JobStore):
+    def __init__(self, path: Path, ttl: int = DEFAULT_JOB_TTL) -> None:
+        super().__init__(ttl)
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _read(self, path):
+        try:
+            if path.stat().st_mtime + self.ttl < time.time():
+                return None
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, data):
+        # Written under a temporary name and renamed, so that the readers
+        # never see a partial file.
+        temporary = path.with_suffix(".tmp")
+        temporary.write_bytes(data)
+        temporary.replace(path)
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        for path in self.path.iterdir():
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+            except FileNotFoundError:
+                continue
+
+    def get(self, job_id):
+        if record := self._read(self.path / f"{job_id}.json"):
+            return json.loads(record)
+        else:
+            return None
+
+    def put(self, job):
+        self._write(self.path / f"{job['id']}.json", json.dumps(job).encode())
+
+    def get_results(self, job_id):
+        if payload := self._read(self.path / f"{job_id}.results"):
+            return decode_results(payload)
+        else:
+            return None
+
+    def put_results(self, job_id, results):
+        self._write(self.path / f"{job_id}.results", encode_results(results))
+
+
+class JobManager:
+    # Runs the long queries on a small, separate pool of threads so that
+    # they don't occupy the workers that serve the interactive traffic.
+    # Every worker process has its own pool, but since the jobs are kept
+    # in a shared store any of them can report their status. The owner of
+    # a pending job keeps refreshing its heartbeat, so that the jobs of
+    # the workers that went away are reported as failed instead of
+    # pending forever.
+
+    def __init__(
+        self,
+        store: JobStore,
+        workers: int = DEFAULT_JOB_WORKERS,
+        heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+    ):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.heartbeat_interval = heartbeat_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._heartbeat_pid = None
+
+    def _put(self, job):
+        # Serialized with the heartbeats, so that an older state of the
+        # job can't overwrite a newer one.
+        with self._lock:
+            if job["status"] in PENDING_STATUSES:
+                self._pending[job["id"]] = job
+            else:
+                self._pending.pop(job["id"], None)
+            self.store.put(job)
+
+    def _update(self, job, **changes):
+        # Each state of a job is a new copy that is swapped in at once by
+        # _put(), so that the heartbeats never store a half-updated job
+        # (e.g. a finished one without its count).
+        with self._lock:
+            job = {**self._pending.get(job["id"], job), **changes}
+        self._put(job)
+        return job
+
+    def _start_heartbeat(self):
+        # The thread is started by the process that runs the jobs, e.g.
+        # not by the gunicorn's master before it forks the workers.
+        with self._lock:
+            if self._heartbeat_pid == os.getpid():
+                return None
+            self._heartbeat_pid = os.getpid()
+            self._pending.clear()
+
+        thread = threading.Thread(target=self._heartbeat, daemon=True)
+        thread.start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                for job in self._pending.values():
+                    job["heartbeat"] = time.time()
+                    try:
+                        self.store.put(job)
+                    except Exception:
+                        logger.exception("couldn't refresh job %s", job["id"])
+
+    def submit(
+        self,
+        reiz_ql: str,
+        stats: bool = False,
+        limit: int = MAX_JOB_LIMIT,
+        scope: Optional[Scope] = None,
+    ) -> str:
+        # The query is validated before it is queued, so that the syntax
+        # errors are reported right away.
+        timeout = get_query_timeout("job")
+        if stats:
+            parse_query(reiz_ql)
+            execute = partial(
+                run_query, reiz_ql, stats=True, timeout=timeout, scope=scope
+            )
+        else:
+            execute = partial(
+                list,
+                stream_query(
+                    reiz_ql, limit=limit, timeout=timeout, scope=scope
+                ),
+            )
+
+        self.store.expire()
+        self._start_heartbeat()
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "query": reiz_ql,
+            "stats": stats,
+            "limit": None if stats else limit,
+            "scope": None if scope is None else asdict(scope),
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+            "count": None,
+            "exception": None,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "heartbeat": time.time(),
+        }
+        self._put(job)
+        self.executor.submit(self._run, job, execute)
+        return job["id"]
+
+    def _run(self, job, execute):
+        job = self._update(job, status="running", started=time.time())
+        try:
+            results = execute()
+        except QueryTimeout as exc:
+            logger.warning("job %s has timed out", job["id"])
+            changes = dict(status="timeout", exception=exc.args[0])
+        except Exception:
+            logger.exception("job %s has failed", job["id"])
+            changes = dict(status="error", exception=traceback.format_exc())
+        else:
+            self.store.put_results(job["id"], results)
+            changes = dict(
+                status="success",
+                count=results if job["stats"] else len(results),
+            )
+        self._update(job, finished=time.time(), **changes)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+
+        job = self.store.get(job_id)
+        stale_after = self.heartbeat_interval * MISSED_HEARTBEATS
+        if job is not None and is_orphaned(job, stale_after):
+            logger.warning("job %s is lost, marking it as failed", job_id)
+            job.update(
+                status="failed",
+                exception="The worker that was running the job has exited",
+                finished=time.time(),
+            )
+            self.store.put(job)
+        return job
+
+    def get_page(self, job_id: str, offset: int, limit: int) -> Any:
+        results = self.store.get_results(job_id)
+        if isinstance(results, list):
+            return results[offset : offset + limit]
+        else:
+            # The counts of the stats=True jobs
+            return results
+
+
+def get_job_manager(client=None) -> JobManager:
+    options = get_config_settings().get("jobs", {})
+    ttl = options.get("ttl", DEFAULT_JOB_TTL)
+    if client is not None:
+        store = RedisJobStore(client, ttl)
+    else:
+        path = Path(options.get("path", DEFAULT_JOBS_PATH)).expanduser()
+        store = DiskJobStore(path, ttl)
+    return JobManager(
+        store,
+        options.get("workers", DEFAULT_JOB_WORKERS),
+        options.get("heartbeat_interval", DEFAULT_HEARTBEAT_INTERVAL),
+    )
@@ -0,0 +1,117 @@
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from reiz.utilities import get_config_settings
+
+PHASE_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+QUERY_PHASES = Histogram(
+    "reiz_query_phase_seconds",
+    "Time spent in each phase of serving a query",
+    ["phase"],
+    buckets=PHASE_BUCKETS,
+)
+REQUEST_LATENCY = Histogram(
+    "reiz_request_seconds",
+    "Total time spent on serving a request",
+    ["endpoint"],
+    buckets=PHASE_BUCKETS,
+)
+
+
+def uses_server_timing():
+    return get_config_settings().get("metrics", {}).get("server_timing", False)
+
+
+def observe_request(endpoint, duration, timings):
+    REQUEST_LATENCY.labels(endpoint).observe(duration)
+    for phase, phase_duration in timings.items():
+        QUERY_PHASES.labels(phase).observe(phase_duration)
+
+
+def format_server_timing(timings):
+    # Server-Timing: parse;dur=0.12, db;dur=30.50 (in milliseconds), see
+    # scripts/load_test.py for the consumer.
+    return ", ".join(
+        f"{phase};dur={duration * 1000:.2f}"
+        for phase, duration in timings.items()
+    )
+
+
+class StateCollector:
+    # The cache and the pool already keep their own counters, so they are
+    # read at the scrape time instead of being mirrored into metrics. When
+    # running under multiple workers, these only reflect the worker that
+    # has served the scrape.
+
+    def __init__(self, get_cache_metrics, get_pool_metrics):
+        self.get_cache_metrics = get_cache_metrics
+        self.get_pool_metrics = get_pool_metrics
+
+    def collect(self):
+        lookups = CounterMetricFamily(
+            "reiz_cache_lookups",
+            "Number of result cache lookups",
+            labels=["tier", "result"],
+        )
+        hit_ratio = GaugeMetricFamily(
+            "reiz_cache_hit_ratio",
+            "Ratio of the result cache lookups that were hits",
+            labels=["tier"],
+        )
+        for tier, counts in (self.get_cache_metrics() or {}).items():
+            lookups.add_metric([tier, "hit"], counts["hits"])
+            lookups.add_metric([tier, "miss"], counts["misses"])
+            if total := counts["hits"] + counts["misses"]:
+                hit_ratio.add_metric([tier], counts["hits"] / total)
+        yield lookups
+        yield hit_ratio
+
+        connections = GaugeMetricFamily(
+            "reiz_pool_connections",
+            "State of the database connection pool",
+            labels=["state"],
+        )
+        for state, value in (self.get_pool_metrics() or {}).items():
+            connections.add_metric([state], value)
+        yield connections
+
+
+def render_metrics(collector):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Histograms are aggregated over all the gunicorn workers
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    state_registry = CollectorRegistry(auto_describe=True)
+    state_registry.register(collector)
+    body = generate_latest(registry) + generate_latest(state_registry)
+    return body, CONTENT_TYPE_LATEST
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import asdict
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from reiz.utilities import get_config_settings
+from reiz.web.common import get_query_key
+
+DEFAULT_SAMPLE_RATE = 1.0
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BACKUPS = 4
+
+
+def count_results(results):
+    if isinstance(results, list):
+        return len(results)
+    elif isinstance(results, dict):
+        # Approximate counts
+        return results["count"]
+    else:
+        return results
+
+
+def get_cache_outcome(caching, timings, approximate=False):
+    # A query that didn't reach the database was either served from the
+    # cache or coalesced into a call that has populated it.
+    if approximate:
+        return "approximate"
+    elif caching is None:
+        return None
+    elif "db" in timings:
+        return "miss"
+    else:
+        return "hit"
+
+
+class QueryLog:
+    # A sampled log of the served queries, one JSON object per line. The
+    # records are compatible with the scripts/load_test.py's replay mode
+    # (--queries-file), and the rest of the fields (timings, cache outcome
+    # etc.) describe how the query was served originally.
+
+    def __init__(
+        self,
+        path,
+        sample_rate=DEFAULT_SAMPLE_RATE,
+        max_bytes=DEFAULT_MAX_BYTES,
+        backups=DEFAULT_BACKUPS,
+    ):
+        self.path = Path(path)
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.handler = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_handler(self):
+        # Each process writes (and rotates) its own file (queries.jsonl.<pid>,
+        # see reiz.web.warmup.get_log_files), since the rotations can't be
+        # coordinated among the gunicorn workers. It is only opened on the
+        # first record, so that the forked workers don't share it.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                # Records are passed to the handler directly rather than
+                # through a logger, so that they never end up in the
+                # application logs (and aren't affected by their
+                # configuration).
+                self.handler = RotatingFileHandler(
+                    f"{self.path}.{self._pid}",
+                    maxBytes=self.max_bytes,
+                    backupCount=self.backups,
+                    delay=True,
+                )
+                self.handler.setFormatter(logging.Formatter("%(message)s"))
+            return self.handler
+
+    @classmethod
+    def from_config(cls):
+        options = get_config_settings().get("query_log", {})
+        if not (path := options.get("path")):
+            return None
+
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return cls(
+            path,
+            sample_rate=options.get("sample_rate", DEFAULT_SAMPLE_RATE),
+            max_bytes=options.get("max_bytes", DEFAULT_MAX_BYTES),
+            backups=options.get("backups", DEFAULT_BACKUPS),
+        )
+
+    def record(self, entry, status, duration, timings):
+        if random.random() >= self.sample_rate:
+            return None
+
+        scope = entry.get("scope")
+        record = {
+            "timestamp": time.time(),
+            "query": entry["query"],
+            "key": get_query_key(
+                entry["query"], None, None, entry["stats"], scope
+            ),
+            "stats": entry["stats"],
+            "scope": None if scope is None else asdict(scope),
+            "status": status,
+            "count": entry.get("count"),
+            "cache": entry.get("cache"),
+            "duration": duration,
+            "timings": timings,
+        }
+        line = json.dumps(record)
+        self.get_handler().handle(logging.makeLogRecord({"msg": line}))
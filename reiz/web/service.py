@@ -0,0 +1,365 @@
+import traceback
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Optional
+
+import edgedb
+
+from reiz.db.timeouts import QueryTimeout
+from reiz.fetch import CountEstimate, InvalidCursor, get_next_cursor
+from reiz.reizql import ReizQLSyntaxError
+from reiz.utilities import timed
+from reiz.web.admission import (
+    APPROXIMATE,
+    DEFER,
+    QUERY_COST_LIMIT,
+    REJECT,
+    rejection_message,
+)
+from reiz.web.coalescing import RemoteCallError
+from reiz.web.common import (
+    QueryRequest,
+    error_payload,
+    find_payload_error,
+    get_page_args,
+    job_payload,
+    parse_scope,
+    parse_stats_args,
+    syntax_error_payload,
+    validate_limit,
+)
+from reiz.web.jobs import MAX_JOB_LIMIT
+from reiz.web.querylog import count_results, get_cache_outcome
+
+# Request handling that is shared by the WSGI (reiz.web.api) and the ASGI
+# (reiz.web.asgi) applications. The handlers are coroutines, and all of
+# their I/O goes through a QueryBackend; the blocking backend of the WSGI
+# app never suspends them, so it runs them with run_blocking().
+
+
+@dataclass
+class Reply:
+    payload: Any
+    status: int = 200
+    headers: Dict[str, str] = field(default_factory=dict)
+    # Entry of the query log, see reiz.web.querylog
+    logged: Optional[Dict[str, Any]] = None
+
+
+class QueryBackend(ABC):
+    # Things that an application needs to provide; besides the methods,
+    # an 'admission' policy and a 'caching' (a result cache or None).
+
+    @abstractmethod
+    async def cache_get(self, key):
+        ...
+
+    @abstractmethod
+    async def cache_set(self, key, value):
+        ...
+
+    @abstractmethod
+    async def charge(self, units):
+        # Charges the client with the given units of query cost, returns
+        # whether it was within its limits.
+        ...
+
+    @abstractmethod
+    async def estimate(self, request):
+        ...
+
+    @abstractmethod
+    async def run(self, request, timings=None):
+        # Runs the query (coalesced with the identical ones) and stores
+        # its results in the cache, if there is one.
+        ...
+
+    @abstractmethod
+    async def approximate(self, request, timings=None):
+        ...
+
+    @abstractmethod
+    def refine(self, request):
+        # Computes the exact count of the query in the background
+        ...
+
+    @abstractmethod
+    async def submit(self, reiz_ql, stats, limit, scope=None):
+        ...
+
+    @abstractmethod
+    async def get_job(self, job_id):
+        ...
+
+    @abstractmethod
+    async def get_job_page(self, job_id, offset, limit):
+        ...
+
+    @abstractmethod
+    async def get_stats(self, nodes, project):
+        ...
+
+
+def run_blocking(coroutine):
+    # Runs a handler on a backend that never suspends, which completes
+    # on its first step.
+    try:
+        coroutine.send(None)
+    except StopIteration as result:
+        return result.value
+    else:
+        coroutine.close()
+        raise RuntimeError("the backend has suspended the handler")
+
+
+def error_reply(exception, code, **extras):
+    return Reply(error_payload(exception, **extras), code)
+
+
+def check_payload(payload, *keys):
+    if message := find_payload_error(payload, *keys):
+        return error_reply(message, 412)
+    else:
+        return None
+
+
+def query_error_reply(exc):
+    if isinstance(exc, QueryTimeout):
+        return error_reply(exc.args[0], 504, status="timeout")
+    elif isinstance(exc, ReizQLSyntaxError):
+        return Reply(syntax_error_payload(exc), 422)
+    elif isinstance(exc, InvalidCursor):
+        return error_reply(exc.args[0], 412)
+    elif isinstance(exc, edgedb.errors.InvalidReferenceError):
+        return error_reply(exc.args[0], 412)
+    elif isinstance(exc, RemoteCallError):
+        return Reply(exc.payload, exc.status)
+    else:
+        return error_reply(
+            "".join(
+                traceback.format_exception(type(exc), exc, exc.__traceback__)
+            ),
+            412,
+        )
+
+
+def describe_query_error(exc):
+    # Errors of the coalesced queries are shared with the waiters in the
+    # other processes, see reiz.web.coalescing
+    reply = query_error_reply(exc)
+    return reply.payload, reply.status
+
+
+def stream_error_payload(exc):
+    # Errors after the first result can't change the status code anymore,
+    # so the streams report them as their last line.
+    if isinstance(exc, QueryTimeout):
+        return {"status": "timeout", "exception": exc.args[0]}
+    else:
+        return {
+            "status": "error",
+            "exception": "".join(
+                traceback.format_exception(type(exc), exc, exc.__traceback__)
+            ),
+        }
+
+
+async def run_cached_query(backend, request, timings=None):
+    if backend.caching is not None:
+        with timed(timings, "cache"):
+            results = await backend.cache_get(request.key)
+        if results is not None:
+            return results
+
+    return await backend.run(request, timings)
+
+
+async def run_approximate_count(backend, request, timings=None):
+    # A sampled estimate is returned right away, and the exact count is
+    # computed in the background so that the next requests can get it
+    # from the cache.
+    key = request.as_count().key
+    if backend.caching is not None:
+        with timed(timings, "cache"):
+            count = await backend.cache_get(key)
+        if count is not None:
+            return asdict(CountEstimate(count, 0, exact=True))
+
+    estimate = await backend.approximate(request, timings)
+    if backend.caching is None:
+        return estimate
+    elif estimate["exact"]:
+        await backend.cache_set(key, estimate["count"])
+    else:
+        backend.refine(request)
+    return estimate
+
+
+async def should_defer(backend, request):
+    # Queries that would occupy the worker for a long time are run as a
+    # job instead, if the client is fine with it ({"defer": true}).
+    if not request.stats:
+        return False
+    elif backend.caching is None:
+        return True
+    else:
+        return await backend.cache_get(request.as_count().key) is None
+
+
+async def admit_query(backend, request, timings=None):
+    # Cached results are free, everything else is judged by its estimated
+    # cost; see reiz.web.admission
+    admission = backend.admission
+    if backend.caching is not None:
+        with timed(timings, "cache"):
+            cached = await backend.cache_get(request.key) is not None
+        if cached:
+            return (
+                admission.admit(
+                    0, request.stats, request.defer, request.approximate
+                ),
+                0,
+            )
+
+    with timed(timings, "admission"):
+        cost = (await backend.estimate(request)).total
+    decision = admission.admit(
+        cost, request.stats, request.defer, request.approximate
+    )
+    return decision, cost
+
+
+async def submit_job(backend, reiz_ql, stats, limit, scope=None):
+    job_id = await backend.submit(reiz_ql, stats, limit, scope)
+    return Reply(job_payload(job_id), 202)
+
+
+def query_reply(backend, request, results, decision, timings, logged):
+    response = {
+        "status": "success",
+        "results": results,
+        "exception": None,
+    }
+    if request.progressive:
+        response["cursor"] = None
+    elif not request.stats:
+        response["cursor"] = get_next_cursor(results, request.limit)
+    if request.scope is not None and request.scope.sample is not None:
+        response["seed"] = request.scope.seed
+
+    reply = Reply(response)
+    cache = get_cache_outcome(
+        backend.caching, timings, decision == APPROXIMATE
+    )
+    logged.update(count=count_results(results), cache=cache)
+    if cache is not None:
+        reply.headers["X-Reiz-Cache"] = cache
+    return reply
+
+
+async def handle_query(backend, payload, timings=None):
+    if error := check_payload(payload, "query"):
+        return error
+
+    try:
+        request = QueryRequest.from_payload(payload)
+    except ValueError as exc:
+        return error_reply(exc.args[0], 412)
+
+    logged = {
+        "query": request.reiz_ql,
+        "stats": request.stats,
+        "scope": request.scope,
+    }
+    try:
+        decision, cost = await admit_query(backend, request, timings)
+        admission = backend.admission
+        if not await backend.charge(admission.charge(cost, decision)):
+            reply = error_reply(
+                f"Rate limit exceeded: {QUERY_COST_LIMIT}", 429
+            )
+        elif decision == REJECT:
+            reply = error_reply(
+                rejection_message(cost, admission.budget), 403, cost=cost
+            )
+        elif decision == DEFER or (
+            request.defer and await should_defer(backend, request)
+        ):
+            reply = await submit_job(
+                backend,
+                request.reiz_ql,
+                request.stats,
+                request.limit,
+                request.scope,
+            )
+        else:
+            if decision == APPROXIMATE:
+                results = await run_approximate_count(
+                    backend, request, timings
+                )
+            else:
+                results = await run_cached_query(backend, request, timings)
+            reply = query_reply(
+                backend, request, results, decision, timings, logged
+            )
+    except Exception as exc:
+        reply = query_error_reply(exc)
+
+    reply.logged = logged
+    return reply
+
+
+async def handle_submit(backend, payload):
+    if error := check_payload(payload, "query"):
+        return error
+
+    reiz_ql = payload["query"]
+    stats = payload.get("stats", False)
+    admission = backend.admission
+    try:
+        limit = validate_limit(
+            payload.get("limit", MAX_JOB_LIMIT), MAX_JOB_LIMIT
+        )
+        scope = parse_scope(payload)
+        request = QueryRequest(reiz_ql, stats=stats, limit=limit, scope=scope)
+        cost = (await backend.estimate(request)).total
+        if not admission.admit_job(cost):
+            return error_reply(
+                rejection_message(cost, admission.max_cost), 403, cost=cost
+            )
+        return await submit_job(backend, reiz_ql, stats, limit, scope)
+    except ReizQLSyntaxError as syntax_err:
+        return Reply(syntax_error_payload(syntax_err), 422)
+    except ValueError as exc:
+        return error_reply(exc.args[0], 412)
+
+
+async def handle_job(backend, job_id, args):
+    if not (job := await backend.get_job(job_id)):
+        return error_reply(f"Unknown job {job_id}", 404)
+
+    try:
+        offset, limit = get_page_args(args)
+    except ValueError as exc:
+        return error_reply(exc.args[0], 412)
+
+    response = {
+        "status": job["status"],
+        "results": [],
+        "exception": job["exception"],
+        "job": job,
+    }
+    if job["status"] == "success":
+        response["results"] = await backend.get_job_page(job_id, offset, limit)
+        if not job["stats"] and offset + limit < job["count"]:
+            response["offset"] = offset + limit
+    return Reply(response)
+
+
+async def handle_stats(backend, args):
+    try:
+        nodes, project = parse_stats_args(args)
+    except ValueError as exc:
+        return error_reply(exc.args[0], 412)
+
+    return Reply(await backend.get_stats(nodes, project))
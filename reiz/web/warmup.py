@@ -0,0 +1,259 @@
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from reiz.db.timeouts import QueryTimeout
+from reiz.fetch import (
+    DEFAULT_LIMIT,
+    get_cost_statistics,
+    get_stats,
+    prepare_query,
+    run_query,
+)
+from reiz.reizql import ReizQLSyntaxError
+from reiz.utilities import get_config_settings, logger
+from reiz.web.common import get_query_key
+
+DEFAULT_TOP_QUERIES = 50
+DEFAULT_WORKERS = 2
+DEFAULT_TIME_BUDGET = 60.0
+
+# Below this, a query isn't worth starting since it would most likely
+# time out anyway.
+MIN_QUERY_TIME = 1.0
+
+# Claimed by the worker that warms up the cache of a corpus generation
+WARMUP_LOCK_KEY = "reiz:warmup:{generation}"
+
+
+def get_log_files(path):
+    # The logs of each process (queries.jsonl.<pid>, see reiz.web.querylog)
+    # and their rotated backups (queries.jsonl.<pid>.1, ...)
+    path = Path(path).expanduser()
+    return [path, *sorted(path.parent.glob(path.name + ".*"))]
+
+
+def read_query_log(paths, top=DEFAULT_TOP_QUERIES):
+    # Most frequent successful queries in the logs of reiz.web.querylog,
+    # grouped by their canonical forms.
+    counts, queries = Counter(), {}
+    for path in paths:
+        if not path.exists():
+            continue
+        with open(path) as stream:
+            for line in stream:
+                # e.g. a line that is still being written
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.debug("skipping a malformed line of %s", path)
+                    continue
+                # Only the corpus-wide queries are warmed up
+                if record["status"] != 200 or record.get("scope"):
+                    continue
+                counts[record["key"]] += 1
+                queries.setdefault(
+                    record["key"], (record["query"], record["stats"])
+                )
+    return [queries[key] for key, _ in counts.most_common(top)]
+
+
+def read_queries_file(path):
+    # One query per line, e.g. the load_test.py's QUERIES
+    with open(path) as stream:
+        return [(line, False) for line in filter(None, map(str.strip, stream))]
+
+
+def get_configured_queries(options):
+    queries = []
+    for query in options.get("queries", []):
+        if isinstance(query, str):
+            queries.append((query, False))
+        else:
+            queries.append((query["query"], query.get("stats", False)))
+    return queries
+
+
+def get_warmup_queries(options, top):
+    queries = get_configured_queries(options)
+    if log_path := get_config_settings().get("query_log", {}).get("path"):
+        queries.extend(read_query_log(get_log_files(log_path), top))
+    return list(dict.fromkeys(queries))[:top]
+
+
+def warm_query(caching, reiz_ql, stats, deadline):
+    # Populates the cache entry that the /query would use for the first
+    # page (or the count) of this query. Without a cache, only the
+    # per-process state (e.g. the interned EdgeQL trees) is warmed up.
+    limit = None if stats else DEFAULT_LIMIT
+    if caching is None:
+        prepare_query(reiz_ql, stats=stats, limit=limit)
+        return True
+
+    key = get_query_key(reiz_ql, limit, None, stats)
+    if caching.get(key) is not None:
+        return False
+
+    if (remaining := deadline - time.monotonic()) < MIN_QUERY_TIME:
+        return False
+
+    results = run_query(reiz_ql, stats=stats, limit=limit, timeout=remaining)
+    caching.set(key, results)
+    return True
+
+
+def warmup(
+    queries,
+    caching=None,
+    workers=DEFAULT_WORKERS,
+    time_budget=DEFAULT_TIME_BUDGET,
+):
+    # The work is bounded both by the number of concurrent queries and by
+    # the total time; the queries that don't fit into the budget are
+    # skipped and the running ones are cut by their timeouts.
+    deadline = time.monotonic() + time_budget
+    get_stats()
+    get_cost_statistics()
+
+    def warm(query):
+        reiz_ql, stats = query
+        if time.monotonic() >= deadline:
+            return None
+        try:
+            return warm_query(caching, reiz_ql, stats, deadline)
+        except (ReizQLSyntaxError, QueryTimeout) as exc:
+            logger.warning("couldn't warm up %r: %s", reiz_ql, exc)
+        except Exception:
+            logger.exception("couldn't warm up %r", reiz_ql)
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(warm, queries))
+
+    warmed = outcomes.count(True)
+    logger.info(
+        "warmed up %d queries (%d were already cached, %d were skipped)",
+        warmed,
+        outcomes.count(False),
+        outcomes.count(None),
+    )
+    return warmed
+
+
+def get_caching():
+    if not (redis_url := get_config_settings().get("redis")):
+        return None
+
+    import redis
+
+    from reiz.cache import ResultCache
+
+    return ResultCache.from_config(redis.from_url(redis_url))
+
+
+def warmup_from_config(caching=None):
+    options = get_config_settings().get("warmup", {})
+    if caching is None:
+        caching = get_caching()
+    queries = get_warmup_queries(
+        options, options.get("top", DEFAULT_TOP_QUERIES)
+    )
+    return warmup(
+        queries,
+        caching=caching,
+        workers=options.get("workers", DEFAULT_WORKERS),
+        time_budget=options.get("time_budget", DEFAULT_TIME_BUDGET),
+    )
+
+
+def claim_warmup(caching, time_budget):
+    # Only one of the API workers (of all the hosts) warms up the shared
+    # cache, the rest would run the same queries at the same time. The
+    # claim expires with the time budget; a worker that starts afterwards
+    # would find the queries in the cache anyway.
+    key = WARMUP_LOCK_KEY.format(generation=caching.get_generation())
+    return caching.client.set(
+        key, os.getpid(), nx=True, px=int(time_budget * 1000)
+    )
+
+
+def warmup_on_startup(caching=None):
+    options = get_config_settings().get("warmup", {})
+    if caching is None:
+        caching = get_caching()
+
+    # Without a shared cache, each worker only warms up its own state
+    time_budget = options.get("time_budget", DEFAULT_TIME_BUDGET)
+    if caching is not None and not claim_warmup(caching, time_budget):
+        logger.info("the cache is warmed up by another worker")
+        return None
+    return warmup_from_config(caching)
+
+
+def start_warmup(caching=None):
+    # Startup hook of the API workers ({"warmup": {"on_startup": true}});
+    # runs in the background so that the worker can serve right away.
+    options = get_config_settings().get("warmup", {})
+    if not options.get("on_startup", False):
+        return None
+
+    thread = threading.Thread(
+        target=warmup_on_startup, args=(caching,), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def main():
+    options = get_config_settings().get("warmup", {})
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--query-log",
+        type=Path,
+        help="take the most frequent queries from the given query log "
+        "(and its rotated files)",
+    )
+    parser.add_argument(
+        "--queries-file",
+        type=Path,
+        help="a file with one query per line",
+    )
+    parser.add_argument(
+        "--top", type=int, default=options.get("top", DEFAULT_TOP_QUERIES)
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=options.get("workers", DEFAULT_WORKERS),
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=options.get("time_budget", DEFAULT_TIME_BUDGET),
+    )
+    arguments = parser.parse_args()
+
+    if arguments.query_log:
+        queries = read_query_log(
+            get_log_files(arguments.query_log), arguments.top
+        )
+    elif arguments.queries_file:
+        queries = read_queries_file(arguments.queries_file)[: arguments.top]
+    else:
+        queries = get_warmup_queries(options, arguments.top)
+
+    warmup(
+        queries,
+        caching=get_caching(),
+        workers=arguments.workers,
+        time_budget=arguments.time_budget,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+import ast
+import json
+import math
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+
+from query_smith import generate_node, load_asdl_map, random_subclass, unparse
+
+from reiz.edgeql.optimizer import OptimizerState, optimize_edgeql
+from reiz.reizql import ReizQLSyntaxError, compile_edgeql, parse_query
+from reiz.utilities import logger
+
+DEFAULT_ASDL = Path(__file__).parent.parent / "static" / "Python-reiz.asdl"
+DEFAULT_BASELINE = Path("~/.local/reiz-compiler-baseline.json").expanduser()
+
+PHASES = {
+    "parse": parse_query,
+    "compile": compile_edgeql,
+    "optimize": lambda tree: optimize_edgeql(tree, OptimizerState()),
+    "construct": lambda tree: tree.construct(),
+}
+
+
+def generate_corpus(seed, level, amount):
+    random.seed(seed * 1000 + level)
+    return [
+        unparse(
+            generate_node(
+                random_subclass(ast.expr), max_depth=level, max_width=level
+            )
+        )
+        for _ in range(amount)
+    ]
+
+
+def run_phases(source, measure):
+    # Every phase is fed with the output of the previous one. Nothing
+    # is kept alive between runs, so that the interned nodes (and their
+    # cached constructions) from the last run can't be reused.
+    results = {}
+    value = source
+    for phase, func in PHASES.items():
+        value, results[phase] = measure(func, value)
+    return results
+
+
+def measure_time(func, value):
+    start = time.perf_counter()
+    result = func(value)
+    return result, time.perf_counter() - start
+
+
+def measure_memory(func, value):
+    tracemalloc.start()
+    try:
+        result = func(value)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def benchmark_query(source, repeat):
+    timings = [run_phases(source, measure_time) for _ in range(repeat)]
+    memory = run_phases(source, measure_memory)
+    return {
+        phase: {
+            "time": statistics.median(timing[phase] for timing in timings),
+            "memory": memory[phase],
+        }
+        for phase in PHASES
+    }
+
+
+def benchmark_level(corpus, repeat):
+    sizes, reports = [], []
+    for source in corpus:
+        try:
+            reports.append(benchmark_query(source, repeat))
+        except ReizQLSyntaxError:
+            # Not every generated query is supported by the compiler.
+            continue
+        sizes.append(len(source))
+
+    return {
+        "queries": len(reports),
+        "skipped": len(corpus) - len(reports),
+        "size": statistics.mean(sizes) if sizes else 0,
+        "sizes": sizes,
+        "phases": {
+            phase: {
+                "time": sum(report[phase]["time"] for report in reports),
+                "memory": max(
+                    (report[phase]["memory"] for report in reports),
+                    default=0,
+                ),
+                "times": [report[phase]["time"] for report in reports],
+            }
+            for phase in PHASES
+        },
+    }
+
+
+def growth_exponent(sizes, timings):
+    # Slope of the log-log fit of time over query size; ~1 means
+    # linear scaling, anything well above it is superlinear.
+    points = [
+        (math.log(size), math.log(timing))
+        for size, timing in zip(sizes, timings)
+        if size > 0 and timing > 0
+    ]
+    if len(points) < 2:
+        return None
+
+    mean_x = statistics.mean(x for x, _ in points)
+    mean_y = statistics.mean(y for _, y in points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return covariance / variance
+
+
+def summarize(levels):
+    exponents = {}
+    for phase in PHASES:
+        sizes, timings = [], []
+        for report in levels.values():
+            sizes.extend(report["sizes"])
+            timings.extend(report["phases"][phase]["times"])
+        exponents[phase] = growth_exponent(sizes, timings)
+
+    for report in levels.values():
+        del report["sizes"]
+        for phase_report in report["phases"].values():
+            del phase_report["times"]
+    return exponents
+
+
+def find_regressions(results, baseline, tolerance, exponent_slack):
+    regressions = []
+    for level, report in results["levels"].items():
+        if not (base_report := baseline["levels"].get(level)):
+            continue
+        for phase, phase_report in report["phases"].items():
+            base_phase = base_report["phases"][phase]
+            for metric in ("time", "memory"):
+                if base_phase[metric] == 0:
+                    continue
+                ratio = phase_report[metric] / base_phase[metric]
+                if ratio > tolerance:
+                    regressions.append(
+                        f"level {level} {phase} {metric}: {ratio:.2f}x"
+                    )
+
+    for phase, exponent in results["exponents"].items():
+        base_exponent = baseline["exponents"].get(phase)
+        if exponent is None or base_exponent is None:
+            continue
+        if exponent > base_exponent + exponent_slack:
+            regressions.append(
+                f"{phase} growth exponent: "
+                f"{base_exponent:.2f} -> {exponent:.2f}"
+            )
+    return regressions
+
+
+def print_report(results):
+    header = " ".join(f"{phase + ' ms/KiB':>20}" for phase in PHASES)
+    print(f"{'level':>5} {'queries':>8} {'skipped':>8} {'size':>8} {header}")
+    for level, report in results["levels"].items():
+        columns = " ".join(
+            f"{phase['time'] * 1000:11.2f}/{phase['memory'] / 1024:8.1f}"
+            for phase in report["phases"].values()
+        )
+        print(
+            f"{level:>5} {report['queries']:>8} {report['skipped']:>8} "
+            f"{report['size']:8.1f} {columns}"
+        )
+
+    print(
+        "growth exponents:",
+        ", ".join(
+            f"{phase}={exponent:.2f}"
+            for phase, exponent in results["exponents"].items()
+            if exponent is not None
+        ),
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--asdl-file", type=Path, default=DEFAULT_ASDL)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--levels", type=int, nargs="+", default=[1, 2, 3, 4, 5, 6]
+    )
+    parser.add_argument("--queries", type=int, default=25)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument("--exponent-slack", type=float, default=0.25)
+    options = parser.parse_args()
+
+    load_asdl_map(options.asdl_file.read_text())
+    settings = {
+        "seed": options.seed,
+        "queries": options.queries,
+        "levels": options.levels,
+    }
+
+    levels = {}
+    for level in options.levels:
+        corpus = generate_corpus(options.seed, level, options.queries)
+        levels[str(level)] = benchmark_level(corpus, options.repeat)
+
+    exponents = summarize(levels)
+    results = {"settings": settings, "levels": levels, "exponents": exponents}
+    print_report(results)
+
+    if options.save_baseline:
+        with open(options.baseline, "w") as baseline_f:
+            json.dump(results, baseline_f, indent=4)
+        print(f"baseline saved to {options.baseline}")
+        return
+
+    if not options.baseline.exists():
+        return
+
+    with open(options.baseline) as baseline_f:
+        baseline = json.load(baseline_f)
+
+    if baseline["settings"] != settings:
+        logger.warning(
+            "baseline was recorded with different settings (%r), "
+            "skipping the comparison",
+            baseline["settings"],
+        )
+        return
+
+    if regressions := find_regressions(
+        results, baseline, options.tolerance, options.exponent_slack
+    ):
+        print("regressions:")
+        for regression in regressions:
+            print("   ", regression)
+        sys.exit(1)
+    else:
+        print("no regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
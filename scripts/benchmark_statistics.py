@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import statistics
+import time
+from argparse import ArgumentParser
+
+from load_test import QUERIES
+
+from reiz.db.connection import connect
+from reiz.db.statistics import get_statistics
+from reiz.fetch import compile_query
+from reiz.reizql import parse_query
+from reiz.utilities import get_db_settings, logger
+
+
+def measure(connection, query, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        connection.query(query)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def compare(connection, reiz_ql, corpus_stats, iterations, stats=False):
+    # The baseline skips the optimizer altogether; even without any
+    # statistics it would reorder the filters by the default selectivities.
+    tree = parse_query(reiz_ql)
+    plain_query = compile_query(tree, stats=stats, optimize=False)
+    tuned_query = compile_query(tree, stats=stats, statistics=corpus_stats)
+
+    plain = measure(connection, plain_query, iterations)
+    if tuned_query == plain_query:
+        tuned = plain
+    else:
+        tuned = measure(connection, tuned_query, iterations)
+    return plain, tuned
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--stats", action="store_true")
+    options = parser.parse_args()
+
+    corpus_stats = get_statistics()
+    if not corpus_stats:
+        raise ValueError(
+            "No statistics found, please run reiz.pipes.analyze first"
+        )
+
+    print(f"{'query':90} {'plain':>8} {'tuned':>8} {'speedup':>8}")
+    with connect(**get_db_settings()) as connection:
+        for query in QUERIES:
+            plain, tuned = compare(
+                connection,
+                query,
+                corpus_stats,
+                options.iterations,
+                stats=options.stats,
+            )
+            logger.debug("%r: %.4f -> %.4f", query, plain, tuned)
+            print(
+                f"{query:90} {plain:8.4f} {tuned:8.4f} {plain / tuned:7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
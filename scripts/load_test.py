@@ -1,11 +1,20 @@
 #!/usr/bin/env python
 
+import itertools
 import json
+import math
 import random
+import statistics
+import sys
+import time
 from argparse import ArgumentParser
+from collections import Counter, defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from functools import partial
-from urllib.error import HTTPError
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.error import HTTPError, URLError
 from urllib.request import Request, urlopen
 
 from reiz.utilities import logger
@@ -29,6 +38,8 @@ QUERIES = [
     "ClassDef(body=[AsyncFunctionDef(), AsyncFunctionDef()])",
 ]
 
+PERCENTILES = (50, 95, 99)
+
 
 class QueryError(Exception):
     @property
@@ -39,55 +50,466 @@ class QueryError(Exception):
     def reason(self):
         return self.args[1]
 
+    @property
+    def status(self):
+        # HTTP status of the response, if there was one
+        return self.args[2] if len(self.args) > 2 else None
+
+
+@dataclass
+class Query:
+    query: str
+    stats: bool = False
+    # Seconds since the start of the recording (only for replayed logs)
+    offset: Optional[float] = None
+    # {"project": ..., "filename": ..., "sample": ...}, see reiz.fetch.Scope
+    scope: Optional[Dict[str, Any]] = None
+
+    def as_payload(self):
+        return {"query": self.query, "stats": self.stats, **(self.scope or {})}
+
+
+@dataclass
+class Sample:
+    query: str
+    latency: float
+    phases: Dict[str, float] = field(default_factory=dict)
+    error: Optional[str] = None
+    # Cache outcome that is reported by the API (X-Reiz-Cache)
+    cache: Optional[str] = None
+    # HTTP status of the failed requests
+    status: Optional[int] = None
+
+
+def parse_server_timing(header):
+    # Server-Timing: compile;dur=1.2, db;dur=30.5
+    phases = {}
+    for metric in filter(None, header.split(",")):
+        name, *params = metric.strip().split(";")
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                phases[name] = float(value) / 1000
+    return phases
+
+
+def check_response(query, status, results, headers):
+    if status == 429:
+        raise QueryError(query.query, "RATE LIMITED!", status)
+    elif not isinstance(results, dict):
+        # e.g. the HTML error pages of a proxy (502, 504)
+        raise QueryError(
+            query.query, f"unexpected response ({status})", status
+        )
+    elif results.get("status") != "success":
+        raise QueryError(query.query, results.get("exception"), status)
+
+    phases = {}
+    if server_timing := headers.get("Server-Timing"):
+        phases = parse_server_timing(server_timing)
+    return phases, headers.get("X-Reiz-Cache")
+
 
 def post_request(api, query):
     request = Request(api + "/query")
     request.add_header("Content-Type", "application/json")
+    payload = json.dumps(query.as_payload())
     try:
-        with urlopen(request, json.dumps({"query": query}).encode()) as page:
-            results = json.load(page)
+        with urlopen(request, payload.encode()) as page:
+            status, headers, body = page.status, page.headers, page.read()
     except HTTPError as exc:
-        if exc.code == 429:
-            raise QueryError(query, "RATE LIMITED!")
-        else:
-            results = json.load(exc)
+        status, headers, body = exc.code, exc.headers, exc.read()
+    except (URLError, OSError) as exc:
+        # Refused or dropped connections, timeouts etc.
+        raise QueryError(query.query, repr(exc))
+
+    try:
+        results = json.loads(body)
+    except ValueError:
+        results = None
+    return check_response(query, status, results, headers)
+
+
+class AppClient:
+    def __init__(self):
+        from reiz.web.api import app, limiter
+
+        # The benchmark would hit the per-client limits immediately
+        limiter.enabled = False
+        self.app = app
+
+    def __call__(self, query):
+        with self.app.test_client() as client:
+            response = client.post("/query", json=query.as_payload())
+        return check_response(
+            query, response.status_code, response.get_json(), response.headers
+        )
+
+
+def run_direct(query):
+    from reiz.fetch import Scope, run_query
+
+    timings = {}
+    scope = Scope(**query.scope) if query.scope else None
+    try:
+        run_query(query.query, stats=query.stats, timings=timings, scope=scope)
+    except Exception as exc:
+        raise QueryError(query.query, repr(exc))
+    return timings, None
 
-    if results["status"] != "success":
-        raise QueryError(query, results["exception"])
 
-    return results["results"]
+def get_target(options):
+    if options.target == "http":
+        return partial(post_request, options.api)
+    elif options.target == "app":
+        return AppClient()
+    else:
+        return run_direct
 
 
-def worker(query, api):
+def measure(target, query, scheduled=None):
+    # In open-loop mode the latency is measured from the scheduled
+    # arrival, so that the time spent on waiting for a free worker is
+    # accounted (avoiding coordinated omission).
+    start = scheduled or time.perf_counter()
     try:
-        matches = len(post_request(api, query))
+        phases, cache = target(query)
     except QueryError as exc:
         logger.error("Query %r failed with %s!", exc.query, exc.reason)
-        return False
+        return Sample(
+            query.query,
+            time.perf_counter() - start,
+            error=str(exc.reason),
+            status=exc.status,
+        )
+    else:
+        return Sample(
+            query.query, time.perf_counter() - start, phases, cache=cache
+        )
+
+
+def run_closed_loop(target, workload, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(partial(measure, target), workload))
+
+
+def get_arrivals(workload, rate, poisson=False, speedup=None):
+    if speedup and all(query.offset is not None for query in workload):
+        base = workload[0].offset
+        return [(query.offset - base) / speedup for query in workload]
+    elif poisson:
+        intervals = (random.expovariate(rate) for _ in workload)
+        return list(itertools.accumulate(intervals))
+    else:
+        return [index / rate for index in range(len(workload))]
+
+
+def run_open_loop(target, workload, workers, arrivals):
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        start = time.perf_counter()
+        for query, arrival in zip(workload, arrivals):
+            scheduled = start + arrival
+            if (delay := scheduled - time.perf_counter()) > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(measure, target, query, scheduled))
+    return [future.result() for future in futures]
+
+
+def load_queries(paths):
+    # Either plain files with one query per line, or JSON lines logs
+    # where each record has a 'query' and optionally 'stats' and 'timestamp'
+    # (e.g. the per-process and rotated files of reiz.web.querylog, in any
+    # order).
+    queries = []
+    for path in paths:
+        queries.extend(load_query_file(path))
+
+    if all(query.offset is not None for query in queries):
+        queries.sort(key=lambda query: query.offset)
+    return queries
+
+
+def load_query_file(path):
+    queries = []
+    with open(path) as stream:
+        for line in filter(None, map(str.strip, stream)):
+            if not line.startswith("{"):
+                queries.append(Query(line))
+                continue
+
+            record = json.loads(line)
+            queries.append(
+                Query(
+                    record["query"],
+                    stats=record.get("stats", False),
+                    offset=record.get("timestamp"),
+                    scope=record.get("scope"),
+                )
+            )
+    return queries
+
+
+def repeat_queries(queries, iterations):
+    # The recorded offsets of each repetition are shifted after the ones
+    # before it (by the span of the log, plus the mean gap between two
+    # queries for the wrap), so that a replay doesn't fire every cycle
+    # after the first one at once.
+    if not all(query.offset is not None for query in queries):
+        return list(itertools.islice(itertools.cycle(queries), iterations))
+
+    span = queries[-1].offset - queries[0].offset
+    period = span + span / max(len(queries) - 1, 1)
+    workload = []
+    for index in range(iterations):
+        cycle, position = divmod(index, len(queries))
+        query = queries[position]
+        workload.append(replace(query, offset=query.offset + cycle * period))
+    return workload
+
+
+def get_workload(options):
+    if options.queries_file:
+        queries = load_queries(options.queries_file)
+        if options.iterations is None or not queries:
+            return queries
+        else:
+            return repeat_queries(queries, options.iterations)
     else:
-        logger.info("Query succeed with %d matches!", matches)
-        return True
+        return [
+            Query(query)
+            for query in random.choices(QUERIES, k=options.iterations or 100)
+        ]
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[rank]
+
+
+def summarize_latencies(values):
+    if not values:
+        return None
+
+    summary = {
+        f"p{percent}": percentile(values, percent) for percent in PERCENTILES
+    }
+    summary["mean"] = statistics.mean(values)
+    return summary
+
+
+def summarize_cache(samples):
+    outcomes = Counter(
+        sample.cache for sample in samples if sample.cache is not None
+    )
+    if not outcomes:
+        return None
+
+    lookups = outcomes["hit"] + outcomes["miss"]
+    return {
+        "outcomes": dict(outcomes),
+        "hit_rate": outcomes["hit"] / lookups if lookups else None,
+    }
+
+
+def summarize_samples(samples):
+    latencies = [sample.latency for sample in samples if sample.error is None]
+    phases = defaultdict(list)
+    for sample in samples:
+        for phase, duration in sample.phases.items():
+            phases[phase].append(duration)
+
+    failures = Counter(
+        str(sample.status or "error")
+        for sample in samples
+        if sample.error is not None
+    )
+    return {
+        "count": len(samples),
+        "errors": sum(failures.values()),
+        "failures": dict(failures),
+        "latency": summarize_latencies(latencies),
+        "cache": summarize_cache(samples),
+        "phases": {
+            phase: summarize_latencies(durations)
+            for phase, durations in phases.items()
+        },
+    }
+
+
+def summarize(samples, elapsed):
+    by_query = defaultdict(list)
+    for sample in samples:
+        by_query[sample.query].append(sample)
+
+    return {
+        "elapsed": elapsed,
+        "throughput": len(samples) / elapsed,
+        "overall": summarize_samples(samples),
+        "queries": {
+            query: summarize_samples(query_samples)
+            for query, query_samples in by_query.items()
+        },
+    }
+
+
+def format_latency(summary):
+    if summary is None:
+        return " ".join(f"{'-':>8}" for _ in PERCENTILES)
+    return " ".join(
+        f"{summary[f'p{percent}'] * 1000:8.1f}" for percent in PERCENTILES
+    )
+
+
+def print_report(report):
+    header = " ".join(f"{f'p{percent}':>8}" for percent in PERCENTILES)
+    print(f"{'query':90} {'count':>6} {'errors':>6} {header}")
+    for query, summary in report["queries"].items():
+        print(
+            f"{query[:90]:90} {summary['count']:6} {summary['errors']:6} "
+            f"{format_latency(summary['latency'])}"
+        )
+
+    overall = report["overall"]
+    print(
+        f"{'overall':90} {overall['count']:6} {overall['errors']:6} "
+        f"{format_latency(overall['latency'])}"
+    )
+    for phase, summary in overall["phases"].items():
+        print(
+            f"{'  phase: ' + phase:90} {'':6} {'':6} {format_latency(summary)}"
+        )
+    if failures := overall["failures"]:
+        statuses = ", ".join(
+            f"{status}: {count}" for status, count in failures.items()
+        )
+        print(f"failures: {statuses}")
+    if (cache := overall["cache"]) and cache["hit_rate"] is not None:
+        outcomes = ", ".join(
+            f"{outcome}: {count}"
+            for outcome, count in cache["outcomes"].items()
+        )
+        print(f"cache hit rate: {cache['hit_rate']:.1%} ({outcomes})")
+    print(
+        f"elapsed: {report['elapsed']:.2f}s, "
+        f"throughput: {report['throughput']:.2f} queries/s"
+    )
+
+
+def find_regressions(report, baseline, tolerance):
+    regressions = []
+    sections = [("overall", report["overall"], baseline["overall"])]
+    for query, summary in report["queries"].items():
+        if base_summary := baseline["queries"].get(query):
+            sections.append((query, summary, base_summary))
+
+    for name, summary, base_summary in sections:
+        current, previous = summary["latency"], base_summary["latency"]
+        if current is None or previous is None:
+            continue
+        for percent in PERCENTILES:
+            key = f"p{percent}"
+            if previous[key] and current[key] / previous[key] > tolerance:
+                regressions.append(
+                    f"{name} {key}: {previous[key] * 1000:.1f}ms "
+                    f"-> {current[key] * 1000:.1f}ms"
+                )
+    return regressions
 
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument("--workers", type=int, default=12)
+    parser.add_argument(
+        "--target",
+        choices=("http", "app", "direct"),
+        default="http",
+        help="send queries over HTTP to --api, to an in-process "
+        "reiz.web.api app, or directly to reiz.fetch.run_query",
+    )
     parser.add_argument("--api", default="https://api.tree.science")
-    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument(
+        "--mode",
+        choices=("closed", "open"),
+        default="closed",
+        help="closed: each worker waits for its last query to finish; "
+        "open: queries arrive at a fixed --rate regardless of latency",
+    )
+    parser.add_argument("--workers", type=int, default=12)
+    parser.add_argument("--rate", type=float, default=10.0)
+    parser.add_argument(
+        "--poisson",
+        action="store_true",
+        help="use exponentially distributed arrivals in the open mode",
+    )
+    parser.add_argument(
+        "--queries-file",
+        type=Path,
+        nargs="+",
+        help="replay queries from files (one per line, or JSON lines "
+        "such as the logs of reiz.web.querylog)",
+    )
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        help="replay the recorded arrival times, N times faster "
+        "(only in the open mode, with timestamped --queries-file logs)",
+    )
+    parser.add_argument("--iterations", type=int)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--tolerance", type=float, default=1.25)
     options = parser.parse_args()
+
+    if options.speedup and options.mode != "open":
+        parser.error("--speedup can only be used with --mode open")
+
+    random.seed(options.seed)
+    workload = get_workload(options)
+    if options.speedup and any(query.offset is None for query in workload):
+        parser.error("--speedup needs queries with recorded timestamps")
+    target = get_target(options)
     logger.info(
-        "Starting %d threads for running total of %d queries",
+        "Running %d queries with %d workers (%s-loop)",
+        len(workload),
         options.workers,
-        options.iterations,
+        options.mode,
     )
-    with ThreadPoolExecutor(max_workers=options.workers) as executor:
-        results = []
-        dataset = random.choices(QUERIES, k=options.iterations)
-        for result in executor.map(partial(worker, api=options.api), dataset):
-            results.append(result)
-            logger.info(
-                "Status: %d/%d", results.count(True), results.count(False)
-            )
+
+    start = time.perf_counter()
+    if options.mode == "closed":
+        samples = run_closed_loop(target, workload, options.workers)
+    else:
+        arrivals = get_arrivals(
+            workload, options.rate, options.poisson, options.speedup
+        )
+        samples = run_open_loop(target, workload, options.workers, arrivals)
+
+    report = summarize(samples, time.perf_counter() - start)
+    report["settings"] = {
+        "target": options.target,
+        "mode": options.mode,
+        "workers": options.workers,
+        "rate": options.rate if options.mode == "open" else None,
+    }
+    print_report(report)
+
+    if options.output:
+        with open(options.output, "w") as output_f:
+            json.dump(report, output_f, indent=4)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_f:
+            baseline = json.load(baseline_f)
+        if regressions := find_regressions(
+            report, baseline, options.tolerance
+        ):
+            print("regressions:")
+            for regression in regressions:
+                print("   ", regression)
+            sys.exit(1)
 
 
 if __name__ == "__main__":
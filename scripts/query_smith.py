@@ -16,7 +16,7 @@ def unparse(value):
     if isinstance(value, Node):
         return value.unparse()
     elif isinstance(value, list):
-        return [unparse(item) for item in value]
+        return "[" + ", ".join(unparse(item) for item in value) + "]"
     elif value is None:
         return value
     else:
@@ -65,18 +65,23 @@ def random_subclass(kind):
     return next(random_subclasses(kind, 1))
 
 
-def generate_node(node_type, level=0):
+def generate_node(node_type, level=0, max_depth=5, max_width=4):
     try:
         node_fields = NODE_DB[node_type.__base__][node_type]
     except KeyError:
         node_fields = ()
 
     fields = {}
-    if level >= random.randint(level, 5):
+    if level >= random.randint(level, max_depth):
         return Node(node_type, fields)
     else:
         level += 1
-        fetch = functools.partial(generate_node, level=level)
+        fetch = functools.partial(
+            generate_node,
+            level=level,
+            max_depth=max_depth,
+            max_width=max_width,
+        )
 
     for field in node_fields:
         if not (base := getattr(ast, field.kind, None)):
@@ -86,7 +91,7 @@ def generate_node(node_type, level=0):
             result = [
                 node
                 for sub_node_type in random_subclasses(
-                    base, random.randint(0, 4)
+                    base, random.randint(0, max_width)
                 )
                 if (node := fetch(sub_node_type))
             ]
@@ -95,9 +100,9 @@ def generate_node(node_type, level=0):
             and random.randint(0, 4) == 2
         ):
             # FIX-ME(high): handle optionals in ReizQL
-            fields[field.name] = None
+            result = None
         else:
-            result = generate_node(random_subclass(base), level=level)
+            result = fetch(random_subclass(base))
         fields[field.name] = result
 
     return Node(node_type, fields)
@@ -106,9 +111,23 @@ def generate_node(node_type, level=0):
 def main():
     parser = ArgumentParser()
     parser.add_argument("asdl_file", type=Path)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--max-depth", type=int, default=5)
+    parser.add_argument("--max-width", type=int, default=4)
+    parser.add_argument("--count", type=int, default=1)
     options = parser.parse_args()
     load_asdl_map(options.asdl_file.read_text())
-    print(unparse(generate_node(random_subclass(ast.expr))))
+    random.seed(options.seed)
+    for _ in range(options.count):
+        print(
+            unparse(
+                generate_node(
+                    random_subclass(ast.expr),
+                    max_depth=options.max_depth,
+                    max_width=options.max_width,
+                )
+            )
+        )
 
 
 if __name__ == "__main__":